@@ -0,0 +1,208 @@
+import os
+import sys
+import time
+import ftplib
+import shutil
+import socket
+import tempfile
+import argparse
+import threading
+import logging
+from bundler import Bundler, BUNDLE_DIR
+
+try:
+    import socketserver
+except ImportError:
+    # Python 2
+    import SocketServer as socketserver
+
+
+"""
+A benchmark of the upload throughput gained by bundling small files. A local
+FTP stand-in adds a fixed delay to every reply and data connection, standing
+in for the round trip time of a high latency link. A directory of small staged
+files is uploaded to it file by file, as the mirror does without bundling, and
+then bundled and uploaded as archives, and the files per second of each are
+reported. The time taken to bundle the files is included in the bundled rate.
+
+    python bundle_benchmark.py --files 200 --size 20000 --latency 0.3
+"""
+
+
+class LatencyFTPHandler(socketserver.StreamRequestHandler):
+    """
+    Handles the FTP commands used by ftplib to upload files, sleeping for the
+    server latency before every reply. Uploaded data is discarded.
+    """
+
+    def reply(self, line):
+        time.sleep(self.server.latency)
+        self.wfile.write((line + '\r\n').encode('ascii'))
+        self.wfile.flush()
+
+    def handle(self):
+        data_sock = None
+        self.reply('220 Benchmark server ready')
+        for line in self.rfile:
+            parts = line.decode('utf-8').strip().split(' ', 1)
+            cmd = parts[0].upper()
+            if cmd == 'USER':
+                self.reply('331 Password required')
+            elif cmd == 'PASS':
+                self.reply('230 Logged in')
+            elif cmd in ('TYPE', 'CWD'):
+                self.reply('200 OK')
+            elif cmd == 'MKD':
+                self.reply('257 Created')
+            elif cmd == 'PASV':
+                data_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                data_sock.bind(('127.0.0.1', 0))
+                data_sock.listen(1)
+                port = data_sock.getsockname()[1]
+                self.reply('227 Entering Passive Mode (127,0,0,1,{},{})'.format(port >> 8,
+                                                                               port & 255))
+            elif cmd == 'STOR' and data_sock is not None:
+                self.reply('150 Opening data connection')
+                conn, _ = data_sock.accept()
+                while conn.recv(65536):
+                    pass
+                conn.close()
+                data_sock.close()
+                data_sock = None
+                self.reply('226 Transfer complete')
+            elif cmd == 'QUIT':
+                self.reply('221 Goodbye')
+                break
+            else:
+                self.reply('502 Not implemented')
+
+
+class LatencyFTPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency):
+        """
+        A local FTP stand-in with injected latency, listening on a free port.
+
+        Args:
+            latency: The delay in seconds added to every reply
+        """
+
+        socketserver.TCPServer.__init__(self, ('127.0.0.1', 0), LatencyFTPHandler)
+        self.latency = latency
+
+
+def upload_files(address, root, paths):
+    """
+    Upload files one by one over a single FTP session, creating each remote
+    directory once, as the lftp mirror does.
+
+    Args:
+        address: A tuple of the server host and port
+        root: The local directory the paths are relative to
+        paths: The relative paths of the files to upload
+    """
+
+    ftp = ftplib.FTP()
+    ftp.connect(*address)
+    ftp.login('benchmark', 'benchmark')
+    ftp.voidcmd('TYPE I')
+    made = set()
+    for relpath in paths:
+        remote_dir = os.path.dirname(relpath)
+        if remote_dir and remote_dir not in made:
+            ftp.mkd(remote_dir)
+            made.add(remote_dir)
+        with open(os.path.join(root, relpath), 'rb') as infile:
+            ftp.storbinary('STOR {}'.format(relpath), infile)
+    ftp.quit()
+
+
+def make_files(root, n_files, size):
+    """
+    Write small files into a daily folder of a device upload directory, dated
+    in the past so that the bundler does not wait for them to settle.
+
+    Returns:
+        The relative paths of the files.
+    """
+
+    day_dir = os.path.join(root, '2020-05-01')
+    os.makedirs(day_dir)
+    paths = []
+    past = time.time() - 3600
+    for index in range(n_files):
+        relpath = os.path.join('2020-05-01', '2020-05-01T{:06d}.jpg'.format(index))
+        path = os.path.join(root, relpath)
+        with open(path, 'wb') as outfile:
+            outfile.write(os.urandom(size))
+        os.utime(path, (past, past))
+        paths.append(relpath)
+    return paths
+
+
+def benchmark(n_files=200, size=20000, latency=0.3, max_bytes=10 * 1024 * 1024):
+    """
+    Time the upload of small files with and without bundling.
+
+    Args:
+        n_files: The number of files to upload
+        size: The size of each file in bytes
+        latency: The delay in seconds added to every server reply
+        max_bytes: The size at which the bundler seals an archive
+    Returns:
+        A dictionary of the files per second uploaded without and with bundling,
+        the number of archives and the time taken to bundle the files.
+    """
+
+    server = LatencyFTPServer(latency)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    root = tempfile.mkdtemp()
+
+    try:
+        paths = make_files(root, n_files, size)
+        started = time.time()
+        upload_files(server.server_address, root, paths)
+        unbundled = time.time() - started
+
+        started = time.time()
+        bundler = Bundler(root, small_file_size=size + 1, max_bytes=max_bytes, settle_time=0)
+        bundler.bundle()
+        bundler.seal()
+        bundle_secs = time.time() - started
+        archives = [os.path.join(BUNDLE_DIR, fname)
+                    for fname in sorted(os.listdir(os.path.join(root, BUNDLE_DIR)))]
+        upload_files(server.server_address, root, archives)
+        bundled = time.time() - started
+    finally:
+        server.shutdown()
+        server.server_close()
+        shutil.rmtree(root)
+
+    return {'unbundled_files_per_sec': n_files / unbundled,
+            'bundled_files_per_sec': n_files / bundled,
+            'archives': len(archives),
+            'bundle_secs': bundle_secs}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark uploading small files with bundling')
+    parser.add_argument('--files', type=int, default=200, help='The number of files to upload')
+    parser.add_argument('--size', type=int, default=20000, help='The size of each file in bytes')
+    parser.add_argument('--latency', type=float, default=0.3,
+                        help='The delay in seconds added to every server reply')
+    parser.add_argument('--max-bytes', type=int, default=10 * 1024 * 1024,
+                        help='The size at which a bundle is sealed')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+
+    result = benchmark(args.files, args.size, args.latency, args.max_bytes)
+    print('Unbundled: {:.2f} files per second'.format(result['unbundled_files_per_sec']))
+    print('Bundled: {:.2f} files per second in {} archives, {:.2f} secs bundling'.format(
+        result['bundled_files_per_sec'], result['archives'], result['bundle_secs']))
@@ -0,0 +1,221 @@
+import os
+import io
+import json
+import time
+import tarfile
+import logging
+import threading
+from supervisor import heartbeat
+from integrity import MANIFEST_DIR, PRIORITY_DIR, hash_file, record_bundled, record_staged
+from health import HEALTH_DIR
+
+
+"""
+Bundling of small staged files into tar archives, to amortise the per-file
+overhead of FTP transfers on high latency links. Files in the device upload
+directory below a size threshold are appended to an open archive, which is
+sealed for upload once it reaches a size or age limit. The open archive has a
+.part suffix, which is excluded from the FTP mirror. Sealed archives embed a
+JSON index and can be restored to the original layout with unbundle.py.
+"""
+
+BUNDLE_DIR = 'bundles'
+INDEX_NAME = 'bundle_index.json'
+PART_SUFFIX = '.part'
+
+# Defaults for the optional bundle section of the config
+BUNDLE_DEFAULTS = {'enabled': 0,
+                   'small_file_size': 1024 * 1024,
+                   'max_bytes': 10 * 1024 * 1024,
+                   'max_age': 3600,
+                   'settle_time': 60,
+                   'interval': 60}
+
+
+def bundle_options(config):
+    """
+    Get bundle settings from the optional bundle section of a config,
+    filling in defaults.
+
+    Args:
+        config: The full config dictionary
+    Returns:
+        A dictionary of bundle settings.
+    """
+
+    opts = dict(BUNDLE_DEFAULTS)
+    opts.update(config.get('bundle', {}))
+    return opts
+
+
+class Bundler(object):
+
+    def __init__(self, upload_dir, small_file_size=BUNDLE_DEFAULTS['small_file_size'],
+                 max_bytes=BUNDLE_DEFAULTS['max_bytes'], max_age=BUNDLE_DEFAULTS['max_age'],
+                 settle_time=BUNDLE_DEFAULTS['settle_time']):
+        """
+        A class to bundle small staged files into archives.
+
+        Args:
+            upload_dir: The device specific upload directory holding staged files
+            small_file_size: Files below this size in bytes are bundled
+            max_bytes: An open archive is sealed when it reaches this size
+            max_age: An open archive is sealed when it is this many seconds old
+            settle_time: Files modified in the last settle_time seconds are
+                assumed to still be being written and are skipped
+        """
+
+        self.upload_dir = upload_dir
+        self.bundle_dir = os.path.join(upload_dir, BUNDLE_DIR)
+        self.small_file_size = small_file_size
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.settle_time = settle_time
+        self.open_bundle = None
+        self.opened_at = None
+
+        if not os.path.exists(self.bundle_dir):
+            os.makedirs(self.bundle_dir)
+
+        # Seal any archive left open by a previous run
+        for fname in os.listdir(self.bundle_dir):
+            if fname.endswith(PART_SUFFIX):
+                self.open_bundle = os.path.join(self.bundle_dir, fname)
+                self.seal()
+
+    def candidates(self):
+        """
+        Find staged files that should be added to a bundle.
+
+        Returns:
+            A sorted list of paths relative to the upload directory.
+        """
+
+        now = time.time()
+        found = []
+        for subdir, dirs, files in os.walk(self.upload_dir):
+            if subdir == self.upload_dir and BUNDLE_DIR in dirs:
+                dirs.remove(BUNDLE_DIR)
+            if subdir == self.upload_dir and MANIFEST_DIR in dirs:
+                dirs.remove(MANIFEST_DIR)
+            # health records and priority queues are sent ahead of the data
+            if subdir == self.upload_dir and HEALTH_DIR in dirs:
+                dirs.remove(HEALTH_DIR)
+            if subdir == self.upload_dir and PRIORITY_DIR in dirs:
+                dirs.remove(PRIORITY_DIR)
+            for fname in files:
+                if fname.endswith(PART_SUFFIX):
+                    continue
+                path = os.path.join(subdir, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if stat.st_size < self.small_file_size and now - stat.st_mtime > self.settle_time:
+                    found.append(os.path.relpath(path, self.upload_dir))
+
+        return sorted(found)
+
+    def bundle(self):
+        """
+        Append all candidate files to the open archive, removing the originals,
+        and seal the archive if it has reached its size or age limit.
+
+        Returns:
+            The number of files bundled.
+        """
+
+        files = self.candidates()
+        if files:
+            if self.open_bundle is None:
+                name = 'bundle_{}.tar'.format(time.strftime('%Y%m%d_%H%M%S')) + PART_SUFFIX
+                self.open_bundle = os.path.join(self.bundle_dir, name)
+                self.opened_at = time.time()
+
+            archive = tarfile.open(self.open_bundle, 'a')
+            try:
+                for relpath in files:
+                    archive.add(os.path.join(self.upload_dir, relpath), arcname=relpath)
+            finally:
+                archive.close()
+
+            # Only remove the originals once the archive is safely closed, and
+            # after the catalog knows where they went, so that a reconcile in
+            # between does not mark them as uploaded
+            record_bundled([os.path.join(self.upload_dir, relpath) for relpath in files],
+                           self.open_bundle[:-len(PART_SUFFIX)])
+            for relpath in files:
+                os.remove(os.path.join(self.upload_dir, relpath))
+
+            logging.info('Bundled {} files into {}'.format(len(files), self.open_bundle))
+
+        if self.open_bundle is not None:
+            if self.opened_at is None:
+                self.opened_at = os.stat(self.open_bundle).st_mtime
+            if (os.path.getsize(self.open_bundle) >= self.max_bytes or
+                    time.time() - self.opened_at >= self.max_age):
+                self.seal()
+
+        return len(files)
+
+    def seal(self):
+        """
+        Append the index to the open archive and rename it so that it is
+        picked up by the FTP sync.
+        """
+
+        if self.open_bundle is None:
+            return
+
+        archive = tarfile.open(self.open_bundle, 'a')
+        try:
+            index = [{'name': m.name, 'size': m.size, 'mtime': m.mtime}
+                     for m in archive.getmembers() if m.name != INDEX_NAME]
+            data = json.dumps({'files': index}, indent=1).encode('utf-8')
+            info = tarfile.TarInfo(INDEX_NAME)
+            info.size = len(data)
+            info.mtime = time.time()
+            archive.addfile(info, io.BytesIO(data))
+        finally:
+            archive.close()
+
+        sealed = self.open_bundle[:-len(PART_SUFFIX)]
+        os.rename(self.open_bundle, sealed)
+        record_staged(sealed, os.path.getsize(sealed), hash_file(sealed))
+        logging.info('Sealed bundle {} with {} files'.format(sealed, len(index)))
+
+        self.open_bundle = None
+        self.opened_at = None
+
+
+def bundle_staged_files(bundler, interval, die, upload_lock=None):
+    """
+    Function to regularly bundle staged files, intended to run in a thread.
+    Any open archive is sealed on shutdown.
+
+    Args:
+        bundler: A Bundler instance
+        interval: The time in seconds between bundling passes
+        die: A threading event to terminate the bundling
+        upload_lock: An optional lock held by the sync while it uploads. Passes
+            are skipped while it is held, so that files are not bundled and
+            removed while they are being transferred.
+    """
+
+    if upload_lock is None:
+        upload_lock = threading.Lock()
+
+    while not die.is_set():
+        heartbeat()
+        if upload_lock.acquire(False):
+            try:
+                bundler.bundle()
+            except (IOError, OSError, tarfile.TarError) as e:
+                logging.error('Bundling failed: {}'.format(e))
+            finally:
+                upload_lock.release()
+        else:
+            logging.info('Sync in progress, skipping bundling pass')
+        die.wait(interval)
+
+    bundler.seal()
@@ -0,0 +1,606 @@
+import os
+import re
+import sys
+import json
+import math
+import time
+import calendar
+import sqlite3
+import argparse
+import threading
+import logging
+import clock
+from integrity import MANIFEST_DIR, PART_SUFFIX, hash_file
+
+
+"""
+A local SQLite catalog of all data recorded by the device. Every staged file is
+added by record_staged() in integrity.py, with the sensor, start and end time,
+size, codec, encoder quality and checksum, and its upload state is updated after each sync. The
+catalog is indexed by time, so that queries for the files, gaps and coverage in
+a time range only visit the rows in that range.
+
+Run as a script, it provides a command line interface to the catalog:
+
+    python catalog.py catalog.sqlite files --start 2020-05-01 --end 2020-05-02
+    python catalog.py catalog.sqlite gaps --start 2020-05-01 --sensor USBSoundcardMic
+    python catalog.py catalog.sqlite coverage --day 2020-05-01 --output report.json
+    python catalog.py catalog.sqlite status
+    python catalog.py catalog.sqlite latency --start 2020-05-01
+    python catalog.py catalog.sqlite scan /home/pi/continuous_monitoring_data/live_data/<PI_ID>
+
+Times are given and shown in the local time of the device.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    sensor TEXT,
+    start REAL,
+    end REAL,
+    duration REAL,
+    size INTEGER,
+    codec TEXT,
+    checksum TEXT,
+    state TEXT,
+    bundle TEXT,
+    staged_at REAL,
+    uploaded_at REAL,
+    quality INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_start ON files (start);
+CREATE INDEX IF NOT EXISTS files_sensor_start ON files (sensor, start);
+CREATE INDEX IF NOT EXISTS files_duration ON files (duration);
+CREATE INDEX IF NOT EXISTS files_state ON files (state);
+CREATE INDEX IF NOT EXISTS files_bundle ON files (bundle);
+"""
+
+COLUMNS = ['path', 'sensor', 'start', 'end', 'duration', 'size', 'codec', 'checksum',
+           'state', 'bundle', 'staged_at', 'uploaded_at', 'quality']
+
+# Columns added since the first version of the schema, added to older catalogs
+ADDED_COLUMNS = [('quality', 'INTEGER')]
+
+CODECS = {'.mp3': 'mp3', '.wav': 'wav', '.jpg': 'jpeg', '.zip': 'zip', '.tar': 'tar',
+          '.log': 'text', '.jsonl': 'json', '.json': 'json'}
+
+# Filename conventions of the sensors, used to catalog files that were staged
+# before the catalog existed
+DATE_DIR = re.compile(r'^(\d{4}-\d{2}-\d{2})$')
+AUDIO_NAME = re.compile(r'^(\d{2}-\d{2}-\d{2})_dur=(\d+)secs')
+IMAGE_NAME = re.compile(r'^(\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2})')
+UNIX_NAME = re.compile(r'^final_(\d{8}_\d{6})')
+HEALTH_NAME = re.compile(r'^\w+_(\d{8}_\d{6})\.json$')
+
+
+def parse_name(relpath):
+    """
+    Get the sensor and capture times of a staged file from its name.
+
+    Args:
+        relpath: The path of the file relative to the device upload directory
+    Returns:
+        A dictionary of the sensor, start, end and codec, with None for any not known.
+    """
+
+    parts = relpath.split(os.sep)
+    fname = parts[-1]
+    info = {'sensor': None, 'start': None, 'end': None,
+            'codec': CODECS.get(os.path.splitext(fname)[1].lower())}
+
+    day = parts[0] if len(parts) > 1 and DATE_DIR.match(parts[0]) else None
+
+    match = AUDIO_NAME.match(fname)
+    if match and day is not None:
+        info['sensor'] = 'USBSoundcardMic'
+        info['start'] = time.mktime(time.strptime(day + ' ' + match.group(1), '%Y-%m-%d %H-%M-%S'))
+        info['end'] = info['start'] + int(match.group(2))
+        return info
+
+    match = IMAGE_NAME.match(fname)
+    if match:
+        info['sensor'] = 'TimelapseCamera'
+        info['start'] = time.mktime(time.strptime(match.group(1), '%Y-%m-%dT%H:%M:%S'))
+        info['end'] = info['start']
+        return info
+
+    match = UNIX_NAME.match(fname)
+    if match:
+        # UnixDevice names files in UTC
+        info['sensor'] = 'UnixDevice'
+        info['start'] = calendar.timegm(time.strptime(match.group(1), '%d%m%Y_%H%M%S'))
+        info['end'] = info['start']
+        return info
+
+    match = HEALTH_NAME.match(fname)
+    if match and parts[0] == 'health':
+        info['sensor'] = 'health'
+        info['start'] = time.mktime(time.strptime(match.group(1), '%Y%m%d_%H%M%S'))
+        info['end'] = info['start']
+        return info
+
+    if parts[0] in ['logs', 'bundles']:
+        info['sensor'] = parts[0][:-1]
+
+    return info
+
+
+class Catalog(object):
+
+    def __init__(self, db_file, upload_dir=None):
+        """
+        A class to hold the catalog of staged files for a device. The connection
+        is shared between the recorder threads under a lock.
+
+        Args:
+            db_file: The path of the SQLite database, created if needed
+            upload_dir: The device specific upload directory. Files are cataloged
+                by their path relative to this directory.
+        """
+
+        self.db_file = db_file
+        self.upload_dir = upload_dir
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_file, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+
+        with self.lock:
+            try:
+                # Let the command line interface read while the recorder writes
+                self.conn.execute('PRAGMA journal_mode=WAL')
+            except sqlite3.Error:
+                pass
+            self.conn.executescript(SCHEMA)
+            existing = set(row[1] for row in self.conn.execute('PRAGMA table_info(files)'))
+            for name, col_type in ADDED_COLUMNS:
+                if name not in existing:
+                    self.conn.execute('ALTER TABLE files ADD COLUMN {} {}'.format(name, col_type))
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def relpath(self, path):
+        if self.upload_dir is None:
+            return path
+        return os.path.relpath(path, self.upload_dir)
+
+    def add(self, path, size, digest, info=None):
+        """
+        Add a staged file to the catalog, replacing any existing entry. Details not
+        given in info are taken from the file name where possible. Errors are
+        logged rather than raised, so that the catalog can not stop staging.
+
+        Args:
+            path: The path of the staged file
+            size: The size of the file in bytes
+            digest: The hex digest of the file contents
+            info: An optional dictionary of the sensor, start and end times in
+                seconds since the epoch, the codec and the encoder quality level
+        """
+
+        relpath = self.relpath(path)
+        entry = parse_name(relpath)
+        entry.update(dict((k, v) for k, v in (info or {}).items() if v is not None))
+        if entry['start'] is not None and entry['end'] is None:
+            entry['end'] = entry['start']
+        duration = None
+        if entry['start'] is not None:
+            duration = entry['end'] - entry['start']
+
+        try:
+            with self.lock:
+                self.conn.execute('INSERT OR REPLACE INTO files (path, sensor, start, end, duration, '
+                                  'size, codec, checksum, state, staged_at, quality) '
+                                  'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                  (relpath, entry['sensor'], entry['start'], entry['end'],
+                                   duration, size, entry['codec'], digest, 'staged', clock.time(),
+                                   entry.get('quality')))
+                self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error('Could not add {} to catalog: {}'.format(relpath, e))
+
+    def mark_bundled(self, paths, bundle):
+        """
+        Record that staged files have been moved into a bundle archive.
+
+        Args:
+            paths: The paths of the bundled files
+            bundle: The path of the sealed bundle archive
+        """
+
+        bundle = self.relpath(bundle)
+        try:
+            with self.lock:
+                self.conn.executemany('UPDATE files SET state = ?, bundle = ? WHERE path = ?',
+                                      [('bundled', bundle, self.relpath(p)) for p in paths])
+                self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error('Could not mark bundled files in catalog: {}'.format(e))
+
+    def mark_replaced(self, paths):
+        """
+        Record that staged files have been replaced on the device, for example
+        WAV files compressed by transcode.py, so they will not be uploaded.
+
+        Args:
+            paths: The paths of the replaced files
+        """
+
+        try:
+            with self.lock:
+                self.conn.executemany('UPDATE files SET state = ? WHERE path = ?',
+                                      [('replaced', self.relpath(p)) for p in paths])
+                self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error('Could not mark replaced files in catalog: {}'.format(e))
+
+    def mark_uploaded(self, paths):
+        """
+        Mark the staged files a transport reports as sent as uploaded, along with
+        the contents of uploaded bundles.
+
+        Args:
+            paths: The paths of the files sent and removed by a sync
+        Returns:
+            A tuple of the number of files marked as uploaded and their size in
+            bytes. Bundled files are counted in the size of their bundle.
+        """
+
+        now = clock.time()
+        relpaths = [self.relpath(p) for p in paths]
+        try:
+            with self.lock:
+                sent = []
+                for relpath in relpaths:
+                    row = self.conn.execute('SELECT size FROM files WHERE path = ? AND state = ?',
+                                            (relpath, 'staged')).fetchone()
+                    if row is not None:
+                        sent.append((relpath, row['size'] or 0))
+                self.conn.executemany('UPDATE files SET state = ?, uploaded_at = ? WHERE path = ?',
+                                      [('uploaded', now, p) for p, _ in sent])
+                self.conn.executemany('UPDATE files SET state = ?, uploaded_at = ? '
+                                      'WHERE bundle = ? AND state = ?',
+                                      [('uploaded', now, p, 'bundled') for p, _ in sent])
+                self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error('Could not update catalog upload state: {}'.format(e))
+            return 0, 0
+
+        if sent:
+            logging.info('Catalog: {} files uploaded'.format(len(sent)))
+
+        return len(sent), sum(size for _, size in sent)
+
+    def reconcile(self):
+        """
+        Mark staged files that have gone from the upload directory without a
+        transport reporting them as sent as missing, for example files removed
+        by hand. Only the files waiting for upload are checked.
+
+        Returns:
+            The number of files marked as missing.
+        """
+
+        if self.upload_dir is None:
+            return 0
+
+        try:
+            with self.lock:
+                rows = self.conn.execute('SELECT path FROM files WHERE state = ?',
+                                         ('staged',)).fetchall()
+                gone = [row['path'] for row in rows
+                        if not os.path.exists(os.path.join(self.upload_dir, row['path']))]
+                self.conn.executemany('UPDATE files SET state = ? WHERE path = ?',
+                                      [('missing', p) for p in gone])
+                self.conn.commit()
+        except sqlite3.Error as e:
+            logging.error('Could not update catalog upload state: {}'.format(e))
+            return 0
+
+        if gone:
+            logging.warning('Catalog: {} files removed without being uploaded'.format(len(gone)))
+
+        return len(gone)
+
+    def backlog(self):
+        """
+        Returns:
+            A tuple of the number of files and bytes staged and waiting for upload.
+            Files moved into a bundle are counted once the bundle is sealed.
+        """
+
+        with self.lock:
+            row = self.conn.execute('SELECT COUNT(*), SUM(size) FROM files WHERE state = ?',
+                                    ('staged',)).fetchone()
+
+        return row[0], row[1] or 0
+
+    def scan(self):
+        """
+        Add files in the upload directory that are missing from the catalog,
+        taking their details from the file names.
+
+        Returns:
+            The number of files added.
+        """
+
+        with self.lock:
+            known = set(row[0] for row in self.conn.execute('SELECT path FROM files'))
+
+        n_added = 0
+        for subdir, dirs, files in os.walk(self.upload_dir):
+            if subdir == self.upload_dir and MANIFEST_DIR in dirs:
+                dirs.remove(MANIFEST_DIR)
+            for fname in files:
+                path = os.path.join(subdir, fname)
+                if fname.endswith(PART_SUFFIX) or self.relpath(path) in known:
+                    continue
+                self.add(path, os.path.getsize(path), hash_file(path))
+                n_added += 1
+
+        return n_added
+
+    def files(self, start, end, sensor=None):
+        """
+        Find the files with data overlapping a time range.
+
+        Args:
+            start: The start of the range in seconds since the epoch
+            end: The end of the range in seconds since the epoch
+            sensor: An optional sensor name to restrict the search to
+        Returns:
+            A list of dictionaries of file details, ordered by start time.
+        """
+
+        with self.lock:
+            # The longest file bounds how far before the range an overlapping file
+            # can start, so the start index limits the rows visited
+            longest = self.conn.execute('SELECT MAX(duration) FROM files').fetchone()[0] or 0
+            query = 'SELECT * FROM files WHERE start >= ? AND start < ? AND end >= ?'
+            args = [start - longest, end, start]
+            if sensor is not None:
+                query += ' AND sensor = ?'
+                args.append(sensor)
+            rows = self.conn.execute(query + ' ORDER BY start', args).fetchall()
+
+        return [dict(zip(COLUMNS, [row[c] for c in COLUMNS])) for row in rows]
+
+    def gaps(self, start, end, sensor=None, min_gap=60):
+        """
+        Find the periods in a time range not covered by any file.
+
+        Args:
+            start: The start of the range in seconds since the epoch
+            end: The end of the range in seconds since the epoch
+            sensor: An optional sensor name to restrict the search to
+            min_gap: Uncovered periods of up to this many seconds, such as the
+                pause between captures, are not counted as gaps
+        Returns:
+            A tuple of the list of (start, end) gaps and the number of seconds covered.
+        """
+
+        gaps = []
+        covered = 0.0
+        reached = start
+        for entry in self.files(start, end, sensor):
+            file_start = max(entry['start'], start)
+            file_end = min(entry['end'], end)
+            if file_start - reached > min_gap:
+                gaps.append((reached, file_start))
+            if file_end > reached:
+                covered += file_end - max(file_start, reached)
+                reached = file_end
+            elif file_start > reached:
+                reached = file_start
+        if end - reached > min_gap:
+            gaps.append((reached, end))
+
+        return gaps, covered
+
+    def status(self):
+        """
+        Returns:
+            A dictionary of the number of files and bytes in each upload state.
+        """
+
+        with self.lock:
+            rows = self.conn.execute('SELECT state, COUNT(*), SUM(size) FROM files '
+                                     'GROUP BY state').fetchall()
+
+        return dict((row[0], {'files': row[1], 'bytes': row[2] or 0}) for row in rows)
+
+    def upload_latency(self, start, end, sensor=None):
+        """
+        Find the capture to upload latency of the uploaded files with data
+        starting in a time range, from the end of the data to the sync that
+        sent the file.
+
+        Args:
+            start, end: The time range in seconds since the epoch
+            sensor: An optional sensor name to select
+        Returns:
+            A dictionary of the number of files and the 50th, 90th and 99th
+            percentile and maximum latencies in seconds.
+        """
+
+        query = ('SELECT uploaded_at - end FROM files WHERE start >= ? AND start < ? '
+                 'AND uploaded_at IS NOT NULL AND end IS NOT NULL')
+        params = [start, end]
+        if sensor is not None:
+            query += ' AND sensor = ?'
+            params.append(sensor)
+        with self.lock:
+            values = sorted(row[0] for row in self.conn.execute(query, params))
+
+        return {'files': len(values),
+                'p50': percentile(values, 0.5),
+                'p90': percentile(values, 0.9),
+                'p99': percentile(values, 0.99),
+                'max': values[-1] if values else None}
+
+    def coverage_report(self, day, min_gap=60):
+        """
+        Build a coverage report for a day, with the hourly coverage, gaps, file
+        counts and upload states of each sensor.
+
+        Args:
+            day: The day as a YYYY-MM-DD string, in local time
+            min_gap: The longest uncovered period in seconds not counted as a gap
+        Returns:
+            A dictionary holding the report.
+        """
+
+        day_start = time.mktime(time.strptime(day, '%Y-%m-%d'))
+        day_end = time.mktime(time.strptime(day, '%Y-%m-%d')[:3] + (23, 59, 59, 0, 0, -1)) + 1
+        report = {'day': day, 'min_gap': min_gap, 'sensors': {}}
+
+        sensors = set(entry['sensor'] for entry in self.files(day_start, day_end))
+        for sensor in sorted(s for s in sensors if s is not None):
+            files = self.files(day_start, day_end, sensor)
+            gaps, covered = self.gaps(day_start, day_end, sensor, min_gap)
+            hourly = []
+            hour_start = day_start
+            while hour_start < day_end:
+                hour_end = min(hour_start + 3600, day_end)
+                _, hour_covered = self.gaps(hour_start, hour_end, sensor, min_gap)
+                hourly.append(round(hour_covered / (hour_end - hour_start), 4))
+                hour_start = hour_end
+            states = {}
+            for entry in files:
+                states[entry['state']] = states.get(entry['state'], 0) + 1
+            report['sensors'][sensor] = {'files': len(files),
+                                         'bytes': sum(entry['size'] or 0 for entry in files),
+                                         'covered_secs': covered,
+                                         'coverage': round(covered / (day_end - day_start), 4),
+                                         'hourly_coverage': hourly,
+                                         'gaps': [[format_time(a), format_time(b)] for a, b in gaps],
+                                         'states': states}
+
+        return report
+
+
+def parse_time(value):
+    """
+    Parse a local date or date and time given on the command line.
+
+    Args:
+        value: A string in YYYY-MM-DD or YYYY-MM-DDTHH:MM:SS format
+    Returns:
+        The time in seconds since the epoch.
+    """
+
+    for fmt in ['%Y-%m-%dT%H:%M:%S', '%Y-%m-%d %H:%M:%S', '%Y-%m-%d']:
+        try:
+            return time.mktime(time.strptime(value, fmt))
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('Could not parse time {}'.format(value))
+
+
+def percentile(values, fraction):
+    """
+    Find a percentile of a list of values by the nearest rank method.
+
+    Args:
+        values: A sorted list of values
+        fraction: The percentile as a fraction from 0 to 1
+    Returns:
+        The value at the percentile, or None if there are no values.
+    """
+
+    if not values:
+        return None
+    rank = max(int(math.ceil(fraction * len(values))), 1)
+    return values[rank - 1]
+
+
+def format_time(value):
+    return time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(value))
+
+
+def main(args=None):
+
+    parser = argparse.ArgumentParser(description='Query the catalog of recorded data.')
+    parser.add_argument('db_file', help='The catalog database file')
+    commands = parser.add_subparsers(dest='command')
+
+    files_cmd = commands.add_parser('files', help='List the files in a time range')
+    gaps_cmd = commands.add_parser('gaps', help='List the gaps in a time range')
+    latency_cmd = commands.add_parser('latency', help='Report the upload latency of files in a time range')
+    for cmd in [files_cmd, gaps_cmd, latency_cmd]:
+        cmd.add_argument('--start', type=parse_time, required=True,
+                         help='The start of the range, YYYY-MM-DD[THH:MM:SS]')
+        cmd.add_argument('--end', type=parse_time,
+                         help='The end of the range, defaulting to a day after the start')
+        cmd.add_argument('--sensor', help='Only include files from this sensor')
+    gaps_cmd.add_argument('--min-gap', type=float, default=60,
+                          help='The longest uncovered period in seconds not counted as a gap')
+
+    coverage_cmd = commands.add_parser('coverage', help='Report the coverage of a day')
+    coverage_cmd.add_argument('--day', required=True, help='The day to report, YYYY-MM-DD')
+    coverage_cmd.add_argument('--min-gap', type=float, default=60,
+                              help='The longest uncovered period in seconds not counted as a gap')
+    coverage_cmd.add_argument('--output', help='Write the report as JSON to this file')
+
+    commands.add_parser('status', help='Count the files in each upload state')
+
+    scan_cmd = commands.add_parser('scan', help='Add existing files in an upload directory')
+    scan_cmd.add_argument('upload_dir', help='The device specific upload directory')
+
+    args = parser.parse_args(args)
+
+    if args.command != 'scan' and not os.path.exists(args.db_file):
+        parser.error('Catalog {} not found'.format(args.db_file))
+
+    catalog = Catalog(args.db_file, getattr(args, 'upload_dir', None))
+    try:
+        if args.command in ['files', 'gaps', 'latency']:
+            end = args.end if args.end is not None else args.start + 86400
+            if args.command == 'files':
+                for entry in catalog.files(args.start, end, args.sensor):
+                    codec = '{}'.format(entry['codec'])
+                    if entry['quality'] is not None:
+                        # LAME VBR level for mp3, JPEG quality for image tiers
+                        prefix = 'Q' if entry['codec'] == 'jpeg' else 'V'
+                        codec += ' {}{}'.format(prefix, entry['quality'])
+                    print('{}  {:<16} {:>7.0f}s {:>11} {:<7} {:<8} {}'.format(
+                        format_time(entry['start']), entry['sensor'], entry['duration'],
+                        entry['size'], codec, entry['state'], entry['path']))
+            elif args.command == 'latency':
+                latency = catalog.upload_latency(args.start, end, args.sensor)
+                if latency['files']:
+                    print('{files} files uploaded, latency p50 {p50:.0f} secs, p90 {p90:.0f} secs, '
+                          'p99 {p99:.0f} secs, max {max:.0f} secs'.format(**latency))
+                else:
+                    print('No uploaded files')
+            else:
+                gaps, covered = catalog.gaps(args.start, end, args.sensor, args.min_gap)
+                for gap_start, gap_end in gaps:
+                    print('{} - {}  {:.0f}s'.format(format_time(gap_start), format_time(gap_end),
+                                                   gap_end - gap_start))
+                print('Covered {:.0f} of {:.0f} secs ({:.1%})'.format(
+                    covered, end - args.start, covered / (end - args.start)))
+        elif args.command == 'coverage':
+            report = catalog.coverage_report(args.day, args.min_gap)
+            if args.output:
+                with open(args.output, 'w') as outfile:
+                    json.dump(report, outfile, indent=1)
+            for sensor, summary in sorted(report['sensors'].items()):
+                print('{}: {} files, {} bytes, {:.1%} coverage, {} gaps'.format(
+                    sensor, summary['files'], summary['bytes'], summary['coverage'],
+                    len(summary['gaps'])))
+                print('  hourly: ' + ' '.join('{:3.0f}'.format(100 * c)
+                                              for c in summary['hourly_coverage']))
+        elif args.command == 'status':
+            for state, counts in sorted(catalog.status().items()):
+                print('{}: {} files, {} bytes'.format(state, counts['files'], counts['bytes']))
+        elif args.command == 'scan':
+            print('Added {} files'.format(catalog.scan()))
+    finally:
+        catalog.close()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
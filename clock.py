@@ -0,0 +1,59 @@
+import time as _time
+import datetime as _datetime
+
+
+"""
+The source of time for the recording and sync loops. By default this is the
+system clock, but it can be replaced with set_clock(), which is used by the
+simulation mode (simulation.py) to run the recorder against a virtual clock:
+
+* clock.time() # seconds since the epoch, as time.time()
+* clock.sleep(secs) # as time.sleep()
+* clock.strftime(fmt) # the current local time formatted, as time.strftime()
+* clock.now() # the current local time as a datetime, as datetime.now()
+
+Waits that should end on shutdown use the die event, which the simulation
+also replaces.
+"""
+
+
+class SystemClock(object):
+
+    def time(self):
+        return _time.time()
+
+    def sleep(self, secs):
+        _time.sleep(secs)
+
+
+# The clock in use, replaced with set_clock()
+_clock = SystemClock()
+
+
+def set_clock(clock):
+    """
+    Set the clock used by the recorder.
+
+    Args:
+        clock: An object with time() and sleep() methods, or None to use the
+            system clock
+    """
+
+    global _clock
+    _clock = clock if clock is not None else SystemClock()
+
+
+def time():
+    return _clock.time()
+
+
+def sleep(secs):
+    _clock.sleep(secs)
+
+
+def strftime(fmt):
+    return _time.strftime(fmt, _time.localtime(_clock.time()))
+
+
+def now():
+    return _datetime.datetime.fromtimestamp(_clock.time())
@@ -0,0 +1,189 @@
+import os
+import json
+import time
+import threading
+import logging
+import sensors
+from transports import configure_transport
+
+
+"""
+Hot reloading of the recorder config file. The ConfigWatcher is polled from the
+main loop of record() and can also be prompted by SIGHUP. A new config is only
+accepted if it validates, and the recording and sync threads pick it up at their
+next safe boundary: between captures and between transfers respectively.
+"""
+
+# Config sections that are only read at startup - changes need a restart
+RESTART_KEYS = [('offline_mode',), ('sys', 'working_dir'), ('sys', 'upload_dir'),
+                ('sys', 'reboot_time')]
+
+
+def load_config(config_file):
+    """
+    Load and validate a config file.
+
+    Args:
+        config_file: Path to the JSON config file
+    Returns:
+        A tuple of the config dictionary and an unconfigured sensor instance
+        built from it.
+    Raises:
+        IOError if the file cannot be read, ValueError if the config is invalid.
+    """
+
+    with open(config_file) as cf:
+        config = json.load(cf)
+
+    sensor = validate_config(config)
+
+    return config, sensor
+
+
+def validate_config(config):
+    """
+    Check that a config dictionary has the required sections and that the
+    sensor section builds a sensor instance. The sensor setup() method is
+    not run, as that may need hardware currently in use by the recorder.
+
+    Args:
+        config: A config dictionary as loaded from config.json
+    Returns:
+        An instance of the configured sensor class.
+    Raises:
+        ValueError if the config is not valid.
+    """
+
+    try:
+        sensor_config = config['sensor']
+        sensor_type = sensor_config['sensor_type']
+        config['offline_mode']
+        for key in ['working_dir', 'upload_dir', 'reboot_time']:
+            config['sys'][key]
+    except (KeyError, TypeError) as e:
+        raise ValueError('Missing config value: {}'.format(e))
+
+    if not config['offline_mode']:
+        configure_transport(config)
+
+    try:
+        sensor_class = getattr(sensors, sensor_type)
+    except AttributeError:
+        raise ValueError('Sensor type {} not found.'.format(sensor_type))
+
+    return sensor_class(sensor_config)
+
+
+def _get_key(config, keys):
+    for key in keys:
+        config = config.get(key) if isinstance(config, dict) else None
+    return config
+
+
+class ConfigWatcher(object):
+
+    def __init__(self, config_file, config):
+        """
+        A class to watch the config file for changes and hold the currently
+        accepted config. Consumers keep track of the version they last applied
+        and call changed() to see if there is a newer config to apply.
+
+        Args:
+            config_file: Path to the JSON config file being watched
+            config: The config dictionary the recorder was started with
+        """
+
+        self.config_file = config_file
+        self.config = config
+        self.version = 0
+        self.changed_at = None
+        self.sync_interval = None
+        self.lock = threading.Lock()
+        self.reload_requested = threading.Event()
+        self.mtime = self._mtime()
+
+    def _mtime(self):
+        try:
+            return os.stat(self.config_file).st_mtime
+        except OSError:
+            return None
+
+    def request_reload(self, signum=None, frame=None):
+        """
+        Flag that the config should be reloaded on the next check, regardless
+        of the file modification time. Can be used directly as a SIGHUP handler.
+        """
+
+        logging.info('Config reload requested')
+        self.reload_requested.set()
+
+    def check(self):
+        """
+        Reload the config if the file has changed or a reload was requested.
+        An invalid config is logged and ignored, leaving the running config
+        untouched.
+
+        Returns:
+            A boolean showing if a new config was accepted.
+        """
+
+        mtime = self._mtime()
+        if mtime == self.mtime and not self.reload_requested.is_set():
+            return False
+
+        self.reload_requested.clear()
+        self.mtime = mtime
+
+        try:
+            config, sensor = load_config(self.config_file)
+        except (IOError, ValueError) as e:
+            logging.error('Config reload failed, keeping running config: {}'.format(e))
+            return False
+
+        if config == self.config:
+            logging.info('Config file unchanged')
+            return False
+
+        for keys in RESTART_KEYS:
+            if _get_key(config, keys) != _get_key(self.config, keys):
+                logging.warning('Config change to {} needs a restart to take '
+                                'effect'.format('/'.join(keys)))
+
+        with self.lock:
+            self.config = config
+            self.sync_interval = sensor.server_sync_interval
+            self.version += 1
+            self.changed_at = time.time()
+
+        logging.info('Config version {} accepted'.format(self.version))
+        return True
+
+    def changed(self, seen_version):
+        """
+        Check for a config newer than the version a consumer last applied.
+
+        Args:
+            seen_version: The config version last applied by the consumer
+        Returns:
+            A tuple of the current version and config if it is newer than
+            seen_version, otherwise None.
+        """
+
+        with self.lock:
+            if self.version == seen_version:
+                return None
+            return self.version, self.config
+
+    def report_applied(self, version, what):
+        """
+        Log the latency between a config change being accepted and a
+        consumer applying it.
+
+        Args:
+            version: The config version that was applied
+            what: A description of what was reconfigured
+        """
+
+        if self.changed_at is not None:
+            logging.info('Applied config version {} to {} after {:.1f} secs'.format(
+                version, what, time.time() - self.changed_at))
@@ -0,0 +1,184 @@
+import random
+import logging
+import collections
+import clock
+
+
+"""
+A link state monitor for the upload sync, acting as a circuit breaker. Before
+each sync the upload server is probed cheaply (transport.probe(), a TCP connect)
+so that the time update and upload are only run when the link is up. After
+failure_threshold failed probes the link is marked offline and syncs are
+skipped. Probes then continue with an exponential backoff from backoff_base up
+to backoff_max seconds, with jitter so that units sharing a mast do not probe
+in step, and the sync runs as soon as a probe succeeds.
+
+The monitor keeps the time spent online and offline and a history of link
+state changes, reported by metrics().
+"""
+
+ONLINE = 'online'
+OFFLINE = 'offline'
+
+# Defaults for the optional link section of the config
+LINK_DEFAULTS = {'enabled': 0,
+                 'probe_timeout': 5,
+                 'failure_threshold': 2,
+                 'backoff_base': 15,
+                 'backoff_max': 600,
+                 'jitter': 0.5,
+                 'history': 50}
+
+
+def link_options(config):
+    """
+    Get link monitor settings from the optional link section of a config,
+    filling in defaults.
+
+    Args:
+        config: The full config dictionary
+    Returns:
+        A dictionary of link monitor settings.
+    """
+
+    opts = dict(LINK_DEFAULTS)
+    opts.update(config.get('link', {}))
+    return opts
+
+
+class LinkMonitor(object):
+
+    def __init__(self, probe_timeout=5, failure_threshold=2, backoff_base=15, backoff_max=600,
+                 jitter=0.5, history=50, seed=None):
+        """
+        A class to track the state of the upload link from cheap probes, and to
+        hold syncs back while it is down.
+
+        Args:
+            probe_timeout: The time in seconds allowed for each probe
+            failure_threshold: The number of failed probes in a row before the
+                link is marked offline
+            backoff_base: The delay in seconds after the first failed probe,
+                doubled after each further failure
+            backoff_max: The longest delay in seconds between probes
+            jitter: The fraction of each delay that is randomised
+            history: The number of link state changes to keep
+            seed: An optional random seed for the jitter
+        """
+
+        self.probe_timeout = probe_timeout
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.jitter = jitter
+        self.random = random.Random(seed)
+
+        self.state = ONLINE
+        self.since = clock.time()
+        self.failures = 0
+        self.next_probe = 0
+        self.probes = 0
+        self.skipped_syncs = 0
+        self.state_secs = {ONLINE: 0.0, OFFLINE: 0.0}
+        self.history = collections.deque(maxlen=history)
+
+    def backoff(self):
+        """
+        Returns:
+            The delay in seconds before the next probe after a failure.
+        """
+
+        delay = min(self.backoff_base * 2 ** (self.failures - 1), self.backoff_max)
+        return delay * (1 - self.jitter * self.random.random())
+
+    def probe(self, transport):
+        """
+        Probe the upload server and update the link state, logging any change.
+
+        Args:
+            transport: The upload transport in use
+        Returns:
+            A boolean showing if the server could be reached.
+        """
+
+        self.probes += 1
+        up = transport.probe(self.probe_timeout)
+        now = clock.time()
+
+        if up:
+            self.failures = 0
+            self.next_probe = 0
+            self._set_state(ONLINE, now)
+        else:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self._set_state(OFFLINE, now)
+            self.next_probe = now + self.backoff()
+
+        return up
+
+    def _set_state(self, state, now):
+        # Move to a new link state, keeping the time spent in the last one
+        if state == self.state:
+            return
+
+        duration = now - self.since
+        self.state_secs[self.state] += duration
+        if state == OFFLINE:
+            logging.warning('Link offline after {} failed probes, skipping syncs'.format(self.failures))
+        else:
+            logging.warning('Link online after {:.0f} secs offline'.format(duration))
+        self.state = state
+        self.since = now
+        self.history.append((now, state))
+
+    def available(self, transport, die, max_wait):
+        """
+        Check the link before a sync. Probes run as they fall due, so while the
+        link is down this waits through the backoff between probes.
+
+        Args:
+            transport: The upload transport in use
+            die: A threading event to stop waiting
+            max_wait: The longest time in seconds to wait for the link
+        Returns:
+            True as soon as a probe succeeds, or False if the link is still
+            down after max_wait seconds or die is set.
+        """
+
+        deadline = clock.time() + max_wait
+        while not die.is_set():
+            wait = self.next_probe - clock.time()
+            if wait <= 0:
+                if self.probe(transport):
+                    return True
+                continue
+            if clock.time() + wait > deadline:
+                die.wait(max(deadline - clock.time(), 0))
+                break
+            die.wait(wait)
+
+        self.skipped_syncs += 1
+        return False
+
+    def metrics(self):
+        """
+        Returns:
+            A dictionary of the link state, the time spent online and offline,
+            the uptime fraction, the probe and skipped sync counts and the
+            history of state changes as (time, state) pairs.
+        """
+
+        now = clock.time()
+        secs = dict(self.state_secs)
+        secs[self.state] += now - self.since
+        total = secs[ONLINE] + secs[OFFLINE]
+        return {'state': self.state,
+                'since': self.since,
+                'online_secs': secs[ONLINE],
+                'offline_secs': secs[OFFLINE],
+                'uptime': secs[ONLINE] / total if total else 1.0,
+                'probes': self.probes,
+                'failed_probes': self.failures,
+                'skipped_syncs': self.skipped_syncs,
+                'history': list(self.history)}
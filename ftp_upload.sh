@@ -2,6 +2,8 @@
 
 ftp_string=$1
 data_dir=$2
+# Optional lftp mirror flag, --Remove-source-files if uploads are not verified
+remove_flag=$3
 
 if [ ! -d $data_dir ]; then
 	exit 1
@@ -9,6 +11,16 @@ fi
 
 data_top_folder_name=$(basename $data_dir)
 
+# Mirror health records first, so that sensor faults are reported early, then
+# the priority queues from priority 0 up, then everything else
+first_dirs="$(find $data_dir -mindepth 1 -type d -name health)
+$(find $data_dir -mindepth 1 -type d -regex '.*/priority/[0-9]+' | awk -F/ '{print $NF, $0}' | sort -n | cut -d' ' -f2-)"
+first_mirrors=""
+for first_dir in $first_dirs; do
+	first_mirrors="$first_mirrors
+mirror --reverse $remove_flag --only-missing --exclude-glob *.part --verbose $first_dir $data_top_folder_name/${first_dir#$data_dir/};"
+done
+
 lftp -c "set ftp:list-options -a;
 set ssl-force on;
 set passive-mode on;
@@ -17,5 +29,5 @@ set net:timeout 300;
 set net:max-retries 3;
 set net:reconnect-interval-base 5;
 set net:reconnect-interval-multiplier 2;
-open $ftp_string;
-mirror --reverse --Remove-source-files --only-missing --verbose $data_dir $data_top_folder_name"
+open $ftp_string;$first_mirrors
+mirror --reverse $remove_flag --only-missing --exclude-glob *.part --verbose $data_dir $data_top_folder_name"
@@ -0,0 +1,325 @@
+import os
+import time
+import threading
+import logging
+import multiprocessing
+from supervisor import heartbeat
+
+
+"""
+A resource governor to adapt the recorder to the device temperature and load.
+Readings of CPU temperature, load, free memory and optional battery voltage
+are taken through a SysfsReader, which can be pointed at a fake root directory
+for testing. The governor sets a throttle level from the readings:
+
+0: normal running
+1: warm or loaded - one encoder at a time, fastest compression
+2: hot or low battery - as 1, and uploads are deferred
+3: critical - as 2, and the pause between captures is stretched
+
+Every change of level is logged as an event and the time spent throttled is
+recorded.
+"""
+
+LEVEL_NAMES = ['normal', 'warm', 'hot', 'critical']
+
+# Defaults for the optional governor section of the config
+GOVERNOR_DEFAULTS = {'enabled': 0,
+                     'interval': 30,
+                     'sysfs_root': '/',
+                     'battery_path': None,
+                     'warm_temp': 70.0,
+                     'hot_temp': 75.0,
+                     'critical_temp': 80.0,
+                     'hysteresis': 3.0,
+                     'max_load': 1.5,
+                     'min_free_mb': 32,
+                     'low_voltage': None,
+                     'critical_voltage': None,
+                     'max_encoders': None,
+                     'critical_pause': 300}
+
+
+def governor_options(config):
+    """
+    Get governor settings from the optional governor section of a config,
+    filling in defaults.
+
+    Args:
+        config: The full config dictionary
+    Returns:
+        A dictionary of governor settings.
+    """
+
+    opts = dict(GOVERNOR_DEFAULTS)
+    opts.update(config.get('governor', {}))
+    return opts
+
+
+class SysfsReader(object):
+
+    def __init__(self, root='/', battery_path=None):
+        """
+        A class to read resource levels from the proc and sys filesystems.
+
+        Args:
+            root: The root directory holding proc and sys, replaced in testing
+            battery_path: An optional path below root to a battery voltage file
+                in microvolts, e.g. sys/class/power_supply/BAT0/voltage_now
+        """
+
+        self.root = root
+        self.battery_path = battery_path
+
+    def _read(self, path):
+        try:
+            with open(os.path.join(self.root, path)) as infile:
+                return infile.read()
+        except IOError:
+            return None
+
+    def temperature(self):
+        """
+        Returns:
+            The CPU temperature in degrees C or None if not available.
+        """
+        value = self._read('sys/class/thermal/thermal_zone0/temp')
+        return None if value is None else int(value.strip()) / 1000.0
+
+    def load(self):
+        """
+        Returns:
+            The one minute load average per CPU or None if not available.
+        """
+        value = self._read('proc/loadavg')
+        if value is None:
+            return None
+        return float(value.split()[0]) / multiprocessing.cpu_count()
+
+    def free_memory(self):
+        """
+        Returns:
+            The available memory in MB or None if not available.
+        """
+        value = self._read('proc/meminfo')
+        if value is None:
+            return None
+        meminfo = {}
+        for line in value.splitlines():
+            fields = line.split()
+            if len(fields) >= 2:
+                meminfo[fields[0].rstrip(':')] = int(fields[1])
+        free = meminfo.get('MemAvailable', meminfo.get('MemFree'))
+        return None if free is None else free / 1024.0
+
+    def battery_voltage(self):
+        """
+        Returns:
+            The battery voltage in V or None if not configured or available.
+        """
+        if self.battery_path is None:
+            return None
+        value = self._read(self.battery_path)
+        return None if value is None else int(value.strip()) / 1e6
+
+    def readings(self):
+        """
+        Returns:
+            A dictionary of all readings.
+        """
+        return {'temperature': self.temperature(),
+                'load': self.load(),
+                'free_memory': self.free_memory(),
+                'battery_voltage': self.battery_voltage()}
+
+
+class Governor(object):
+
+    def __init__(self, reader, warm_temp=70.0, hot_temp=75.0, critical_temp=80.0,
+                 hysteresis=3.0, max_load=1.5, min_free_mb=32, low_voltage=None,
+                 critical_voltage=None, max_encoders=None, critical_pause=300):
+        """
+        A class to set a throttle level from resource readings and provide the
+        adaptations used by the recorder.
+
+        Args:
+            reader: A SysfsReader instance
+            warm_temp, hot_temp, critical_temp: Temperatures in degrees C at
+                which the levels start
+            hysteresis: Degrees C below a threshold before the level is dropped
+            max_load: The load average per CPU at which the warm level starts
+            min_free_mb: The available memory in MB below which the warm level starts
+            low_voltage, critical_voltage: Optional battery voltages below which
+                the hot and critical levels start
+            max_encoders: The number of concurrent encoders at the normal
+                level, defaulting to the number of CPUs
+            critical_pause: Extra seconds added to the capture delay at the
+                critical level
+        """
+
+        self.reader = reader
+        self.warm_temp = warm_temp
+        self.hot_temp = hot_temp
+        self.critical_temp = critical_temp
+        self.hysteresis = hysteresis
+        self.max_load = max_load
+        self.min_free_mb = min_free_mb
+        self.low_voltage = low_voltage
+        self.critical_voltage = critical_voltage
+        self.max_encoders = max_encoders or multiprocessing.cpu_count()
+        self.critical_pause = critical_pause
+
+        self.level = 0
+        self.readings = {}
+        self.level_since = time.time()
+        self.throttled_secs = 0.0
+
+        self.encoders = 0
+        self.encoder_cond = threading.Condition()
+
+    def _level_for(self, readings, margin):
+        # Work out the throttle level from readings. The margin is subtracted from
+        # temperature thresholds, so that a level is held until the temperature
+        # drops by the hysteresis.
+        level = 0
+        reasons = []
+
+        temp = readings.get('temperature')
+        if temp is not None:
+            for lvl, threshold in [(1, self.warm_temp), (2, self.hot_temp),
+                                   (3, self.critical_temp)]:
+                if temp >= threshold - (margin if lvl <= self.level else 0):
+                    level = lvl
+            if level:
+                reasons.append('temperature {:.1f}C'.format(temp))
+
+        load = readings.get('load')
+        if load is not None and load >= self.max_load:
+            level = max(level, 1)
+            reasons.append('load {:.2f}'.format(load))
+
+        free = readings.get('free_memory')
+        if free is not None and free < self.min_free_mb:
+            level = max(level, 1)
+            reasons.append('free memory {:.0f}MB'.format(free))
+
+        volts = readings.get('battery_voltage')
+        if volts is not None:
+            if self.critical_voltage is not None and volts < self.critical_voltage:
+                level = 3
+                reasons.append('battery {:.2f}V'.format(volts))
+            elif self.low_voltage is not None and volts < self.low_voltage:
+                level = max(level, 2)
+                reasons.append('battery {:.2f}V'.format(volts))
+
+        return level, reasons
+
+    def update(self):
+        """
+        Take new readings and update the throttle level, logging any change.
+
+        Returns:
+            The throttle level.
+        """
+
+        self.readings = self.reader.readings()
+        level, reasons = self._level_for(self.readings, self.hysteresis)
+
+        now = time.time()
+        if self.level > 0:
+            self.throttled_secs += now - self.level_since
+
+        if level != self.level:
+            logging.warning('Governor event: {} -> {} ({}). Throttled for {:.0f} secs in total'.format(
+                LEVEL_NAMES[self.level], LEVEL_NAMES[level], ', '.join(reasons) or 'recovered',
+                self.throttled_time()))
+            with self.encoder_cond:
+                self.level = level
+                self.encoder_cond.notify_all()
+
+        self.level_since = now
+        return self.level
+
+    def throttled_time(self):
+        """
+        Returns:
+            The total time in seconds spent at a throttle level above normal.
+        """
+
+        extra = time.time() - self.level_since if self.level > 0 else 0
+        return self.throttled_secs + extra
+
+    def encoder_limit(self):
+        """
+        Returns:
+            The number of encoders allowed to run at once at the current level.
+        """
+
+        return 1 if self.level >= 1 else self.max_encoders
+
+    def acquire_encoder(self):
+        """
+        Wait for an encoder slot under the current concurrency limit
+        """
+
+        with self.encoder_cond:
+            while self.encoders >= self.encoder_limit():
+                self.encoder_cond.wait()
+            self.encoders += 1
+
+    def release_encoder(self):
+        """
+        Release an encoder slot
+        """
+
+        with self.encoder_cond:
+            self.encoders -= 1
+            self.encoder_cond.notify_all()
+
+    def fast_compression(self):
+        """
+        Returns:
+            A boolean showing if encoders should use their fastest settings.
+        """
+
+        return self.level >= 1
+
+    def defer_uploads(self):
+        """
+        Returns:
+            A boolean showing if uploads should be deferred.
+        """
+
+        return self.level >= 2
+
+    def stretch_delay(self, delay):
+        """
+        Stretch the pause between captures at the critical level.
+
+        Args:
+            delay: The configured capture delay in seconds
+        Returns:
+            The delay to use in seconds.
+        """
+
+        if self.level >= 3:
+            return delay + self.critical_pause
+        return delay
+
+
+def govern(governor, interval, die):
+    """
+    Function to regularly update the governor, intended to run in a thread.
+
+    Args:
+        governor: A Governor instance
+        interval: The time in seconds between readings
+        die: A threading event to terminate the governor
+    """
+
+    while not die.is_set():
+        heartbeat()
+        governor.update()
+        die.wait(interval)
+
+    logging.info('Governor: throttled for {:.0f} secs in total'.format(governor.throttled_time()))
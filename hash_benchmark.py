@@ -0,0 +1,88 @@
+import os
+import sys
+import time
+import shutil
+import tempfile
+import argparse
+import logging
+from integrity import HashingWriter, hash_file
+
+
+"""
+A benchmark of the cost of checksumming staged files (integrity.py), in
+seconds per GB. Data is written in the block size used by stream_command, to
+a plain file and through a HashingWriter, and the difference is the cost of
+hashing as files are written. The freshly written file is then hashed again
+with hash_file, which is the cost of hashing a file written by another
+program, such as the mp3 written by avconv, while it is still in the page
+cache. Run it on the device to see what staging costs there.
+
+    python hash_benchmark.py --size 256 --repeats 3
+"""
+
+
+def write_file(fileobj, block, n_blocks):
+    for _ in range(n_blocks):
+        fileobj.write(block)
+
+
+def benchmark(size_mb=256, repeats=3, block_size=65536):
+    """
+    Time writing a file with and without hashing, and hashing it again.
+
+    Args:
+        size_mb: The size of the test file in MB
+        repeats: The number of times to repeat each test, keeping the fastest
+        block_size: The number of bytes in each write
+    Returns:
+        A dictionary of the seconds per GB of a plain write, a write through a
+        HashingWriter and a hash_file read of the written file.
+    """
+
+    block = os.urandom(block_size)
+    n_blocks = size_mb * 1024 * 1024 // block_size
+    per_gb = 1024 ** 3 / float(n_blocks * block_size)
+    root = tempfile.mkdtemp()
+    path = os.path.join(root, 'hash_benchmark.wav')
+    times = {'write': [], 'hashing_write': [], 'hash_file': []}
+
+    try:
+        for _ in range(repeats):
+            started = time.time()
+            with open(path, 'wb') as outfile:
+                write_file(outfile, block, n_blocks)
+            times['write'].append(time.time() - started)
+            os.remove(path)
+
+            started = time.time()
+            writer = HashingWriter(path)
+            write_file(writer, block, n_blocks)
+            writer.close()
+            times['hashing_write'].append(time.time() - started)
+
+            started = time.time()
+            hash_file(path)
+            times['hash_file'].append(time.time() - started)
+            os.remove(path)
+    finally:
+        shutil.rmtree(root)
+
+    return dict((key + '_secs_per_gb', min(secs) * per_gb) for key, secs in times.items())
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark hashing staged files')
+    parser.add_argument('--size', type=int, default=256, help='The size of the test file in MB')
+    parser.add_argument('--repeats', type=int, default=3,
+                        help='The number of times to repeat each test')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+
+    result = benchmark(args.size, args.repeats)
+    print('Plain write: {:.2f} secs per GB'.format(result['write_secs_per_gb']))
+    print('HashingWriter: {:.2f} secs per GB, {:.2f} secs per GB for hashing'.format(
+        result['hashing_write_secs_per_gb'],
+        result['hashing_write_secs_per_gb'] - result['write_secs_per_gb']))
+    print('hash_file re-read: {:.2f} secs per GB'.format(result['hash_file_secs_per_gb']))
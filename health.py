@@ -0,0 +1,413 @@
+import os
+import json
+import time
+import struct
+import logging
+import clock
+from integrity import HashingWriter, PART_SUFFIX, record_staged
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+"""
+Data quality checks run on every capture, so that a dead microphone, an
+unplugged soundcard or a fogged lens is noticed within one sync rather than
+weeks later. The results of each capture are written to a small JSON health
+record in the health directory of the device upload directory, which the
+transports send ahead of the data. Captures that fail a check are logged as
+health alerts.
+
+Audio is checked as it is recorded: AudioCheck is passed the WAV stream on its
+way to disk and keeps running totals over each chunk with NumPy, so the checks
+need no second read of the file. Recordings are flagged for:
+
+* clipping: the fraction of samples at full scale is over clip_ratio
+* dc_offset: the mean of a channel is over dc_offset of full scale
+* silence: the fraction of samples that are exactly zero is over silence_ratio
+* flatline: a channel varies by no more than flatline_level of full scale
+* truncated: the recording is shorter than min_duration of the expected length
+
+Images are flagged as missing when the capture failed or the file is empty, as
+corrupt when it is not a complete JPEG and, when PIL is available, as black,
+overexposed or blurred from the brightness and the variance of the Laplacian of
+a reduced greyscale decode. Without NumPy only the audio duration is checked.
+"""
+
+HEALTH_DIR = 'health'
+
+# Defaults for the optional health section of the config
+HEALTH_DEFAULTS = {'enabled': 0,
+                   'clip_ratio': 0.001,
+                   'dc_offset': 0.05,
+                   'silence_ratio': 0.95,
+                   'flatline_level': 0.0001,
+                   'min_duration': 0.98,
+                   'black_level': 0.05,
+                   'overexposed_ratio': 0.5,
+                   'blur_threshold': 50.0}
+
+# The greyscale size images are decoded at for the checks. JPEG decoders can
+# scale by up to 1/8 while decoding, which is much faster than a full decode.
+IMAGE_CHECK_SIZE = (640, 480)
+
+
+def health_options(config):
+    """
+    Get data quality check settings from the optional health section of a
+    config, filling in defaults.
+
+    Args:
+        config: The full config dictionary
+    Returns:
+        A dictionary of data quality check settings.
+    """
+
+    opts = dict(HEALTH_DEFAULTS)
+    opts.update(config.get('health', {}))
+    return opts
+
+
+def image_stats(lum):
+    """
+    Measure the brightness and sharpness of a greyscale image.
+
+    Args:
+        lum: A 2D NumPy array of luminance values from 0 to 255
+    Returns:
+        A dictionary of the mean brightness as a fraction of full scale, the
+        fraction of saturated pixels and the variance of the Laplacian, which
+        falls as the image blurs.
+    """
+
+    lum = lum.astype(np.float32)
+    laplacian = (4 * lum[1:-1, 1:-1] - lum[:-2, 1:-1] - lum[2:, 1:-1] -
+                 lum[1:-1, :-2] - lum[1:-1, 2:])
+
+    return {'brightness': float(lum.mean()) / 255,
+            'saturated_ratio': float(np.count_nonzero(lum >= 250)) / lum.size,
+            'blur_score': float(laplacian.var()) if laplacian.size else 0.0}
+
+
+class AudioCheck(object):
+
+    def __init__(self, writer=None):
+        """
+        A file-like object taking a WAV stream and keeping running statistics
+        of the samples, passing the data on to an optional writer. Only the
+        frame count is kept if NumPy is not available.
+
+        Args:
+            writer: An optional file-like object the stream is written to
+        """
+
+        self.writer = writer
+        self.header = b''
+        self.remainder = b''
+        self.channels = None
+        self.rate = None
+        self.sampwidth = None
+        self.block_align = None
+        self.frames = 0
+        self.error = None
+
+        # Running totals over all chunks, per channel
+        self.sums = None
+        self.minimum = None
+        self.maximum = None
+        self.clipped = 0
+        self.zeros = 0
+
+    def write(self, data):
+        if self.writer is not None:
+            self.writer.write(data)
+
+        # A malformed stream is still recorded, just not checked
+        if self.error is not None:
+            return
+        try:
+            if self.block_align is None:
+                self.header += data
+                data = self._parse_header()
+                if data is None:
+                    return
+            data = self.remainder + data
+            usable = len(data) - len(data) % self.block_align
+            self.remainder = data[usable:]
+            if usable:
+                self._update(data[:usable])
+        except (ValueError, struct.error) as e:
+            self.error = str(e)
+
+    def close(self):
+        """
+        Close the writer, if set.
+
+        Returns:
+            The value returned by the writer, such as the digest of a HashingWriter.
+        """
+
+        if self.writer is not None:
+            return self.writer.close()
+
+    def _parse_header(self):
+        # Read the format from the RIFF header once the data chunk is reached,
+        # returning any sample data after it or None if more is needed
+        if len(self.header) < 12:
+            return None
+        if self.header[:4] != b'RIFF' or self.header[8:12] != b'WAVE':
+            raise ValueError('not a WAV stream')
+
+        pos = 12
+        fmt = None
+        while len(self.header) >= pos + 8:
+            chunk_id, size = struct.unpack('<4sI', self.header[pos:pos + 8])
+            if chunk_id == b'data':
+                if fmt is None:
+                    raise ValueError('no fmt chunk before the data')
+                _, self.channels, self.rate, _, self.block_align, _ = fmt
+                self.sampwidth = self.block_align // self.channels
+                if self.sampwidth not in [1, 2, 3, 4]:
+                    raise ValueError('unsupported sample width {}'.format(self.sampwidth))
+                data = self.header[pos + 8:]
+                self.header = b''
+                return data
+            end = pos + 8 + size + size % 2
+            if chunk_id == b'fmt ':
+                if len(self.header) < pos + 24:
+                    return None
+                fmt = struct.unpack('<HHIIHH', self.header[pos + 8:pos + 24])
+            pos = end
+
+        return None
+
+    def _samples(self, data):
+        # Convert little endian PCM bytes to integer samples, one column per channel
+        if self.sampwidth == 1:
+            ints = np.frombuffer(data, dtype=np.uint8).astype(np.int16) - 128
+        elif self.sampwidth == 2:
+            ints = np.frombuffer(data, dtype='<i2')
+        elif self.sampwidth == 3:
+            raw = np.frombuffer(data, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+            ints = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+            ints[ints >= 1 << 23] -= 1 << 24
+        else:
+            ints = np.frombuffer(data, dtype='<i4')
+
+        return ints.reshape(-1, self.channels)
+
+    def _update(self, data):
+        self.frames += len(data) // self.block_align
+        if np is None:
+            return
+
+        samples = self._samples(data)
+        full_scale = 1 << (8 * self.sampwidth - 1)
+        sums = samples.sum(axis=0, dtype=np.float64)
+        minimum = samples.min(axis=0)
+        maximum = samples.max(axis=0)
+        if self.sums is None:
+            self.sums, self.minimum, self.maximum = sums, minimum, maximum
+        else:
+            self.sums += sums
+            self.minimum = np.minimum(self.minimum, minimum)
+            self.maximum = np.maximum(self.maximum, maximum)
+        clipped = (samples <= -full_scale) | (samples >= full_scale - 1)
+        self.clipped += int(np.count_nonzero(clipped))
+        self.zeros += int(np.count_nonzero(samples == 0))
+
+    def metrics(self):
+        """
+        Returns:
+            A dictionary of the channels, sample rate and duration of the stream
+            and, where measured, the fraction of clipped and zero samples and
+            the DC offset and range of each channel as fractions of full scale.
+        """
+
+        duration = self.frames / float(self.rate) if self.rate else 0.0
+        metrics = {'channels': self.channels, 'sample_rate': self.rate, 'duration': duration}
+        if self.error is not None:
+            metrics['error'] = self.error
+        if self.sums is not None:
+            full_scale = float(1 << (8 * self.sampwidth - 1))
+            samples = self.frames * self.channels
+            metrics.update({'clip_ratio': self.clipped / float(samples),
+                            'zero_ratio': self.zeros / float(samples),
+                            'dc_offset': [round(float(total) / self.frames / full_scale, 6)
+                                          for total in self.sums],
+                            'range': [round((hi - lo) / full_scale, 6)
+                                      for lo, hi in zip(self.minimum.tolist(), self.maximum.tolist())]})
+
+        return metrics
+
+
+class HealthChecker(object):
+
+    def __init__(self, upload_dir, clip_ratio=0.001, dc_offset=0.05, silence_ratio=0.95,
+                 flatline_level=0.0001, min_duration=0.98, black_level=0.05,
+                 overexposed_ratio=0.5, blur_threshold=50.0):
+        """
+        A class to judge the results of the data quality checks on each capture
+        and to stage them as health records.
+
+        Args:
+            upload_dir: The device upload directory, holding the health directory
+            clip_ratio: The largest fraction of audio samples at full scale
+            dc_offset: The largest mean of an audio channel, as a fraction of full scale
+            silence_ratio: The largest fraction of audio samples that are exactly zero
+            flatline_level: The smallest range of an audio channel, as a fraction
+                of full scale
+            min_duration: The shortest recording, as a fraction of the expected length
+            black_level: The lowest mean image brightness, as a fraction of full scale
+            overexposed_ratio: The largest fraction of saturated image pixels
+            blur_threshold: The lowest variance of the image Laplacian
+        """
+
+        self.health_dir = os.path.join(upload_dir, HEALTH_DIR)
+        self.clip_ratio = clip_ratio
+        self.dc_offset = dc_offset
+        self.silence_ratio = silence_ratio
+        self.flatline_level = flatline_level
+        self.min_duration = min_duration
+        self.black_level = black_level
+        self.overexposed_ratio = overexposed_ratio
+        self.blur_threshold = blur_threshold
+
+        self.checks = 0
+        self.alerts = 0
+        self.last_alert = None
+
+        if np is None:
+            logging.warning('NumPy not found, only checking audio duration')
+        if Image is None or np is None:
+            logging.warning('PIL or NumPy not found, only checking images are complete')
+
+    def audio_flags(self, metrics, expected=None):
+        """
+        Judge the results of an AudioCheck.
+
+        Args:
+            metrics: The dictionary returned by AudioCheck.metrics()
+            expected: The expected duration in seconds, or None to skip the check
+        Returns:
+            A list of the checks failed.
+        """
+
+        flags = []
+        if 'error' in metrics:
+            flags.append('unreadable')
+        if 'clip_ratio' in metrics:
+            if metrics['clip_ratio'] > self.clip_ratio:
+                flags.append('clipping')
+            if max(abs(offset) for offset in metrics['dc_offset']) > self.dc_offset:
+                flags.append('dc_offset')
+            if metrics['zero_ratio'] > self.silence_ratio:
+                flags.append('silence')
+            if min(metrics['range']) <= self.flatline_level:
+                flags.append('flatline')
+        if expected and metrics['duration'] < self.min_duration * expected:
+            flags.append('truncated')
+
+        return flags
+
+    def check_image(self, path, returncode=0):
+        """
+        Check a staged image.
+
+        Args:
+            path: The path of the image
+            returncode: The return code of the capture command
+        Returns:
+            A tuple of the list of checks failed and a dictionary of measurements.
+        """
+
+        if returncode != 0 or not os.path.exists(path) or os.path.getsize(path) == 0:
+            return ['missing'], {'returncode': returncode}
+
+        # A JPEG starts with a start of image marker and ends with an end of
+        # image marker, so a truncated capture is found without decoding
+        metrics = {'size': os.path.getsize(path)}
+        with open(path, 'rb') as infile:
+            start = infile.read(2)
+            infile.seek(-2, os.SEEK_END)
+            end = infile.read(2)
+        if start != b'\xff\xd8' or end != b'\xff\xd9':
+            return ['corrupt'], metrics
+
+        if Image is None or np is None:
+            return [], metrics
+
+        try:
+            image = Image.open(path)
+            image.draft('L', IMAGE_CHECK_SIZE)
+            metrics.update(image_stats(np.asarray(image.convert('L'))))
+        except (IOError, ValueError) as e:
+            metrics['error'] = str(e)
+            return ['corrupt'], metrics
+
+        flags = []
+        if metrics['brightness'] < self.black_level:
+            flags.append('black')
+        if metrics['saturated_ratio'] > self.overexposed_ratio:
+            flags.append('overexposed')
+        if metrics['blur_score'] < self.blur_threshold:
+            flags.append('blurred')
+
+        return flags, metrics
+
+    def report(self, sensor, name, start, flags, metrics):
+        """
+        Stage a health record for a capture, logging an alert if any check failed.
+
+        Args:
+            sensor: The name of the sensor class
+            name: The name of the captured file
+            start: The capture start time
+            flags: The list of checks failed
+            metrics: A dictionary of measurements
+        Returns:
+            The path of the staged health record, or None if it could not be written.
+        """
+
+        self.checks += 1
+        if flags:
+            self.alerts += 1
+            self.last_alert = {'time': clock.time(), 'sensor': sensor, 'name': name, 'flags': flags}
+            logging.warning('Health alert: {} {} failed checks: {}'.format(
+                sensor, name, ', '.join(flags)))
+
+        stamp = time.strftime('%Y%m%d_%H%M%S', time.localtime(start))
+        path = os.path.join(self.health_dir, '{}_{}.json'.format(sensor, stamp))
+        record = {'sensor': sensor, 'name': name, 'start': start, 'checked_at': clock.time(),
+                  'ok': not flags, 'flags': flags, 'metrics': metrics}
+
+        try:
+            if not os.path.exists(self.health_dir):
+                os.makedirs(self.health_dir)
+            writer = HashingWriter(path + PART_SUFFIX)
+            writer.write(json.dumps(record, sort_keys=True).encode('utf-8'))
+            digest = writer.close()
+            os.rename(path + PART_SUFFIX, path)
+        except (IOError, OSError) as e:
+            # not critical - the capture itself is kept
+            logging.error('Could not stage health record {}: {}'.format(path, e))
+            return None
+        record_staged(path, writer.size, digest, {'sensor': HEALTH_DIR, 'start': start,
+                                                  'end': start, 'codec': 'json'})
+
+        return path
+
+    def status(self):
+        """
+        Returns:
+            A dictionary of the number of captures checked and failed and the last alert.
+        """
+
+        return {'checks': self.checks, 'alerts': self.alerts, 'last_alert': self.last_alert}
@@ -0,0 +1,200 @@
+import os
+import re
+import sys
+import time
+import shutil
+import hashlib
+import tempfile
+import argparse
+import threading
+import logging
+from bundle_benchmark import LatencyFTPServer, make_files, upload_files
+from transports.HTTPTransport import HTTPTransport
+
+try:
+    import socketserver
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    # Python 2
+    import SocketServer as socketserver
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+"""
+A benchmark of the HTTP transport (transports/HTTPTransport.py) against FTP.
+A local HTTP stand-in stores Content-Range PUT parts at their offsets and a
+local FTP stand-in (bundle_benchmark.py) discards uploads, and both add a fixed
+delay to every reply, standing in for the round trip time of a high latency
+link. The same files are uploaded over each and the MB per second reported.
+An HTTP upload is then stopped part way through and resumed, and the share of
+the data sent again on resuming is reported.
+
+    python http_benchmark.py --files 10 --size 2000000 --latency 0.1
+"""
+
+
+class RangePutHandler(BaseHTTPRequestHandler):
+    """
+    Handles PUT requests with optional Content-Range headers, writing each
+    part at its offset, and HEAD requests reporting the stored size and
+    SHA-256. Replies are delayed by the server latency.
+    """
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, headers=None):
+        time.sleep(self.server.latency)
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        if 'Content-Length' not in (headers or {}):
+            self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_PUT(self):
+        length = int(self.headers.get('Content-Length', 0))
+        data = self.rfile.read(length)
+        with self.server.lock:
+            self.server.puts += 1
+            self.server.received += length
+            if self.server.puts in self.server.fail_puts:
+                self.reply(500)
+                return
+            match = re.match(r'bytes (\d+)-\d+/\d+', self.headers.get('Content-Range', ''))
+            if match is None or not self.server.ranges:
+                # A plain PUT replaces the whole object
+                self.server.files[self.path] = bytearray(data)
+            else:
+                start = int(match.group(1))
+                stored = self.server.files.setdefault(self.path, bytearray())
+                if len(stored) < start:
+                    stored.extend(b'\0' * (start - len(stored)))
+                stored[start:start + length] = data
+        self.reply(201)
+
+    def do_HEAD(self):
+        with self.server.lock:
+            stored = self.server.files.get(self.path)
+        if stored is None:
+            self.reply(404)
+            return
+        self.reply(200, {'Content-Length': str(len(stored)),
+                         'X-Checksum-Sha256': hashlib.sha256(bytes(stored)).hexdigest()})
+
+
+class RangePutServer(socketserver.ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, latency=0, ranges=True, fail_puts=()):
+        """
+        A local HTTP upload endpoint with injected latency, listening on a
+        free port. Stored files are kept in memory by request path.
+
+        Args:
+            latency: The delay in seconds added to every reply
+            ranges: Whether to honour Content-Range, or replace the stored
+                file with each request as a plain PUT endpoint does
+            fail_puts: The numbers of the PUT requests, counting from one,
+                to answer with a server error
+        """
+
+        HTTPServer.__init__(self, ('127.0.0.1', 0), RangePutHandler)
+        self.latency = latency
+        self.ranges = ranges
+        self.fail_puts = set(fail_puts)
+        self.lock = threading.Lock()
+        self.files = {}
+        self.puts = 0
+        self.received = 0
+
+    @property
+    def url(self):
+        return 'http://{}:{}/upload'.format(*self.server_address)
+
+
+def start_server(server):
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def benchmark(n_files=10, size=2000000, latency=0.1, part_size=512 * 1024, parallel=4):
+    """
+    Time the upload of the same files over HTTP and FTP, and the data sent
+    again when an interrupted HTTP upload resumes.
+
+    Args:
+        n_files: The number of files to upload
+        size: The size of each file in bytes
+        latency: The delay in seconds added to every server reply
+        part_size: The size of each HTTP upload part in bytes
+        parallel: The number of HTTP parts sent at once
+    Returns:
+        A dictionary of the MB per second uploaded over FTP and HTTP, and the
+        fraction of the data resent on resuming.
+    """
+
+    ftp_server = start_server(LatencyFTPServer(latency))
+    http_server = start_server(RangePutServer(latency))
+    config = {'url': http_server.url, 'part_size': part_size, 'parallel': parallel}
+    root = tempfile.mkdtemp()
+    total = float(n_files * size)
+
+    try:
+        upload_dir = os.path.join(root, 'live_data')
+        paths = make_files(upload_dir, n_files, size)
+        started = time.time()
+        upload_files(ftp_server.server_address, upload_dir, paths)
+        ftp_secs = time.time() - started
+
+        started = time.time()
+        HTTPTransport(config).upload(upload_dir)
+        http_secs = time.time() - started
+
+        # Stop an upload about half way through, then resume it
+        shutil.rmtree(upload_dir)
+        make_files(upload_dir, n_files, size)
+        http_server.received = 0
+        die = threading.Event()
+        timer = threading.Timer(http_secs / 2, die.set)
+        timer.start()
+        HTTPTransport(config).upload(upload_dir, die=die)
+        timer.cancel()
+        HTTPTransport(config).upload(upload_dir)
+        resent = http_server.received - total
+    finally:
+        for server in (ftp_server, http_server):
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(root)
+
+    return {'ftp_mb_per_sec': total / ftp_secs / 1e6,
+            'http_mb_per_sec': total / http_secs / 1e6,
+            'resent_fraction': resent / total}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark HTTP uploads against FTP')
+    parser.add_argument('--files', type=int, default=10, help='The number of files to upload')
+    parser.add_argument('--size', type=int, default=2000000, help='The size of each file in bytes')
+    parser.add_argument('--latency', type=float, default=0.1,
+                        help='The delay in seconds added to every server reply')
+    parser.add_argument('--part-size', type=int, default=512 * 1024,
+                        help='The size of each HTTP upload part in bytes')
+    parser.add_argument('--parallel', type=int, default=4,
+                        help='The number of HTTP parts sent at once')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stdout)
+
+    result = benchmark(args.files, args.size, args.latency, args.part_size, args.parallel)
+    print('FTP: {:.2f} MB per second'.format(result['ftp_mb_per_sec']))
+    print('HTTP: {:.2f} MB per second'.format(result['http_mb_per_sec']))
+    print('Resumed HTTP upload sent {:.1%} of the data again'.format(result['resent_fraction']))
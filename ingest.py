@@ -0,0 +1,509 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import sqlite3
+import argparse
+import threading
+import logging
+from multiprocessing.pool import ThreadPool
+from integrity import HASH_ALGORITHM, MANIFEST_DIR, PART_SUFFIX, hash_file
+from catalog import parse_name, format_time
+from unbundle import BUNDLE_DIR, unbundle
+
+
+"""
+Server side ingest of fleet uploads. Devices upload into a landing area with a
+directory per device, live_data/<PI_ID>/. Each pass of the ingest finds the
+devices in the landing area and works through them on a bounded pool of worker
+threads, one device per worker at a time:
+
+* sealed bundles (bundler.py) are restored with unbundle()
+* files are checked against the size and hash in the device manifests. Files
+  not yet in a manifest are held for orphan_time seconds, as manifests are
+  uploaded after the files they describe, and are then taken unverified.
+* complete files are moved into the archive as
+  <archive>/<PI_ID>/<sensor>/<YYYY>/<YYYY-MM-DD>/<name>, or under their upload
+  path if the sensor or time is not known. Files failing their checks are
+  moved to <archive>/quarantine/<PI_ID>/.
+* manifests are archived once none of their files remain in the landing area
+
+Ingested files are indexed by device, sensor and time in an SQLite database in
+the archive. The liveness of each device is tracked from the newest file it has
+uploaded, its newest log or health record and its newest data, and written to
+fleet_status.json in the archive after each pass. Everything works on local
+directories, so the ingest can be run against a copy of the landing area:
+
+    python ingest.py /srv/ftp/continuous_monitoring_data/live_data /srv/archive
+    python ingest.py landing archive --once --workers 8
+"""
+
+INGEST_DB = 'ingest.sqlite'
+STATUS_NAME = 'fleet_status.json'
+QUARANTINE_DIR = 'quarantine'
+
+# Upload directories holding device logs and health records, used for liveness
+LIVENESS_DIRS = ['logs', 'health']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    device TEXT,
+    sensor TEXT,
+    start REAL,
+    end REAL,
+    size INTEGER,
+    checksum TEXT,
+    verified INTEGER,
+    ingested_at REAL
+);
+CREATE INDEX IF NOT EXISTS files_device_start ON files (device, start);
+CREATE INDEX IF NOT EXISTS files_sensor_start ON files (sensor, start);
+CREATE TABLE IF NOT EXISTS devices (
+    device TEXT PRIMARY KEY,
+    first_seen REAL,
+    last_seen REAL,
+    last_log REAL,
+    last_data REAL,
+    files INTEGER,
+    bytes INTEGER,
+    quarantined INTEGER,
+    state TEXT
+);
+"""
+
+DEVICE_COLUMNS = ['device', 'first_seen', 'last_seen', 'last_log', 'last_data', 'files', 'bytes',
+                  'quarantined', 'state']
+
+
+def archive_name(relpath, info):
+    """
+    Get the path of a file in the long term layout of a device archive.
+
+    Args:
+        relpath: The path of the file relative to the device landing directory
+        info: The details of the file from parse_name()
+    Returns:
+        The path relative to the device archive directory.
+    """
+
+    if info['sensor'] is None or info['start'] is None or info['sensor'] in ['log', 'bundle']:
+        return relpath
+
+    day = time.strftime('%Y-%m-%d', time.localtime(info['start']))
+    return os.path.join(info['sensor'], day[:4], day, os.path.basename(relpath))
+
+
+def move_file(src, dest):
+    """
+    Move a file, writing it with a .part suffix first when crossing filesystems,
+    so that a partly copied file is never left under its final name.
+
+    Args:
+        src: The path of the file to move
+        dest: The destination path
+    """
+
+    dest_dir = os.path.dirname(dest)
+    if not os.path.exists(dest_dir):
+        try:
+            os.makedirs(dest_dir)
+        except OSError:
+            # made by another worker
+            pass
+
+    try:
+        os.rename(src, dest)
+    except OSError:
+        shutil.copy2(src, dest + PART_SUFFIX)
+        os.rename(dest + PART_SUFFIX, dest)
+        os.remove(src)
+
+
+def read_manifests(device_dir):
+    """
+    Load the entries from the manifests uploaded by a device.
+
+    Args:
+        device_dir: The device landing directory
+    Returns:
+        A tuple of a dictionary of entries keyed by path relative to the device
+        directory, and a dictionary of the paths in each manifest keyed by the
+        manifest path.
+    """
+
+    entries = {}
+    manifests = {}
+    manifest_dir = os.path.join(device_dir, MANIFEST_DIR)
+    if not os.path.isdir(manifest_dir):
+        return entries, manifests
+
+    for fname in sorted(os.listdir(manifest_dir)):
+        if fname.endswith(PART_SUFFIX):
+            continue
+        path = os.path.join(manifest_dir, fname)
+        names = []
+        with open(path) as manifest:
+            for line in manifest:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partly written line from an interrupted run
+                    continue
+                relpath = os.path.normpath(entry['name'])
+                entries[relpath] = entry
+                names.append(relpath)
+        manifests[path] = names
+
+    return entries, manifests
+
+
+def ingest_device(landing_dir, archive_dir, device, settle_time=300, orphan_time=3600):
+    """
+    Ingest the completed files uploaded by a single device. This only works on
+    files, so it can run in a worker thread, and returns the records for the
+    index rather than writing them.
+
+    Args:
+        landing_dir: The landing area, holding a directory per device
+        archive_dir: The archive root directory
+        device: The device directory name
+        settle_time: Files modified in the last settle_time seconds are left alone
+        orphan_time: The time in seconds files wait for a manifest entry
+    Returns:
+        A dictionary of the device, the records of the ingested files, the
+        number of files quarantined and waiting, and the newest upload and log
+        times.
+    """
+
+    device_dir = os.path.join(landing_dir, device)
+    device_archive = os.path.join(archive_dir, device)
+    result = {'device': device, 'records': [], 'quarantined': 0, 'waiting': 0,
+              'last_upload': None, 'last_log': None}
+    now = time.time()
+
+    def newest(current, value):
+        return value if current is None or value > current else current
+
+    def quarantine(path, relpath, reason):
+        logging.error('Quarantining {}/{}: {}'.format(device, relpath, reason))
+        move_file(path, os.path.join(archive_dir, QUARANTINE_DIR, device, relpath))
+        result['quarantined'] += 1
+
+    # Restore settled bundles first, so their files are ingested in this pass
+    bundle_dir = os.path.join(device_dir, BUNDLE_DIR)
+    if os.path.isdir(bundle_dir):
+        for fname in sorted(os.listdir(bundle_dir)):
+            path = os.path.join(bundle_dir, fname)
+            if not fname.endswith('.tar') or now - os.path.getmtime(path) < settle_time:
+                continue
+            try:
+                unbundle(path)
+            except Exception as e:
+                quarantine(path, os.path.join(BUNDLE_DIR, fname), e)
+
+    entries, manifests = read_manifests(device_dir)
+
+    for subdir, dirs, fnames in os.walk(device_dir):
+        if os.path.relpath(subdir, device_dir).split(os.sep)[0] in [MANIFEST_DIR, BUNDLE_DIR]:
+            continue
+        for fname in sorted(fnames):
+            path = os.path.join(subdir, fname)
+            relpath = os.path.relpath(path, device_dir)
+            if fname.endswith(PART_SUFFIX):
+                continue
+            try:
+                mtime = os.path.getmtime(path)
+                size = os.path.getsize(path)
+            except OSError:
+                continue
+            result['last_upload'] = newest(result['last_upload'], min(mtime, now))
+            if now - mtime < settle_time:
+                result['waiting'] += 1
+                continue
+
+            entry = entries.get(relpath)
+            if entry is None and now - mtime < orphan_time:
+                # The manifest may still be on its way
+                result['waiting'] += 1
+                continue
+            if entry is not None and entry['size'] != size:
+                if now - mtime < orphan_time:
+                    result['waiting'] += 1
+                else:
+                    quarantine(path, relpath, 'size {} does not match manifest size {}'.format(
+                        size, entry['size']))
+                continue
+
+            digest = hash_file(path)
+            if entry is not None and entry[HASH_ALGORITHM] != digest:
+                quarantine(path, relpath, 'hash does not match manifest')
+                continue
+
+            info = parse_name(relpath)
+            dest = os.path.join(device_archive, archive_name(relpath, info))
+            if os.path.exists(dest):
+                if os.path.getsize(dest) == size and hash_file(dest) == digest:
+                    # uploaded again after an earlier ingest
+                    os.remove(path)
+                else:
+                    quarantine(path, relpath, 'a different file is already archived')
+                continue
+
+            move_file(path, dest)
+            if relpath.split(os.sep)[0] in LIVENESS_DIRS:
+                result['last_log'] = newest(result['last_log'], mtime)
+            result['records'].append({'path': os.path.relpath(dest, archive_dir), 'device': device,
+                                      'sensor': info['sensor'], 'start': info['start'],
+                                      'end': info['end'], 'size': size, 'checksum': digest,
+                                      'verified': int(entry is not None)})
+
+    # Archive manifests once none of their files are left to ingest
+    for path, names in sorted(manifests.items()):
+        if not any(os.path.exists(os.path.join(device_dir, name)) for name in names):
+            move_file(path, os.path.join(device_archive, MANIFEST_DIR, os.path.basename(path)))
+
+    # Remove settled empty directories, such as finished days
+    for subdir, dirs, fnames in os.walk(device_dir, topdown=False):
+        if subdir == device_dir or os.path.basename(subdir) in [MANIFEST_DIR, BUNDLE_DIR]:
+            continue
+        if not os.listdir(subdir) and now - os.path.getmtime(subdir) > settle_time:
+            os.rmdir(subdir)
+
+    return result
+
+
+class Ingest(object):
+
+    def __init__(self, landing_dir, archive_dir, workers=4, settle_time=300, orphan_time=3600,
+                 stale_time=21600):
+        """
+        A class to ingest uploads from the fleet into an indexed archive.
+
+        Args:
+            landing_dir: The landing area, holding a directory per device
+            archive_dir: The archive root directory, created if needed
+            workers: The number of devices ingested at once
+            settle_time: Files modified in the last settle_time seconds are left alone
+            orphan_time: The time in seconds files wait for a manifest entry
+            stale_time: The time in seconds without uploads, or without new
+                data, after which a device is reported as stale or no_data
+        """
+
+        self.landing_dir = landing_dir
+        self.archive_dir = archive_dir
+        self.workers = workers
+        self.settle_time = settle_time
+        self.orphan_time = orphan_time
+        self.stale_time = stale_time
+
+        if not os.path.exists(archive_dir):
+            os.makedirs(archive_dir)
+        self.conn = sqlite3.connect(os.path.join(archive_dir, INGEST_DB))
+        self.conn.row_factory = sqlite3.Row
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+        self.pool = ThreadPool(workers)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.conn.close()
+
+    def devices(self):
+        """
+        Returns:
+            A list of the device directory names in the landing area.
+        """
+
+        return sorted(d for d in os.listdir(self.landing_dir)
+                      if os.path.isdir(os.path.join(self.landing_dir, d)))
+
+    def run_once(self):
+        """
+        Ingest all devices in the landing area on the worker pool, index the
+        ingested files and update the device states.
+
+        Returns:
+            A dictionary of the number of files and bytes ingested, and the files
+            quarantined and waiting.
+        """
+
+        def work(device):
+            # Failures are returned, so that one device can not stop the others
+            try:
+                return ingest_device(self.landing_dir, self.archive_dir, device,
+                                     self.settle_time, self.orphan_time)
+            except Exception as e:
+                return {'device': device, 'error': e}
+
+        totals = {'files': 0, 'bytes': 0, 'quarantined': 0, 'waiting': 0}
+        for result in self.pool.imap_unordered(work, self.devices()):
+            if 'error' in result:
+                logging.error('Ingest of {} failed: {}'.format(result['device'], result['error']))
+                continue
+            self.record(result)
+            totals['files'] += len(result['records'])
+            totals['bytes'] += sum(r['size'] for r in result['records'])
+            totals['quarantined'] += result['quarantined']
+            totals['waiting'] += result['waiting']
+
+        self.update_states()
+        self.write_status()
+        return totals
+
+    def record(self, result):
+        """
+        Index the files ingested from a device and update its liveness times.
+
+        Args:
+            result: A result dictionary from ingest_device()
+        """
+
+        now = time.time()
+        device = result['device']
+        self.conn.executemany('INSERT OR REPLACE INTO files (path, device, sensor, start, end, size, '
+                              'checksum, verified, ingested_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                              [(r['path'], r['device'], r['sensor'], r['start'], r['end'], r['size'],
+                                r['checksum'], r['verified'], now) for r in result['records']])
+
+        last_data = None
+        for r in result['records']:
+            if r['sensor'] not in [None, 'log', 'bundle'] and r['end'] is not None:
+                last_data = max(last_data or r['end'], r['end'])
+
+        self.conn.execute('INSERT OR IGNORE INTO devices (device, first_seen, files, bytes, quarantined) '
+                          'VALUES (?, ?, 0, 0, 0)', (device, now))
+        self.conn.execute('UPDATE devices SET last_seen = MAX(COALESCE(last_seen, 0), COALESCE(?, 0)), '
+                          'last_log = MAX(COALESCE(last_log, 0), COALESCE(?, 0)), '
+                          'last_data = MAX(COALESCE(last_data, 0), COALESCE(?, 0)), '
+                          'files = files + ?, bytes = bytes + ?, quarantined = quarantined + ? '
+                          'WHERE device = ?',
+                          (result['last_upload'], result['last_log'], last_data,
+                           len(result['records']), sum(r['size'] for r in result['records']),
+                           result['quarantined'], device))
+        self.conn.commit()
+
+    def update_states(self):
+        """
+        Set the liveness state of each device, logging any change:
+
+        * live - uploading, with data recorded in the last stale_time seconds
+        * no_data - uploading, but without recent data, e.g. a failed sensor
+        * stale - nothing uploaded in the last stale_time seconds
+        """
+
+        now = time.time()
+        for row in self.conn.execute('SELECT device, last_seen, last_data, state FROM devices').fetchall():
+            if not row['last_seen'] or now - row['last_seen'] > self.stale_time:
+                state = 'stale'
+            elif not row['last_data'] or now - row['last_data'] > self.stale_time:
+                state = 'no_data'
+            else:
+                state = 'live'
+            if state != row['state']:
+                logging.warning('Device {}: {} -> {}'.format(row['device'], row['state'], state))
+                self.conn.execute('UPDATE devices SET state = ? WHERE device = ?',
+                                  (state, row['device']))
+        self.conn.commit()
+
+    def status(self):
+        """
+        Returns:
+            A list of dictionaries of the state, liveness times and totals of each device.
+        """
+
+        rows = self.conn.execute('SELECT * FROM devices ORDER BY device').fetchall()
+        return [dict(zip(DEVICE_COLUMNS, [row[c] for c in DEVICE_COLUMNS])) for row in rows]
+
+    def write_status(self):
+        """
+        Write the device states to the fleet status file in the archive
+        """
+
+        path = os.path.join(self.archive_dir, STATUS_NAME)
+        devices = self.status()
+        for device in devices:
+            for key in ['first_seen', 'last_seen', 'last_log', 'last_data']:
+                device[key] = format_time(device[key]) if device[key] else None
+        with open(path + PART_SUFFIX, 'w') as outfile:
+            json.dump({'updated': format_time(time.time()), 'devices': devices}, outfile, indent=1)
+        os.rename(path + PART_SUFFIX, path)
+
+    def files(self, device, start, end, sensor=None):
+        """
+        Find the archived files from a device with data starting in a time range.
+
+        Args:
+            device: The device name
+            start, end: The time range in seconds since the epoch
+            sensor: An optional sensor name to select
+        Returns:
+            A list of dictionaries of the file details, in time order.
+        """
+
+        query = 'SELECT * FROM files WHERE device = ? AND start >= ? AND start < ?'
+        params = [device, start, end]
+        if sensor is not None:
+            query += ' AND sensor = ?'
+            params.append(sensor)
+        rows = self.conn.execute(query + ' ORDER BY start', params).fetchall()
+        return [dict((key, row[key]) for key in row.keys()) for row in rows]
+
+
+def watch(ingest, interval, die):
+    """
+    Function to run ingest passes until stopped.
+
+    Args:
+        ingest: An Ingest instance
+        interval: The time in seconds between the start of each pass
+        die: A threading event to stop the ingest
+    """
+
+    while not die.is_set():
+        start = time.time()
+        totals = ingest.run_once()
+        logging.info('Ingested {} files ({:.1f} MB), {} quarantined, {} waiting in {:.1f} secs'.format(
+            totals['files'], totals['bytes'] / 1e6, totals['quarantined'], totals['waiting'],
+            time.time() - start))
+        die.wait(max(interval - (time.time() - start), 0))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Ingest uploads from rpi-eco-monitoring devices')
+    parser.add_argument('landing_dir', help='The landing area, holding a directory per device')
+    parser.add_argument('archive_dir', help='The archive directory')
+    parser.add_argument('--workers', type=int, default=4, help='The number of devices ingested at once')
+    parser.add_argument('--interval', type=int, default=300, help='Seconds between ingest passes')
+    parser.add_argument('--settle-time', type=int, default=300,
+                        help='Skip files modified in the last settle-time seconds')
+    parser.add_argument('--orphan-time', type=int, default=3600,
+                        help='Seconds files wait for a manifest entry before being taken unverified')
+    parser.add_argument('--stale-time', type=int, default=21600,
+                        help='Seconds without uploads or data before a device is reported')
+    parser.add_argument('--once', action='store_true', help='Run a single pass and exit')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    ingest = Ingest(args.landing_dir, args.archive_dir, workers=args.workers,
+                    settle_time=args.settle_time, orphan_time=args.orphan_time,
+                    stale_time=args.stale_time)
+    die = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: die.set())
+    try:
+        if args.once:
+            totals = ingest.run_once()
+            logging.info('Ingested {} files ({:.1f} MB), {} quarantined, {} waiting'.format(
+                totals['files'], totals['bytes'] / 1e6, totals['quarantined'], totals['waiting']))
+        else:
+            watch(ingest, args.interval, die)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ingest.close()
@@ -0,0 +1,347 @@
+import os
+import json
+import fcntl
+import hashlib
+import threading
+import logging
+import clock
+from supervisor import stream_command
+
+
+"""
+Checksums for staged files. Staged files are hashed as they are written and
+recorded in a pending manifest for the device. At the start of each sync the
+pending manifest is sealed into a batch manifest, which is uploaded alongside
+the files. The upload transports only remove local files once the remote copy
+has been checked against the local size and, where the server supports it,
+the recorded hash. Staged files are also added to the catalog (catalog.py) and
+passed to a stage listener, if set.
+"""
+
+HASH_ALGORITHM = 'sha256'
+MANIFEST_DIR = 'manifests'
+PENDING_NAME = 'pending.jsonl.part'
+PART_SUFFIX = '.part'
+
+# Files staged below priority/<n> in the device upload directory are uploaded
+# ahead of other data, lowest n first
+PRIORITY_DIR = 'priority'
+
+# A lock file in the device upload directory, held by the sync while it uploads
+UPLOAD_LOCK_NAME = 'upload.lock' + PART_SUFFIX
+
+# The manifest, catalog and listener receiving staged files, set up by the
+# recorder with set_manifest(), set_catalog() and set_stage_listener()
+_manifest = None
+_catalog = None
+_listener = None
+
+
+class HashingWriter(object):
+
+    def __init__(self, path):
+        """
+        A file writer that hashes data as it is written, so staged files do
+        not need a second read pass to be checksummed.
+
+        Args:
+            path: The path of the file to write
+        """
+
+        self.path = path
+        self.hash = hashlib.new(HASH_ALGORITHM)
+        self.size = 0
+        self.fileobj = open(path, 'wb')
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def close(self):
+        """
+        Close the file.
+
+        Returns:
+            The hex digest of the data written.
+        """
+
+        self.fileobj.close()
+        return self.hash.hexdigest()
+
+
+def hash_file(path, chunk_size=1024 * 1024):
+    """
+    Hash an existing file, for staging paths that move rather than write files.
+
+    Args:
+        path: The path of the file to hash
+        chunk_size: The number of bytes to read at a time
+    Returns:
+        The hex digest of the file contents.
+    """
+
+    file_hash = hashlib.new(HASH_ALGORITHM)
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunk_size), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+class UploadLock(object):
+
+    def __init__(self, path):
+        """
+        A lock held by the sync while it uploads, so that files are not moved or
+        removed while they are being transferred. Recorder threads share one
+        instance, and other processes, such as transcode.py, lock the same file.
+
+        Args:
+            path: The path of the lock file, created if needed
+        """
+
+        self.path = path
+        self.thread_lock = threading.Lock()
+        self.fileobj = open(path, 'a')
+
+    def acquire(self, blocking=True):
+        """
+        Take the lock.
+
+        Args:
+            blocking: Wait for the lock, rather than return at once if it is held
+        Returns:
+            A boolean showing if the lock was taken.
+        """
+
+        if not self.thread_lock.acquire(blocking):
+            return False
+        try:
+            fcntl.flock(self.fileobj, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self.thread_lock.release()
+            return False
+        return True
+
+    def release(self):
+        fcntl.flock(self.fileobj, fcntl.LOCK_UN)
+        self.thread_lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+def stage_output(cmd, ofile, timeout, shell=True, die=None, info=None):
+    """
+    Run a command that writes a data file to standard output, staging the output
+    to ofile while hashing it, and record the file in the active manifest. The
+    output is written with a .part suffix, so it is not uploaded until complete,
+    and is removed if the command fails or is killed.
+
+    Args:
+        cmd: The command string (or argument list if shell is False)
+        ofile: The path of the staged file
+        timeout: The number of seconds to allow the command to run
+        shell: Should the command be run through the shell
+        die: An optional threading event, which also stops the command when set
+        info: An optional dictionary of details of the file for the catalog
+    Returns:
+        The command return code, or None if the command was killed.
+    """
+
+    writer = HashingWriter(ofile + PART_SUFFIX)
+    returncode = None
+    try:
+        returncode = stream_command(cmd, timeout, writer, shell=shell, die=die)
+    finally:
+        digest = writer.close()
+        if returncode == 0:
+            os.rename(ofile + PART_SUFFIX, ofile)
+        else:
+            os.remove(ofile + PART_SUFFIX)
+
+    if returncode == 0:
+        record_staged(ofile, writer.size, digest, info)
+    else:
+        logging.error('Staging {} failed, removing partial output'.format(ofile))
+
+    return returncode
+
+
+def set_manifest(manifest):
+    """
+    Set the manifest that staged files are recorded in.
+
+    Args:
+        manifest: A Manifest instance, or None to stop recording
+    """
+
+    global _manifest
+    _manifest = manifest
+
+
+def set_catalog(catalog):
+    """
+    Set the catalog that staged files are recorded in.
+
+    Args:
+        catalog: A Catalog instance, or None to stop recording
+    """
+
+    global _catalog
+    _catalog = catalog
+
+
+def set_stage_listener(listener):
+    """
+    Set a function to be called with each staged file, after it is recorded.
+
+    Args:
+        listener: A function taking the path and the info dictionary of a
+            staged file, or None to stop calling it
+    """
+
+    global _listener
+    _listener = listener
+
+
+def record_staged(path, size, digest, info=None):
+    """
+    Record a staged file in the active manifest and catalog, and pass it to the
+    stage listener, if set.
+
+    Args:
+        path: The path of the staged file
+        size: The size of the file in bytes
+        digest: The hex digest of the file contents
+        info: An optional dictionary of details of the file for the catalog: the
+            sensor name, the start and end time of the data in seconds since the
+            epoch, the codec and the encoder quality level. Details not given are
+            taken from the file name.
+    """
+
+    if _manifest is not None:
+        _manifest.add(path, size, digest)
+    if _catalog is not None:
+        _catalog.add(path, size, digest, info)
+    if _listener is not None:
+        _listener(path, info)
+
+
+def record_bundled(paths, bundle):
+    """
+    Record that staged files have been moved into a bundle, if a catalog is set.
+
+    Args:
+        paths: The paths of the bundled files
+        bundle: The path of the bundle the files will be uploaded in
+    """
+
+    if _catalog is not None:
+        _catalog.mark_bundled(paths, bundle)
+
+
+def record_replaced(paths):
+    """
+    Record that staged files have been replaced on the device, if a catalog is set.
+
+    Args:
+        paths: The paths of the replaced files
+    """
+
+    if _catalog is not None:
+        _catalog.mark_replaced(paths)
+
+
+class Manifest(object):
+
+    def __init__(self, upload_dir):
+        """
+        A class to hold the manifests of staged files for a device.
+
+        Args:
+            upload_dir: The device specific upload directory
+        """
+
+        self.upload_dir = upload_dir
+        self.manifest_dir = os.path.join(upload_dir, MANIFEST_DIR)
+        self.pending = os.path.join(self.manifest_dir, PENDING_NAME)
+        self.lock = threading.Lock()
+
+        if not os.path.exists(self.manifest_dir):
+            os.makedirs(self.manifest_dir)
+
+    def add(self, path, size, digest):
+        """
+        Append a staged file to the pending manifest.
+
+        Args:
+            path: The path of the staged file
+            size: The size of the file in bytes
+            digest: The hex digest of the file contents
+        """
+
+        entry = {'name': os.path.relpath(path, self.upload_dir), 'size': size,
+                 HASH_ALGORITHM: digest}
+        with self.lock:
+            with open(self.pending, 'a') as pending:
+                pending.write(json.dumps(entry) + '\n')
+
+    def seal(self):
+        """
+        Seal the pending manifest into a batch manifest for upload.
+
+        Returns:
+            The path of the batch manifest or None if there was nothing pending.
+        """
+
+        with self.lock:
+            if not os.path.exists(self.pending):
+                return None
+            batch = os.path.join(self.manifest_dir, 'manifest_{}.jsonl'.format(
+                clock.strftime('%Y%m%d_%H%M%S')))
+            os.rename(self.pending, batch)
+
+        return batch
+
+    def read(self, path):
+        """
+        Load the entries from a manifest file.
+
+        Args:
+            path: The path of the manifest file
+        Returns:
+            A dictionary of entries keyed by absolute file path.
+        """
+
+        found = {}
+        with open(path) as manifest:
+            for line in manifest:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a partly written line from an interrupted run
+                    continue
+                found[os.path.join(self.upload_dir, entry['name'])] = entry
+
+        return found
+
+    def entries(self):
+        """
+        Load the entries from all local manifests.
+
+        Returns:
+            A dictionary of entries keyed by absolute file path.
+        """
+
+        found = {}
+        with self.lock:
+            for fname in os.listdir(self.manifest_dir):
+                found.update(self.read(os.path.join(self.manifest_dir, fname)))
+
+        return found
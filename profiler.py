@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import time
+import signal
+import threading
+import traceback
+import logging
+from integrity import PART_SUFFIX, hash_file, record_staged
+
+
+"""
+On demand diagnostics for field units, triggered by signals to the recorder:
+
+* SIGUSR1 - dump_stacks() logs the stack of every thread and the pipeline state
+* SIGUSR2 - toggles a SamplingProfiler over the recorder threads, which writes
+  collapsed stacks for flame graphs into the upload directory when it stops
+
+Nothing runs until a signal arrives, so there is no overhead otherwise. The
+collapsed stack files have one line per distinct stack, with the frames from
+the thread name down separated by semicolons and followed by the sample count,
+as read by flamegraph.pl and speedscope.
+"""
+
+PROFILE_DIR = 'profiles'
+
+# Defaults for the optional profiler section of the config
+PROFILER_DEFAULTS = {'interval': 0.01,
+                     'duration': 300,
+                     'threads': ['record', 'sync', 'postprocess', 'bundle', 'governor']}
+
+
+def profiler_options(config):
+    """
+    Get profiler settings from the optional profiler section of a config,
+    filling in defaults.
+
+    Args:
+        config: The full config dictionary
+    Returns:
+        A dictionary of profiler settings.
+    """
+
+    opts = dict(PROFILER_DEFAULTS)
+    opts.update(config.get('profiler', {}))
+    return opts
+
+
+def dump_stacks(state=None):
+    """
+    Log the current stack of every thread and, optionally, the pipeline state.
+
+    Args:
+        state: An optional function returning a dictionary of the pipeline state
+    """
+
+    names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+    lines = ['Stack dump of {} threads:'.format(len(names))]
+    for ident, frame in sys._current_frames().items():
+        lines.append('Thread {} ({}):'.format(names.get(ident, 'unknown'), ident))
+        lines.extend(line.rstrip('\n') for line in traceback.format_stack(frame))
+
+    if state is not None:
+        try:
+            lines.append('Pipeline state: {}'.format(json.dumps(state(), indent=1, sort_keys=True,
+                                                                 default=str)))
+        except Exception as e:
+            lines.append('Pipeline state not available: {}'.format(e))
+
+    logging.warning('\n'.join(lines))
+
+
+class SamplingProfiler(object):
+
+    def __init__(self, upload_dir, interval=0.01, duration=300, threads=None):
+        """
+        A class to sample the stacks of the recorder threads at a regular
+        interval, counting each distinct stack.
+
+        Args:
+            upload_dir: The device specific upload directory, which profiles
+                are written below
+            interval: The time in seconds between samples
+            duration: The longest time in seconds to profile for
+            threads: Names of the threads to sample, matching any thread whose
+                name starts with one of them. All threads are sampled if None.
+        """
+
+        self.profile_dir = os.path.join(upload_dir, PROFILE_DIR)
+        self.interval = interval
+        self.duration = duration
+        self.threads = threads
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def toggle(self):
+        """
+        Start the profiler, or stop it if it is running
+        """
+
+        if self.running():
+            self.stop()
+        else:
+            self.start()
+
+    def start(self):
+        """
+        Start sampling in a background thread
+        """
+
+        if self.running():
+            return
+
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self._sample, name='profiler')
+        self.thread.daemon = True
+        self.thread.start()
+        logging.warning('Profiler started for up to {} secs'.format(self.duration))
+
+    def stop(self):
+        """
+        Stop sampling, the profile is written by the sampling thread
+        """
+
+        self.stop_event.set()
+
+    def _sample(self):
+        # Count the stacks of the selected threads until stopped or the duration ends
+        counts = {}
+        n_samples = 0
+        own_ident = threading.current_thread().ident
+        started = time.time()
+        end = started + self.duration
+
+        while not self.stop_event.is_set() and time.time() < end:
+            names = dict((thread.ident, thread.name) for thread in threading.enumerate())
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident)
+                if ident == own_ident or name is None:
+                    continue
+                if self.threads is not None and not any(name.startswith(t) for t in self.threads):
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('{}:{}'.format(os.path.basename(code.co_filename), code.co_name))
+                    frame = frame.f_back
+                stack.append(name)
+                key = ';'.join(reversed(stack))
+                counts[key] = counts.get(key, 0) + 1
+            n_samples += 1
+            self.stop_event.wait(self.interval)
+
+        try:
+            path = self.write(counts)
+            logging.warning('Profiler stopped after {:.0f} secs and {} samples, written to {}'.format(
+                time.time() - started, n_samples, path))
+        except (IOError, OSError) as e:
+            logging.error('Could not write profile: {}'.format(e))
+
+    def write(self, counts):
+        """
+        Write sampled stacks in collapsed stack format and stage the file for upload.
+
+        Args:
+            counts: A dictionary of sample counts keyed by collapsed stack
+        Returns:
+            The path of the profile.
+        """
+
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir)
+
+        path = os.path.join(self.profile_dir, 'profile_{}.folded'.format(
+            time.strftime('%Y%m%d_%H%M%S')))
+        with open(path + PART_SUFFIX, 'w') as outfile:
+            for key, count in sorted(counts.items()):
+                outfile.write('{} {}\n'.format(key, count))
+        os.rename(path + PART_SUFFIX, path)
+        record_staged(path, os.path.getsize(path), hash_file(path), {'sensor': 'profile'})
+
+        return path
+
+
+def install_signal_handlers(profiler, state=None):
+    """
+    Attach dump_stacks to SIGUSR1 and the profiler toggle to SIGUSR2. This must
+    be called from the main thread.
+
+    Args:
+        profiler: A SamplingProfiler instance
+        state: An optional function returning a dictionary of the pipeline state
+    """
+
+    signal.signal(signal.SIGUSR1, lambda signum, frame: dump_stacks(state))
+    signal.signal(signal.SIGUSR2, lambda signum, frame: profiler.toggle())
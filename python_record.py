@@ -1,18 +1,39 @@
 import os
 import sys
+import copy
 import time
 import subprocess
 import shutil
 import signal
+import sqlite3
 import threading
 from datetime import datetime
 import json
 import sensors
 import logging
+import clock
+from config_watcher import ConfigWatcher
+from supervisor import (Supervisor, heartbeat, run_command, running_commands, watchdog_enabled,
+                        watchdog_notify)
+from bundler import Bundler, bundle_options, bundle_staged_files
+from integrity import (Manifest, UPLOAD_LOCK_NAME, UploadLock, hash_file, record_staged,
+                       set_catalog, set_manifest, set_stage_listener)
+from catalog import Catalog
+from transports import configure_transport
+from governor import Governor, SysfsReader, governor_options, govern
+from profiler import SamplingProfiler, install_signal_handlers, profiler_options
+from quality import QualityController, quality_options
+from connectivity import LinkMonitor, link_options
+from realtime import UploadTrigger, realtime_options
+from health import HealthChecker, health_options
 
 # set a global name for a common logging for functions using this module
 LOG = 'rpi-eco-monitoring'
 
+# Seconds allowed beyond three sync intervals for a capture or sync loop to
+# send a heartbeat, covering the external command timeouts
+LOOP_STALL_MARGIN = 7200
+
 
 """
 Running the recording process uses the following functions, which users
@@ -24,10 +45,11 @@ Sensor setup and recording
 * record_sensor(sensor, wdir, udir, sleep=True) # initiates a single round of sampling
 
 FTP server sync
-* ftp_server_sync(ftp_config, udir) # rolling synchronisation, intended to run in thread
+* ftp_server_sync(interval, transport, udir, die) # rolling synchronisation, intended to run in thread
 
 Utility
 * clean_dirs(wdir, udir) # cleans out trash in wdir and udir
+* rebuild_sensor(sensor_config) # returns a new configured sensor or None on failure
 """
 
 
@@ -69,6 +91,52 @@ def configure_sensor(sensor_config):
     return sensor
 
 
+def rebuild_sensor(sensor_config):
+
+    """
+    Build a replacement sensor from new sensor config settings. Unlike
+    configure_sensor, failures are logged and do not exit, so that the
+    running sensor can be kept.
+    Args:
+        sensor_config: The sensor section of a validated config
+    Returns:
+        An instance of a sensor class or None if the sensor could not be set up.
+    """
+
+    try:
+        sensor_class = getattr(sensors, sensor_config['sensor_type'])
+        sensor = sensor_class(sensor_config)
+        if sensor.setup() is False:
+            raise EnvironmentError('setup returned False')
+    except Exception as e:
+        logging.error('Sensor rebuild failed, keeping running sensor: {}'.format(e))
+        return None
+
+    logging.info('Sensor rebuilt from new config')
+    return sensor
+
+
+def postprocess_sensor(sensor):
+
+    """
+    Function to run sensor postprocessing, waiting for an encoder slot when
+    the sensor has a resource governor
+    Args:
+        sensor: A sensor instance
+    """
+
+    governor = getattr(sensor, 'governor', None)
+    if governor is None:
+        sensor.postprocess()
+        return
+
+    governor.acquire_encoder()
+    try:
+        sensor.postprocess()
+    finally:
+        governor.release_encoder()
+
+
 def record_sensor(sensor, working_dir, upload_dir, sleep=True):
 
     """
@@ -82,7 +150,7 @@ def record_sensor(sensor, working_dir, upload_dir, sleep=True):
     """
 
     # Create daily folders to hold files during this recording session
-    start_date = time.strftime('%Y-%m-%d')
+    start_date = clock.strftime('%Y-%m-%d')
     session_working_dir = os.path.join(working_dir, start_date)
     session_upload_dir = os.path.join(upload_dir, start_date)
 
@@ -106,8 +174,13 @@ def record_sensor(sensor, working_dir, upload_dir, sleep=True):
     logging.info('Capturing data from sensor')
     sensor.capture_data(working_dir=session_working_dir, upload_dir=session_upload_dir)
 
-    # Postprocess the raw data in a separate thread
-    postprocess_t = threading.Thread(target=sensor.postprocess)
+    # Postprocess the raw data in a separate thread. This runs even when shutting
+    # down, so that captured data is flushed to upload within the shutdown timeout.
+    # Postprocessing may wait for an encoder, so it works on a copy of the sensor
+    # holding the details of this capture.
+    postprocess_t = threading.Thread(target=postprocess_sensor, args=(copy.copy(sensor),),
+                                     name='postprocess')
+    postprocess_t.daemon = True
     postprocess_t.start()
 
     # Let the sensor sleep
@@ -123,7 +196,7 @@ def exit_handler(signal, frame):
     :return:
     """
 
-    logging.info('SIGINT detected, shutting down')
+    logging.info('Signal {} detected, shutting down'.format(signal))
     # set the event to signal threads
     raise StopMonitoring
 
@@ -138,45 +211,116 @@ class StopMonitoring(Exception):
     pass
 
 
-def ftp_server_sync(sync_interval, ftp_config, upload_dir, die):
+def ftp_server_sync(sync_interval, transport, upload_dir, die, watcher=None, manifest=None,
+                    governor=None, catalog=None, quality=None, link=None, trigger=None,
+                    upload_lock=None):
 
     """
-    Function to synchronize the upload data folder with the FTP server
+    Function to synchronize the upload data folder with the server
 
     Parameters:
         sync_interval: The time interval between synchronisation connections
-        ftp_config: A dictionary holding the FTP configuration
+        transport: An instance of one of the upload transport classes
         upload_dir: The upload directory to synchronise (top level, not the device specific subdirectory)
         die: A threading event to terminate the ftp server sync
+        watcher: An optional ConfigWatcher, checked between transfers for new upload config
+        manifest: An optional Manifest. If provided, each sync uploads a batch manifest
+            and local files are only removed once verified on the server.
+        governor: An optional resource Governor, which can defer syncs
+        catalog: An optional Catalog, updated with the files uploaded by each sync
+        quality: An optional QualityController, updated with the backlog and the
+            throughput measured by each sync from the catalog, which it requires
+        link: An optional LinkMonitor, which skips syncs while the link is down
+        trigger: An optional UploadTrigger. If provided, syncs start as soon as
+            files are staged, and the time update runs once per sync interval.
+        upload_lock: An optional lock held while uploading and updating the
+            catalog, shared with the bundler so that it leaves files alone
+            while they are being transferred.
     """
 
-    # Build ftp string from configured details
-    if ftp_config['use_ftps']:
-        ftp_config['protocol'] = 'ftps'
-    else:
-        ftp_config['protocol'] = 'ftp'
+    if upload_lock is None:
+        upload_lock = threading.Lock()
 
-    ftp_string = '{protocol}://{uname}:{pword}@{host}'.format(**ftp_config)
+    config_version = 0
+    next_time_update = 0
 
     # keep running while the die is not set
     while not die.is_set():
-
-        start = time.time()
+        heartbeat()
+
+        # Pick up any new config between transfers
+        if watcher is not None:
+            new_config = watcher.changed(config_version)
+            if new_config is not None:
+                config_version, config = new_config
+                try:
+                    transport = configure_transport(config)
+                    sync_interval = watcher.sync_interval
+                    watcher.report_applied(config_version, 'upload transport')
+                except ValueError as e:
+                    logging.error('New upload config failed, keeping running transport: {}'.format(e))
+
+        start = clock.time()
+
+        if governor is not None and governor.defer_uploads():
+            logging.info('Governor: deferring sync')
+            die.wait(sync_interval)
+            continue
+
+        # Skip the time update and upload while the link is down, probing with
+        # backoff until it returns and then syncing straight away
+        if link is not None:
+            if not link.available(transport, die, sync_interval):
+                continue
+            start = clock.time()
 
         # Update time from internet
-        logging.info('Updating time from internet before ftp sync')
-        subprocess.call('bash ./bash_update_time.sh', shell=True)
-
-        logging.info('Started FTP sync at {}'.format(datetime.now()))
-        subprocess.call('bash ./ftp_upload.sh {} {}'.format(ftp_string, upload_dir), shell=True)
-        logging.info('Finished FTP sync at {}'.format(datetime.now()))
+        if trigger is None or clock.time() >= next_time_update:
+            logging.info('Updating time from internet before ftp sync')
+            run_command('bash ./bash_update_time.sh', timeout=330, die=die)
+            next_time_update = clock.time() + sync_interval
+
+        # Seal the files staged since the last sync into a batch manifest
+        if manifest is not None:
+            manifest.seal()
+
+        logging.info('Started {} sync at {}'.format(type(transport).__name__, clock.now()))
+        with upload_lock:
+            upload_start = clock.time()
+            uploaded = transport.upload(upload_dir, manifest, die) or []
+            upload_secs = clock.time() - upload_start
+            heartbeat()
+            if trigger is not None:
+                trigger.synced(uploaded)
+            if catalog is not None:
+                # Only the files the transport reports as sent are uploaded, and
+                # any others gone from the upload directory are missing
+                _, sent = catalog.mark_uploaded(uploaded)
+                catalog.reconcile()
+                if quality is not None:
+                    quality.update(catalog.backlog()[1], sent, upload_secs)
+        logging.info('Finished sync at {}'.format(clock.now()))
+        if link is not None:
+            metrics = link.metrics()
+            logging.info('Link uptime {:.1%}, {} probes, {} skipped syncs'.format(
+                metrics['uptime'], metrics['probes'], metrics['skipped_syncs']))
+        if trigger is not None:
+            metrics = trigger.metrics()
+            if metrics['measured']:
+                logging.info('Upload latency p50 {:.0f} secs, p90 {:.0f} secs, p99 {:.0f} secs '
+                             'over {} files'.format(metrics['p50'], metrics['p90'], metrics['p99'],
+                                                    metrics['measured']))
 
         # wait until the next sync interval
-        wait = sync_interval - (time.time() - start)
+        wait = sync_interval - (clock.time() - start)
         while wait < 0:
             wait += sync_interval
-        logging.info('Waiting {} secs to next sync'.format(wait))
-        time.sleep(wait)
+        if trigger is not None:
+            logging.info('Waiting up to {} secs for staged files'.format(wait))
+            trigger.wait(die, wait)
+        else:
+            logging.info('Waiting {} secs to next sync'.format(wait))
+            die.wait(wait)
 
 
 def clean_dirs(working_dir, upload_dir):
@@ -199,7 +343,8 @@ def clean_dirs(working_dir, upload_dir):
             shutil.rmtree(subdir, ignore_errors=True)
 
 
-def continuous_recording(sensor, working_dir, upload_dir, die):
+def continuous_recording(sensor, working_dir, upload_dir, die, watcher=None, governor=None,
+                         quality=None, health=None):
 
     """
     Runs a loop over the sensor sampling process
@@ -208,10 +353,36 @@ def continuous_recording(sensor, working_dir, upload_dir, die):
         working_dir: Path to the working directory for recording
         upload_dir: Path to the final directory used to upload processed files
         die: A threading event to terminate the ftp server sync
+        watcher: An optional ConfigWatcher, checked between captures for new sensor config
+        governor: An optional resource Governor, attached to the sensor
+        quality: An optional QualityController, attached to the sensor
+        health: An optional HealthChecker, attached to the sensor
     """
 
+    config_version = 0
+    sensor.die = die
+    sensor.governor = governor
+    sensor.quality = quality
+    sensor.health = health
+
     # Start recording
     while not die.is_set():
+        heartbeat()
+
+        # Rebuild the sensor between captures if the config has changed. A
+        # config version that fails to build is not retried.
+        if watcher is not None:
+            new_config = watcher.changed(config_version)
+            if new_config is not None:
+                config_version, config = new_config
+                new_sensor = rebuild_sensor(config['sensor'])
+                if new_sensor is not None:
+                    sensor = new_sensor
+                    sensor.die = die
+                    sensor.governor = governor
+                    sensor.quality = quality
+                    sensor.health = health
+                    watcher.report_applied(config_version, 'sensor')
 
         record_sensor(sensor, working_dir, upload_dir, sleep=True)
 
@@ -270,21 +441,33 @@ def record(config_file, logfile_name, log_dir='logs'):
         sys.exit()
 
     try:
-        ftp_config = config['ftp']
         sensor_config = config['sensor']
         offline_mode = config['offline_mode']
         working_dir = config['sys']['working_dir']
         upload_dir = config['sys']['upload_dir']
         reboot_time = config['sys']['reboot_time']
+        scheduled_reboot = config['sys'].get('scheduled_reboot', -1)
+        shutdown_timeout = config['sys'].get('shutdown_timeout', 60)
+        catalog_file = config['sys'].get('catalog_file', 'catalog.sqlite')
         logging.info('Config loaded')
     except KeyError:
         logging.info('Failed to load config')
         sys.exit()
 
-    # Schedule restart at reboot time, running in a separate process
-    logging.info('Scheduling restart for {}'.format(reboot_time))
-    cmd = '(sudo shutdown -c && shutdown -r {}) &'.format(reboot_time)
-    subprocess.call(cmd, shell=True)
+    # By default the daily reboot is only kept as a fallback to the supervisor
+    # when there is no service watchdog to restart a hung recorder. Setting it
+    # to 0 or 1 overrides this, and 0 cancels the backup reboot set by the
+    # startup script.
+    if scheduled_reboot < 0:
+        scheduled_reboot = 0 if watchdog_enabled() else 1
+    if scheduled_reboot:
+        # Schedule restart at reboot time, running in a separate process
+        logging.info('Scheduling restart for {}'.format(reboot_time))
+        cmd = '(sudo shutdown -c && shutdown -r {}) &'.format(reboot_time)
+    else:
+        logging.info('No daily restart scheduled, cancelling backup restart')
+        cmd = 'sudo shutdown -c'
+    run_command(cmd, timeout=30)
 
     # Check working directory
     if os.path.exists(working_dir) and os.path.isdir(working_dir):
@@ -314,6 +497,23 @@ def record(config_file, logfile_name, log_dir='logs'):
     # Clean directories
     clean_dirs(working_dir,upload_dir)
 
+    # Record checksums of staged files in manifests, used to verify uploads
+    if not offline_mode:
+        manifest = Manifest(upload_dir_pi)
+        set_manifest(manifest)
+    else:
+        manifest = None
+
+    # Keep a local catalog of all staged files and their upload state
+    try:
+        catalog = Catalog(catalog_file, upload_dir_pi)
+        set_catalog(catalog)
+        logging.info('Using {} as catalog'.format(catalog_file))
+    except sqlite3.Error as e:
+        # not critical - recording continues without the catalog
+        logging.error('Could not open catalog {}: {}'.format(catalog_file, e))
+        catalog = None
+
     # move any existing logs into the upload folder for this pi
     try:
         upload_dir_logs = os.path.join(upload_dir_pi, 'logs')
@@ -322,26 +522,142 @@ def record(config_file, logfile_name, log_dir='logs'):
 
         existing_logs = [f for f in os.listdir(log_dir) if f.endswith('.log') and f != logfile_name]
         for log in existing_logs:
-            os.rename(os.path.join(log_dir, log),
-                      os.path.join(upload_dir_logs, log))
+            staged_log = os.path.join(upload_dir_logs, log)
+            os.rename(os.path.join(log_dir, log), staged_log)
+            # logs are small, so hash them as they are staged
+            record_staged(staged_log, os.path.getsize(staged_log), hash_file(staged_log))
             logging.info('Moved {} to upload'.format(log))
-    except OSError:
+    except (IOError, OSError):
         # not critical - can leave logs in the log_dir
         logging.error('Could not move existing logs to upload.')
 
     # Now get the sensor
     sensor = configure_sensor(sensor_config)
 
-    # Set up the threads to run and an event handler to allow them to be shutdown cleanly
+    # Watch the config file for changes, also reloading on SIGHUP
+    watcher = ConfigWatcher(config_file, config)
+    signal.signal(signal.SIGHUP, watcher.request_reload)
+
+    # Set up the threads to run under a supervisor and an event handler to
+    # allow them to be shutdown cleanly
     die = threading.Event()
     signal.signal(signal.SIGINT, exit_handler)
-    
+    signal.signal(signal.SIGTERM, exit_handler)
+    supervisor = Supervisor(die)
+
+    # Optionally adapt to the device temperature and load
+    governor_opts = governor_options(config)
+    if governor_opts['enabled']:
+        reader = SysfsReader(governor_opts['sysfs_root'], governor_opts['battery_path'])
+        governor = Governor(reader, **dict((k, v) for k, v in governor_opts.items()
+                                           if k not in ['enabled', 'interval', 'sysfs_root',
+                                                        'battery_path']))
+        supervisor.add('governor', govern, args=(governor, governor_opts['interval'], die),
+                       stall_time=3 * governor_opts['interval'] + 600)
+    else:
+        governor = None
+
+    # Optionally adapt the encoding quality to the upload backlog
+    quality_opts = quality_options(config)
+    if quality_opts['enabled'] and not offline_mode and catalog is None:
+        logging.error('Adaptive quality needs the catalog, keeping the best quality')
+        quality = None
+    elif quality_opts['enabled'] and not offline_mode:
+        try:
+            quality = QualityController(**dict((k, v) for k, v in quality_opts.items()
+                                               if k != 'enabled'))
+        except ValueError as e:
+            logging.critical('Quality config failed: {}'.format(e))
+            sys.exit()
+    else:
+        quality = None
+
+    # Optionally probe the link before syncs, skipping them while it is down
+    link_opts = link_options(config)
+    if link_opts['enabled'] and not offline_mode:
+        link = LinkMonitor(**dict((k, v) for k, v in link_opts.items() if k != 'enabled'))
+    else:
+        link = None
+
+    # Optionally check the data quality of each capture, staging health records
+    health_opts = health_options(config)
+    if health_opts['enabled']:
+        health = HealthChecker(upload_dir_pi, **dict((k, v) for k, v in health_opts.items()
+                                                     if k != 'enabled'))
+    else:
+        health = None
+
+    # Optionally start syncs as soon as files are staged
+    realtime_opts = realtime_options(config)
+    if realtime_opts['enabled'] and not offline_mode:
+        trigger = UploadTrigger(**dict((k, v) for k, v in realtime_opts.items() if k != 'enabled'))
+        set_stage_listener(trigger.staged)
+    else:
+        trigger = None
+
+    # Held by the sync while it uploads, so that the bundler and transcode.py
+    # leave files alone
+    upload_lock = UploadLock(os.path.join(upload_dir_pi, UPLOAD_LOCK_NAME))
+
+    # Workers that go this long without a heartbeat are treated as hung. A
+    # capture or sync loop can take a full sync interval plus the command timeouts.
+    stall_time = 3 * sensor.server_sync_interval + LOOP_STALL_MARGIN
+
     if not offline_mode:
-        sync_thread = threading.Thread(target=ftp_server_sync, args=(sensor.server_sync_interval,
-                                                                     ftp_config, upload_dir, die))
-    
-    record_thread = threading.Thread(target=continuous_recording, args=(sensor, working_dir,
-                                                                    upload_dir_pi, die))
+        try:
+            transport = configure_transport(config)
+        except ValueError as e:
+            logging.critical('Upload config failed: {}'.format(e))
+            sys.exit()
+        supervisor.add('sync', ftp_server_sync, args=(sensor.server_sync_interval,
+                                                      transport, upload_dir, die, watcher,
+                                                      manifest, governor, catalog, quality,
+                                                      link, trigger, upload_lock),
+                       stall_time=stall_time)
+
+    supervisor.add('record', continuous_recording, args=(sensor, working_dir,
+                                                         upload_dir_pi, die, watcher, governor,
+                                                         quality, health),
+                   stall_time=stall_time)
+
+    # Optionally bundle small staged files to cut per-file upload overhead
+    bundle_opts = bundle_options(config)
+    if bundle_opts['enabled']:
+        bundler = Bundler(upload_dir_pi, small_file_size=bundle_opts['small_file_size'],
+                          max_bytes=bundle_opts['max_bytes'], max_age=bundle_opts['max_age'],
+                          settle_time=bundle_opts['settle_time'])
+        supervisor.add('bundle', bundle_staged_files, args=(bundler, bundle_opts['interval'], die,
+                                                            upload_lock),
+                       stall_time=3 * bundle_opts['interval'] + 600)
+
+    # On demand diagnostics: SIGUSR1 logs thread stacks and the pipeline state,
+    # SIGUSR2 toggles the sampling profiler
+    def pipeline_state():
+        state = {'workers': supervisor.status(),
+                 'commands': running_commands(),
+                 'config_version': watcher.version,
+                 'postprocessing': len([t for t in threading.enumerate()
+                                        if t.name == 'postprocess'])}
+        if governor is not None:
+            state['governor'] = {'level': governor.level, 'readings': governor.readings,
+                                 'encoders': governor.encoders}
+        if quality is not None:
+            state['quality'] = quality.status()
+        if link is not None:
+            state['link'] = link.metrics()
+        if trigger is not None:
+            state['upload_latency'] = trigger.metrics()
+        if health is not None:
+            state['health'] = health.status()
+        if catalog is not None:
+            state['catalog'] = catalog.status()
+        return state
+
+    profiler_opts = profiler_options(config)
+    profiler = SamplingProfiler(upload_dir_pi, interval=profiler_opts['interval'],
+                                duration=profiler_opts['duration'],
+                                threads=profiler_opts['threads'])
+    install_signal_handlers(profiler, pipeline_state)
 
     # Initialise background thread to do remote sync of the root upload directory
     # Failure here does not preclude data capture and might be temporary so log
@@ -349,30 +665,61 @@ def record(config_file, logfile_name, log_dir='logs'):
     try:
         # start the recorder
         logging.info('Starting continuous recording at {}'.format(datetime.now()))
-        record_thread.start()
-        
+        if governor is not None:
+            governor.update()
+            supervisor.start('governor')
+        supervisor.start('record')
+        if bundle_opts['enabled']:
+            logging.info('Bundling small files every {} seconds'.format(bundle_opts['interval']))
+            supervisor.start('bundle')
+        watchdog_notify('READY=1')
+
         if offline_mode:
             logging.info('Running in offline mode - no FTP synchronisation')
+            sync_start = None
+        elif trigger is not None:
+            # in low latency mode the sync waits for staged files itself
+            sync_start = time.time()
         else:
             # wait a while to allow make the two threads run out of sync
-            time.sleep(sensor.server_sync_interval/2)
-            # start the FTP sync
-            sync_thread.start()
-            logging.info('Starting FTP server sync every {} seconds at {}'.format(sensor.server_sync_interval, datetime.now()))
-        
+            sync_start = time.time() + sensor.server_sync_interval / 2
+
         # now run a loop that will continue with a small grain until
         # an interrupt arrives, this is necessary to keep the program live
-        # and listening for interrupts
+        # and listening for interrupts. The same loop polls for config changes,
+        # starts the FTP sync when due and supervises the threads.
         while True:
             time.sleep(1)
+            if watcher.check():
+                # a new sync interval changes how long the loops may take
+                stall_time = 3 * watcher.sync_interval + LOOP_STALL_MARGIN
+                for name in ['record', 'sync']:
+                    if name in supervisor.workers:
+                        supervisor.set_stall_time(name, stall_time)
+            if sync_start is not None and time.time() >= sync_start:
+                supervisor.start('sync')
+                logging.info('Starting FTP server sync every {} seconds at {}'.format(sensor.server_sync_interval, datetime.now()))
+                sync_start = None
+            supervisor.check()
     except StopMonitoring:
-        # We've had an interrupt signal, so tell the threads to shutdown,
-        # wait for them to finish and then exit the program
+        # We've had an interrupt signal, so tell the threads to shutdown, which
+        # stops captures, waits and uploads promptly. Then give the threads and
+        # any in-flight postprocessing until the shutdown timeout to finish.
         die.set()
-        record_thread.join()
-        if not offline_mode:
-            sync_thread.join()
-        
+        if trigger is not None:
+            trigger.stop()
+        deadline = time.time() + shutdown_timeout
+        supervisor.join(shutdown_timeout)
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                thread.join(max(deadline - time.time(), 0))
+
+        running = [t.name for t in threading.enumerate()
+                   if t is not threading.current_thread() and t.is_alive()]
+        if running:
+            logging.error('Threads still running after {} secs: {}'.format(
+                shutdown_timeout, ', '.join(running)))
+
         logging.info('Recording and sync shutdown, exiting at {}'.format(datetime.now()))
 
 
@@ -0,0 +1,133 @@
+import logging
+
+
+"""
+A feedback controller to adapt the audio encoding quality to the upload link,
+so that units with a poor uplink do not build up a backlog that never drains.
+After each sync the recorder reports, from the catalog, the bytes staged and
+not yet uploaded and the bytes the transport reported as sent in the time the
+sync took. Files moved into bundles, replaced or removed on the device are not
+counted as sent. The controller keeps a smoothed estimate of the link
+throughput, and from it the time the backlog would take to drain. The LAME VBR
+level used for each new recording is then stepped:
+
+* towards the worst_level when the drain time is over target_drain and the
+  backlog has not shrunk since the last sync
+* towards the best_level when the drain time is under half of target_drain
+
+LAME VBR levels run from 0 (best quality) to 9 (smallest files). Syncs that
+send nothing leave the throughput estimate unchanged, so a link that is down
+shows up as a growing backlog.
+"""
+
+# Typical average bitrates in kbps of the LAME VBR levels 0 to 9, giving the
+# relative size of a recording encoded at each level
+VBR_KBPS = [245, 225, 190, 175, 165, 130, 115, 100, 85, 65]
+
+# Defaults for the optional quality section of the config
+QUALITY_DEFAULTS = {'enabled': 0,
+                    'best_level': 0,
+                    'worst_level': 6,
+                    'target_drain': 3600,
+                    'smoothing': 0.3}
+
+
+def quality_options(config):
+    """
+    Get adaptive quality settings from the optional quality section of a
+    config, filling in defaults.
+
+    Args:
+        config: The full config dictionary
+    Returns:
+        A dictionary of adaptive quality settings.
+    """
+
+    opts = dict(QUALITY_DEFAULTS)
+    opts.update(config.get('quality', {}))
+    return opts
+
+
+class QualityController(object):
+
+    def __init__(self, best_level=0, worst_level=6, target_drain=3600, smoothing=0.3):
+        """
+        A class to choose the encoding quality of new recordings from the upload
+        backlog and the measured link throughput.
+
+        Args:
+            best_level: The LAME VBR level used when the link keeps up
+            worst_level: The LAME VBR level used at most when the backlog grows
+            target_drain: The longest time in seconds the backlog should take to
+                upload at the measured throughput
+            smoothing: The weight of each new throughput measurement, from 0 to 1
+        """
+
+        if not 0 <= best_level <= worst_level <= len(VBR_KBPS) - 1:
+            raise ValueError('Quality levels must be 0 <= best_level <= worst_level <= {}'.format(
+                len(VBR_KBPS) - 1))
+
+        self.best_level = best_level
+        self.worst_level = worst_level
+        self.target_drain = target_drain
+        self.smoothing = smoothing
+
+        self.level = best_level
+        self.throughput = None
+        self.backlog = None
+        self.drain_time = None
+
+    def update(self, backlog_bytes, sent_bytes, secs):
+        """
+        Update the throughput estimate after a sync and step the quality level,
+        logging any change.
+
+        Args:
+            backlog_bytes: The bytes staged and not yet uploaded after the sync
+            sent_bytes: The bytes uploaded by the sync
+            secs: The time in seconds the upload took
+        Returns:
+            The LAME VBR level to use for new recordings.
+        """
+
+        if sent_bytes > 0 and secs > 0:
+            rate = sent_bytes / float(secs)
+            if self.throughput is None:
+                self.throughput = rate
+            else:
+                self.throughput += self.smoothing * (rate - self.throughput)
+
+        if backlog_bytes == 0:
+            self.drain_time = 0.0
+        elif self.throughput:
+            self.drain_time = backlog_bytes / self.throughput
+        else:
+            self.drain_time = float('inf')
+
+        shrinking = self.backlog is not None and backlog_bytes < self.backlog
+        self.backlog = backlog_bytes
+
+        level = self.level
+        if self.drain_time > self.target_drain and not shrinking:
+            level = min(self.level + 1, self.worst_level)
+        elif self.drain_time < self.target_drain / 2.0:
+            level = max(self.level - 1, self.best_level)
+
+        if level != self.level:
+            logging.warning('Quality event: VBR level {} -> {} (backlog {:.1f} MB, throughput {}, '
+                            'drain time {:.0f} secs)'.format(
+                                self.level, level, backlog_bytes / 1e6,
+                                'unknown' if self.throughput is None else
+                                '{:.0f} B/s'.format(self.throughput), self.drain_time))
+            self.level = level
+
+        return self.level
+
+    def status(self):
+        """
+        Returns:
+            A dictionary of the current level, throughput estimate, backlog and drain time.
+        """
+
+        return {'level': self.level, 'throughput': self.throughput, 'backlog': self.backlog,
+                'drain_time': self.drain_time}
@@ -0,0 +1,178 @@
+import threading
+import logging
+import collections
+import clock
+from catalog import percentile
+
+
+"""
+A low latency upload mode. Rather than waiting for the next sync interval, the
+sync thread waits on an UploadTrigger, which record_staged() notifies as each
+file is staged (integrity.set_stage_listener). The sync then starts after a
+short batch_delay, so that files staged together go in one upload, and at most
+once every min_interval seconds. The time update still only runs once per sync
+interval.
+
+The trigger also measures the capture to remote latency of each file, from the
+end of its data (or its staging time) to the end of the sync that the transport
+reported sent it, and reports percentiles over the last window files. Files
+moved into a bundle are sent inside it, so with bundling the catalog
+(Catalog.upload_latency) gives the better measure. At most max_pending files
+are tracked, so a long outage drops the oldest rather than growing without
+bound.
+"""
+
+# Defaults for the optional realtime section of the config
+REALTIME_DEFAULTS = {'enabled': 0,
+                     'batch_delay': 10,
+                     'min_interval': 60,
+                     'window': 1000,
+                     'max_pending': 10000}
+
+
+def realtime_options(config):
+    """
+    Get low latency upload settings from the optional realtime section of a
+    config, filling in defaults.
+
+    Args:
+        config: The full config dictionary
+    Returns:
+        A dictionary of low latency upload settings.
+    """
+
+    opts = dict(REALTIME_DEFAULTS)
+    opts.update(config.get('realtime', {}))
+    return opts
+
+
+class UploadTrigger(object):
+
+    def __init__(self, event=None, batch_delay=10, min_interval=60, window=1000,
+                 max_pending=10000):
+        """
+        A class to start syncs as soon as files are staged and to measure the
+        capture to remote latency of each file.
+
+        Args:
+            event: The event set when a file is staged, by default a
+                threading.Event. The simulation passes a virtual clock event.
+            batch_delay: The time in seconds to wait for more files once one
+                has been staged
+            min_interval: The shortest time in seconds from the end of one sync
+                to the start of a triggered sync
+            window: The number of recent uploads latency percentiles are taken over
+            max_pending: The most staged files tracked until they are sent. The
+                oldest are dropped without a latency beyond this.
+        """
+
+        self.event = event if event is not None else threading.Event()
+        self.batch_delay = batch_delay
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.max_pending = max_pending
+        self.pending = collections.OrderedDict()
+        self.dropped = 0
+        self.latencies = collections.deque(maxlen=window)
+        self.last_sync = None
+        self.triggered_syncs = 0
+
+    def staged(self, path, info=None):
+        """
+        Record a staged file and wake the sync thread. This is the listener
+        passed to integrity.set_stage_listener().
+
+        Args:
+            path: The path of the staged file
+            info: The optional dictionary of details passed to record_staged(),
+                giving the end time of the data
+        """
+
+        capture_time = (info or {}).get('end')
+        with self.lock:
+            self.pending[path] = capture_time if capture_time is not None else clock.time()
+            if len(self.pending) > self.max_pending:
+                self.pending.popitem(last=False)
+                if not self.dropped:
+                    logging.warning('Over {} files waiting for upload, dropping the oldest from '
+                                    'the latency measures'.format(self.max_pending))
+                self.dropped += 1
+        self.event.set()
+
+    def stop(self):
+        """
+        Wake the sync thread on shutdown, once the die event has been set
+        """
+
+        self.event.set()
+
+    def wait(self, die, timeout):
+        """
+        Wait until a file is staged, then for the batch delay and the minimum
+        interval between syncs.
+
+        Args:
+            die: A threading event to stop waiting
+            timeout: The longest time in seconds to wait, normally the time to
+                the next regular sync
+        Returns:
+            A boolean showing if the wait ended with a staged file rather than
+            the timeout or die.
+        """
+
+        deadline = clock.time() + timeout
+        while not die.is_set():
+            remaining = deadline - clock.time()
+            if remaining <= 0:
+                return False
+            if self.event.wait(remaining):
+                break
+        if die.is_set():
+            return False
+        self.event.clear()
+
+        start = clock.time() + self.batch_delay
+        if self.last_sync is not None:
+            start = max(start, self.last_sync + self.min_interval)
+        if die.wait(max(min(start, deadline) - clock.time(), 0)):
+            return False
+
+        self.triggered_syncs += 1
+        return True
+
+    def synced(self, uploaded):
+        """
+        Record the end of a sync, taking the latency of each staged file sent.
+
+        Args:
+            uploaded: The paths of the files the transport reported as sent
+        """
+
+        now = clock.time()
+        self.last_sync = now
+        with self.lock:
+            for path in uploaded:
+                capture_time = self.pending.pop(path, None)
+                if capture_time is not None:
+                    self.latencies.append(now - capture_time)
+
+    def metrics(self):
+        """
+        Returns:
+            A dictionary of the number of files waiting, dropped and measured,
+            the triggered sync count and the 50th, 90th and 99th percentile and
+            maximum latencies in seconds.
+        """
+
+        with self.lock:
+            values = sorted(self.latencies)
+            waiting = len(self.pending)
+
+        return {'waiting': waiting,
+                'dropped': self.dropped,
+                'measured': len(values),
+                'triggered_syncs': self.triggered_syncs,
+                'p50': percentile(values, 0.5),
+                'p90': percentile(values, 0.9),
+                'p99': percentile(values, 0.99),
+                'max': values[-1] if values else None}
@@ -2,7 +2,8 @@
 
 printf '############################################\nStart of ecosystem monitoring startup script\n############################################\n'
 
-# just as a back up schedule a reboot for 24 hours (in case something goes wrong before scheduling the 2am reboot)
+# just as a back up schedule a reboot for 24 hours (in case something goes wrong before the recorder starts,
+# which then cancels it or replaces it with the optional daily reboot)
 (sudo shutdown -r +1440) &
 
 # One off expanding of filesystem to fill SD card
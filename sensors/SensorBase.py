@@ -4,9 +4,26 @@ import subprocess
 import os
 import sensors
 import logging
+import clock
 
 class SensorBase(object):
 
+    # A threading event set by the recorder on shutdown. Sensors should pass it to
+    # long running commands and waits so that they stop promptly.
+    die = None
+
+    # An optional resource governor set by the recorder, used to adapt to the
+    # device temperature and load
+    governor = None
+
+    # An optional quality controller set by the recorder, giving the encoding
+    # quality to use for new recordings from the upload backlog
+    quality = None
+
+    # An optional health checker set by the recorder, used to check the data
+    # quality of each capture and stage a health record
+    health = None
+
     def __init__(self, config=None):
 
         """
@@ -60,7 +77,7 @@ class SensorBase(object):
         """
         self.working_dir = working_dir
         self.upload_dir = upload_dir
-        self.current_file = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        self.current_file = clock.strftime('%Y-%m-%dT%H:%M:%S')
 
     def postprocess(self):
         pass
@@ -70,6 +87,13 @@ class SensorBase(object):
 
     def sleep(self):
         """
-        Method to pause between data capture
+        Method to pause between data capture, ending early on shutdown
         """
-        time.sleep(self.capture_delay)
+        delay = self.capture_delay
+        if self.governor is not None:
+            delay = self.governor.stretch_delay(delay)
+
+        if self.die is not None:
+            self.die.wait(delay)
+        else:
+            clock.sleep(delay)
@@ -1,10 +1,22 @@
 import datetime
 import time
-import subprocess
 import os
+import re
 import sensors
 import logging
 from sensors.SensorBase import SensorBase
+import tiers
+from supervisor import stream_command
+from integrity import (HashingWriter, PART_SUFFIX, PRIORITY_DIR, hash_file, record_staged,
+                       stage_output)
+from catalog import parse_name
+
+# Full resolution images held on the device end in the part suffix, so that
+# the transports, bundler and catalog all leave them alone. The hash taken as
+# the image was written is kept in the name, as <image>.jpg.<sha256>.held.part
+HELD_SUFFIX = '.held' + PART_SUFFIX
+HELD_NAME = re.compile(r'^(?P<image>.+?)(\.(?P<digest>[0-9a-f]{64}))?' +
+                       re.escape(HELD_SUFFIX) + '$')
 
 class TimelapseCamera(SensorBase):
 
@@ -27,6 +39,10 @@ class TimelapseCamera(SensorBase):
         # config options
         self.device = sensors.set_option('device', config, opts)
         self.capture_delay = sensors.set_option('capture_delay', config, opts)
+        self.resolution = sensors.set_option('resolution', config, opts)
+        self.tiers = tiers.parse_tiers(sensors.set_option('tiers', config, opts))
+        self.hold_full = sensors.set_option('hold_full', config, opts)
+        self.hold_warned = False
 
         # set internal variables and required class variables
         self.current_file = None
@@ -46,7 +62,23 @@ class TimelapseCamera(SensorBase):
                 {'name': 'capture_delay',
                  'type': float,
                  'default': 86400,
-                 'prompt': 'What is the interval in seconds between images?'}
+                 'prompt': 'What is the interval in seconds between images?'},
+                {'name': 'resolution',
+                 'type': str,
+                 'default': '2592x1944',
+                 'prompt': 'What resolution should images be captured at?'},
+                {'name': 'tiers',
+                 'type': str,
+                 'default': '',
+                 'prompt': 'What reduced resolution copies should be uploaded ahead of the '
+                           'full image (name:width:quality:priority separated by commas, '
+                           'blank for none)?'},
+                {'name': 'hold_full',
+                 'type': int,
+                 'default': 0,
+                 'valid': [0, 1],
+                 'prompt': 'Hold full resolution images on the device until requested or the link '
+                           'has capacity (1) or upload them all (0)?'}
                 ]
 
     def setup(self):
@@ -54,6 +86,10 @@ class TimelapseCamera(SensorBase):
         Method to check the sensor is ready for data capture
         """
 
+        if self.tiers and tiers.Image is None:
+            logging.error('PIL is required to make image tiers')
+            raise EnvironmentError
+
         if os.path.exists(self.device):
             return True
         else:
@@ -71,7 +107,8 @@ class TimelapseCamera(SensorBase):
         self.upload_dir = upload_dir
 
         # Name files by capture day and time
-        self.current_file = datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        capture_time = time.time()
+        self.current_file = datetime.datetime.fromtimestamp(capture_time).strftime('%Y-%m-%dT%H:%M:%S')
 
         # Record for a specific duration
         logging.info('\n{} - Started capture\n'.format(self.current_file))
@@ -79,9 +116,156 @@ class TimelapseCamera(SensorBase):
 
         # Name images by capture time
         logging.info('\nTaking picture - smile!\n')
-        res = '2592x1944'
 
-        # Delay and skip some frames to make sure exposure is adjusted to lighting
-        cmd = 'fswebcam -D 5 -S 20 -p YUYV -r {} {}'
-        subprocess.call(cmd.format(res, ofile + '.jpg'), shell=True)
+        # Delay and skip some frames to make sure exposure is adjusted to lighting.
+        # The image is written to stdout so that it is hashed as it is staged.
+        cmd = 'fswebcam -D 5 -S 20 -p YUYV -r {} -'.format(self.resolution)
+        holding = self.holding()
+        if holding:
+            # Keep the full image out of the upload queue until it is released
+            image = ofile + '.jpg' + HELD_SUFFIX
+            writer = HashingWriter(image)
+            try:
+                returncode = stream_command(cmd, 120, writer, die=self.die)
+            finally:
+                digest = writer.close()
+        else:
+            image = ofile + '.jpg'
+            returncode = stage_output(cmd, image, timeout=120, die=self.die,
+                                      info=self.catalog_info(capture_time))
+
+        if returncode == 0 and self.tiers:
+            self.stage_tiers(image, capture_time)
+
+        if self.health is not None:
+            flags, metrics = self.health.check_image(image, returncode)
+            self.health.report(type(self).__name__, self.current_file, capture_time, flags,
+                               metrics)
+
+        if holding and returncode != 0 and os.path.exists(image):
+            os.remove(image)
+        elif holding:
+            os.rename(image, '{}.jpg.{}{}'.format(ofile, digest, HELD_SUFFIX))
+        self.release_held()
+
+    def holding(self):
+        """
+        Method to check if full resolution images should be held. Held images
+        are released from the quality controller's estimate of the link capacity,
+        so without a controller they would never be sent, and are not held.
+
+        Returns:
+            A boolean showing if new images are held.
+        """
+
+        if not self.hold_full:
+            return False
+        if self.quality is None:
+            if not self.hold_warned:
+                logging.warning('Holding full resolution images needs adaptive quality '
+                                'enabled, uploading all images')
+                self.hold_warned = True
+            return False
+        return True
+
+    def catalog_info(self, capture_time, quality=None):
+        """
+        Method to describe an image for the catalog
+
+        Args:
+            capture_time: The time the image was taken
+            quality: The JPEG quality of a reduced resolution tier
+        """
+
+        return {'sensor': type(self).__name__, 'start': capture_time, 'end': capture_time,
+                'codec': 'jpeg', 'quality': quality}
+
+    def stage_tiers(self, image, capture_time):
+        """
+        Method to stage the reduced resolution tiers of an image in the priority
+        queue of each tier, making them all from a single decode.
+
+        Args:
+            image: The path of the full resolution image
+            capture_time: The time the image was taken
+        """
+
+        # Tiers go in priority/<n>/<day> beside the daily upload folders
+        device_dir, day = os.path.split(self.upload_dir)
+        outfiles = []
+        for tier in self.tiers:
+            tier_dir = os.path.join(device_dir, PRIORITY_DIR, str(tier['priority']), day)
+            if not os.path.exists(tier_dir):
+                os.makedirs(tier_dir)
+            fname = '{}_{}.jpg'.format(self.current_file, tier['name'])
+            outfiles.append(os.path.join(tier_dir, fname))
+
+        started = time.time()
+        try:
+            results = tiers.make_tiers(image, self.tiers, [f + PART_SUFFIX for f in outfiles])
+        except Exception as e:
+            logging.error('\n{} - Making image tiers failed: {}\n'.format(self.current_file, e))
+            for outfile in outfiles:
+                if os.path.exists(outfile + PART_SUFFIX):
+                    os.remove(outfile + PART_SUFFIX)
+            return
+
+        for tier, outfile, (width, height, size, digest) in zip(self.tiers, outfiles, results):
+            os.rename(outfile + PART_SUFFIX, outfile)
+            record_staged(outfile, size, digest, self.catalog_info(capture_time, tier['quality']))
+        logging.info('\n{} - Made {} image tiers in {:.2f} secs\n'.format(
+            self.current_file, len(results), time.time() - started))
+
+    def release_budget(self):
+        """
+        Method to find how much held data the link has capacity for, from the
+        quality controller's throughput and backlog drain time estimates.
+
+        Returns:
+            The number of bytes that can be released, which is 0 unless the
+            backlog would drain in under half of the target drain time.
+        """
+
+        quality = self.quality
+        if quality is None or quality.throughput is None or quality.drain_time is None:
+            return 0
+        return max((quality.target_drain / 2.0 - quality.drain_time) * quality.throughput, 0)
+
+    def release_held(self):
+        """
+        Method to move held full resolution images into the upload queue,
+        oldest first. All are released when hold_full is turned off, otherwise
+        only as many as the link has capacity for. Until the link throughput
+        has been measured, one image is released whenever the backlog is empty.
+        """
+
+        device_dir = os.path.dirname(self.upload_dir)
+        held = []
+        for subdir, dirs, fnames in os.walk(device_dir):
+            held.extend(os.path.join(subdir, fname) for fname in fnames
+                        if fname.endswith(HELD_SUFFIX))
+        if not held:
+            return
+
+        budget = self.release_budget() if self.holding() else None
+        unmeasured = (budget is not None and self.quality.throughput is None and
+                      self.quality.drain_time == 0)
+        released = 0
+        n_released = 0
+        for path in sorted(held):
+            size = os.path.getsize(path)
+            if budget is not None and released + size > budget and not (unmeasured and
+                                                                        n_released == 0):
+                break
+            match = HELD_NAME.match(os.path.basename(path))
+            ofile = os.path.join(os.path.dirname(path), match.group('image'))
+            os.rename(path, ofile)
+            # Images held before their hash was kept in the name are hashed again
+            digest = match.group('digest') or hash_file(ofile)
+            record_staged(ofile, size, digest, parse_name(os.path.basename(ofile)))
+            released += size
+            n_released += 1
 
+        if n_released:
+            logging.info('Released {} held images ({:.1f} MB) for upload, {} still held'.format(
+                n_released, released / 1e6, len(held) - n_released))
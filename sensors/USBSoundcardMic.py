@@ -1,9 +1,12 @@
 import time
-import subprocess
 import os
 import sensors
 import logging
 from sensors.SensorBase import SensorBase
+from supervisor import run_command, stream_command
+from integrity import HashingWriter, PART_SUFFIX, hash_file, record_staged
+from sensors import resample
+from health import AudioCheck
 
 class USBSoundcardMic(SensorBase):
 
@@ -26,10 +29,19 @@ class USBSoundcardMic(SensorBase):
         self.record_length = sensors.set_option('record_length', config, opts)
         self.compress_data = sensors.set_option('compress_data', config, opts)
         self.capture_delay = sensors.set_option('capture_delay', config, opts)
+        self.device = sensors.set_option('device', config, opts)
+        self.sample_rate = sensors.set_option('sample_rate', config, opts)
+        self.channels = sensors.set_option('channels', config, opts)
+        self.format = sensors.set_option('format', config, opts)
+        self.output_rate = sensors.set_option('output_rate', config, opts)
+        self.highpass = sensors.set_option('highpass', config, opts)
+        self.lowpass = sensors.set_option('lowpass', config, opts)
 
         # set internal variables and required class variables
         self.working_file = 'currentlyRecording.wav'
         self.current_file = None
+        self.start_time = None
+        self.end_time = None
         self.working_dir = None
         self.upload_dir = None
         self.server_sync_interval = self.record_length + self.capture_delay
@@ -50,14 +62,78 @@ class USBSoundcardMic(SensorBase):
                 {'name': 'capture_delay',
                  'type': int,
                  'default': 0,
-                 'prompt': 'How long should the system wait between audio samples?'}
+                 'prompt': 'How long should the system wait between audio samples?'},
+                {'name': 'device',
+                 'type': str,
+                 'default': 'hw:1,0',
+                 'prompt': 'What is the ALSA device of the soundcard?'},
+                {'name': 'sample_rate',
+                 'type': int,
+                 'default': 44100,
+                 'prompt': 'What is the capture sample rate in Hz?'},
+                {'name': 'channels',
+                 'type': int,
+                 'default': 1,
+                 'prompt': 'How many channels should be recorded?'},
+                {'name': 'format',
+                 'type': str,
+                 'default': 'S16_LE',
+                 'valid': ['S16_LE', 'S24_3LE', 'S32_LE'],
+                 'prompt': 'What is the capture sample format?'},
+                {'name': 'output_rate',
+                 'type': int,
+                 'default': 0,
+                 'prompt': 'What sample rate in Hz should audio be resampled to (0 to keep the capture rate)?'},
+                {'name': 'highpass',
+                 'type': int,
+                 'default': 0,
+                 'prompt': 'What is the lower edge of the kept band in Hz (0 for none)?'},
+                {'name': 'lowpass',
+                 'type': int,
+                 'default': 0,
+                 'prompt': 'What is the upper edge of the kept band in Hz (0 for none)?'}
                 ]
 
+    def filtering(self):
+        """
+        Returns:
+            A boolean showing if audio is resampled or band-pass filtered before encoding.
+        """
+
+        return bool((self.output_rate and self.output_rate != self.sample_rate) or
+                    self.highpass or self.lowpass)
+
+    @staticmethod
+    def compress_command(wfile, ofile, channels=1, fast=False, level=0):
+        """
+        Static method building the avconv command to compress a WAV file to VBR mp3.
+        The fast option uses the fastest encoder algorithm, which keeps the same
+        VBR quality target. The VBR level is also written to the mp3 comment tag.
+
+        Args:
+            wfile: The path of the WAV file
+            ofile: The path of the mp3 file to write
+            channels: The number of channels to encode, at most two
+            fast: Should the fastest encoder algorithm be used
+            level: The LAME VBR level, from 0 (best quality) to 9 (smallest files)
+        Returns:
+            The command string.
+        """
+
+        effort = '-compression_level 9 ' if fast else ''
+        cmd = ('avconv -loglevel panic -i {} -codec:a libmp3lame -filter:a "volume=5" '
+               '-qscale:a {} {}-ac {} -metadata comment="VBR level {}" -f mp3 {} >/dev/null 2>&1')
+        return cmd.format(wfile, level, effort, min(channels, 2), level, ofile)
+
     def setup(self):
 
+        if self.filtering() and resample.np is None:
+            logging.error('NumPy is required to resample or filter audio')
+            raise EnvironmentError
+
         try:
             # Load alsactl file - increased microphone volume level
-            subprocess.call('alsactl --file ./audio_sensor_scripts/asound.state restore', shell=True)
+            run_command('alsactl --file ./audio_sensor_scripts/asound.state restore', timeout=30)
             return True
         except:
             raise EnvironmentError
@@ -76,7 +152,8 @@ class USBSoundcardMic(SensorBase):
         self.upload_dir = upload_dir
 
         # Name files by start time and duration
-        start_time = time.strftime('%H-%M-%S')
+        self.start_time = time.time()
+        start_time = time.strftime('%H-%M-%S', time.localtime(self.start_time))
         self.current_file = '{}_dur={}secs'.format(start_time, self.record_length)
 
         # Record for a specific duration
@@ -84,17 +161,50 @@ class USBSoundcardMic(SensorBase):
         wfile = os.path.join(self.working_dir, self.working_file)
         ofile = os.path.join(self.working_dir, self.current_file)
         try:
-            cmd = 'sudo arecord --device hw:1,0 --rate 44100 --format S16_LE --duration {} {}'
-            subprocess.call(cmd.format(self.record_length, wfile), shell=True)
+            # Record to stdout, hashing the raw audio as it is written
+            cmd = 'sudo arecord --device {} --rate {} --format {} --channels {} --duration {}'
+            cmd = cmd.format(self.device, self.sample_rate, self.format, self.channels,
+                             self.record_length)
+            writer = HashingWriter(wfile)
+            # Check the data quality of the audio as it is written
+            check = AudioCheck(writer) if self.health is not None else writer
+            try:
+                stream_command(cmd, self.record_length + 60, check, die=self.die)
+            finally:
+                self.uncomp_digest = check.close()
+                self.uncomp_size = writer.size
+                self.end_time = time.time()
             self.uncomp_file = ofile + '.wav'
             os.rename(wfile, self.uncomp_file)
+            if self.health is not None:
+                # A recording cut short by shutdown is not truncated
+                stopped = self.die is not None and self.die.is_set()
+                metrics = check.metrics()
+                flags = self.health.audio_flags(metrics, None if stopped else self.record_length)
         except Exception:
             logging.info('Error recording from audio card. Creating dummy file')
             open(ofile + '_ERROR_audio-record-failed', 'a').close()
+            flags, metrics = ['record_failed'], {}
             time.sleep(1)
 
+        if self.health is not None:
+            self.health.report(type(self).__name__, self.current_file, self.start_time, flags,
+                               metrics)
+
         logging.info('\n{} - Finished recording\n'.format(self.current_file))
 
+    def catalog_info(self, codec, quality=None):
+        """
+        Method to describe the current recording for the catalog
+
+        Args:
+            codec: The codec of the staged file
+            quality: The encoder quality level, if compressed
+        """
+
+        return {'sensor': type(self).__name__, 'start': self.start_time,
+                'end': self.end_time, 'codec': codec, 'quality': quality}
+
     def postprocess(self):
         """
         Method to optionally compress raw audio data to mp3 format and stage data to
@@ -104,18 +214,65 @@ class USBSoundcardMic(SensorBase):
         # current working file
         wfile = self.uncomp_file
 
+        if self.filtering():
+            # Resample and band-pass the raw audio in chunks before encoding
+            rfile = os.path.join(self.working_dir, self.current_file) + '_resampled.wav'
+            logging.info('\n{} - Starting resampling\n'.format(self.current_file))
+            try:
+                resample.resample_wav(wfile, rfile, self.output_rate, self.highpass, self.lowpass)
+                os.remove(wfile)
+                wfile = rfile
+                self.uncomp_size = os.path.getsize(wfile)
+                self.uncomp_digest = hash_file(wfile)
+            except Exception as e:
+                logging.error('\n{} - Resampling failed, keeping raw audio: {}\n'.format(
+                    self.current_file, e))
+                if os.path.exists(rfile):
+                    os.remove(rfile)
+
         if self.compress_data == True:
             # Compress the raw audio file to mp3 format
             ofile = os.path.join(self.upload_dir, self.current_file) + '.mp3'
 
             logging.info('\n{} - Starting compression\n'.format(self.current_file))
-            cmd = ('avconv -loglevel panic -i {} -codec:a libmp3lame -filter:a "volume=5" '
-                   '-qscale:a 0 -ac 1 {} >/dev/null 2>&1')
-            subprocess.call(cmd.format(wfile, ofile), shell=True)
+            # avconv writes the output itself, so that the VBR header can be
+            # rewritten once encoding ends. The hash is then taken from the
+            # freshly written file, which is still in the page cache, so this
+            # costs about the same as hashing while writing (hash_benchmark.py).
+            # When the governor reports the device is hot or loaded, use the fastest
+            # encoder algorithm
+            fast = self.governor is not None and self.governor.fast_compression()
+            # Lower the VBR quality when the upload backlog is not draining
+            level = self.quality.level if self.quality is not None else 0
+            cmd = self.compress_command(wfile, ofile + PART_SUFFIX, self.channels, fast, level)
+            returncode = run_command(cmd, timeout=max(self.record_length, 600))
+            if returncode == 0:
+                os.rename(ofile + PART_SUFFIX, ofile)
+                record_staged(ofile, os.path.getsize(ofile), hash_file(ofile),
+                              self.catalog_info('mp3', level))
+                os.remove(wfile)
+            else:
+                # Stage the raw audio rather than leave it in the working directory,
+                # which is cleared at startup. transcode.py can compress it later.
+                logging.error('\n{} - Compression failed, staging raw audio\n'.format(self.current_file))
+                if os.path.exists(ofile + PART_SUFFIX):
+                    os.remove(ofile + PART_SUFFIX)
+                self.stage_wav(wfile)
             logging.info('\n{} - Finished compression\n'.format(self.current_file))
 
         else:
             # Don't compress, store as wav
             logging.info('\n{} - No postprocessing of audio data\n'.format(self.current_file))
-            ofile = os.path.join(self.upload_dir, self.current_file) + '.wav'
-            os.rename(wfile, ofile)
+            self.stage_wav(wfile)
+
+    def stage_wav(self, wfile):
+        """
+        Method to stage uncompressed audio to the upload folder
+
+        Args:
+            wfile: The path of the WAV file in the working directory
+        """
+
+        ofile = os.path.join(self.upload_dir, self.current_file) + '.wav'
+        os.rename(wfile, ofile)
+        record_staged(ofile, self.uncomp_size, self.uncomp_digest, self.catalog_info('wav'))
@@ -1,10 +1,11 @@
 import uuid
 import time
+import calendar
 import os
-import subprocess
 import sensors
 import logging
 from sensors.SensorBase import SensorBase
+from integrity import stage_output
 
 class UnixDevice(SensorBase):
     """
@@ -40,6 +41,7 @@ class UnixDevice(SensorBase):
 
         # starting values for other class variables
         self.start_time = None
+        self.end_time = None
         self.uncompressed_file = None
         self.working_dir = None
         self.upload_dir = None
@@ -123,13 +125,17 @@ class UnixDevice(SensorBase):
             data = datastream.read(self.sample_size)
             outfile.write('{}: {}\n'.format(now, data))
 
-            # wait and increment the counter
-            time.sleep(self.sample_rate)
+            # wait and increment the counter, stopping early on shutdown
+            if self.die is None:
+                time.sleep(self.sample_rate)
+            elif self.die.wait(self.sample_rate):
+                break
             n_samples += 1
 
         # tidy up and hand off to post processing
         outfile.close()
         datastream.close()
+        self.end_time = time.time()
 
     def postprocess(self):
         """
@@ -144,6 +150,9 @@ class UnixDevice(SensorBase):
 
         zipfile = 'final_{}.zip'.format(time.strftime('%d%m%Y_%H%M%S', self.start_time))
         logging.info('Zipping samples from {} to {}'.format(self.device, zipfile))
-        subprocess.call(["zip", os.path.join(self.upload_dir, zipfile), self.uncompressed_file])
+        info = {'sensor': type(self).__name__, 'start': calendar.timegm(self.start_time),
+                'end': self.end_time, 'codec': 'zip'}
+        stage_output(["zip", "-", self.uncompressed_file], os.path.join(self.upload_dir, zipfile),
+                     timeout=60, shell=False, info=info)
         os.remove(self.uncompressed_file)
 
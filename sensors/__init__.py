@@ -28,6 +28,12 @@ def set_option(var, config, opts):
 
     # check if there is a config value of the right type
     val_type = this_opt['type']
+    if val_type is str:
+        # JSON strings load as unicode under Python 2, so accept either
+        try:
+            val_type = basestring
+        except NameError:
+            pass
     if config is not None and var in config:
         if isinstance(config[var], val_type):
             use_default = False
@@ -0,0 +1,245 @@
+import math
+import wave
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+"""
+Streaming polyphase resampling and band-pass filtering of WAV files, used by
+USBSoundcardMic to reduce the sample rate and bandwidth of audio before
+encoding. Audio is processed in fixed size chunks, so memory use is bounded
+regardless of the recording length. Requires NumPy.
+"""
+
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+
+class PolyphaseResampler(object):
+
+    def __init__(self, in_rate, out_rate, channels=1, highpass=0.0, lowpass=0.0,
+                 taps_per_phase=None, rolloff=0.9, beta=8.6, max_taps=2048,
+                 block_size=1 << 21):
+        """
+        A class to resample a stream of audio by a rational factor with an
+        optional band-pass, using a Kaiser windowed sinc FIR filter split into
+        polyphase components. Each call to process() takes the next chunk of
+        input and returns the output samples it completes.
+
+        Args:
+            in_rate: The input sample rate in Hz
+            out_rate: The output sample rate in Hz
+            channels: The number of interleaved channels
+            highpass: The lower edge of the pass band in Hz, or 0 for none
+            lowpass: The upper edge of the pass band in Hz, or 0 to use the
+                Nyquist frequency of the lower of the two rates
+            taps_per_phase: The number of filter taps applied per output sample.
+                By default this is set from the transition width needed by the
+                anti-aliasing filter and high pass edge, up to max_taps.
+            rolloff: The fraction of the Nyquist frequency kept by the
+                anti-aliasing filter
+            beta: The Kaiser window parameter, trading transition width for
+                stop band attenuation (8.6 gives around 80 dB)
+            max_taps: The maximum number of taps per phase
+            block_size: The maximum number of values gathered at once, bounding
+                the memory used per chunk
+        """
+
+        if np is None:
+            raise ImportError('NumPy is required for resampling')
+
+        common = _gcd(in_rate, out_rate)
+        self.up = out_rate // common
+        self.down = in_rate // common
+        self.channels = channels
+        self.block_size = block_size
+
+        # Kaiser's estimate of the filter length for the narrowest transition band
+        nyquist = 0.5 * min(in_rate, out_rate)
+        transition = 2 * nyquist * (1 - rolloff)
+        if highpass > 0:
+            transition = min(transition, highpass / 2.0)
+        if taps_per_phase is None:
+            attenuation = beta / 0.1102 + 8.7
+            taps_per_phase = int(math.ceil((attenuation - 7.95) * in_rate /
+                                           (2.285 * 2 * math.pi * transition)))
+            taps_per_phase = min(taps_per_phase, max_taps)
+        self.taps = taps_per_phase
+
+        # Design the filter at the upsampled rate, as the difference of two
+        # low pass filters when a high pass edge is set
+        pass_edge = nyquist * rolloff
+        high_edge = min(lowpass, pass_edge) if lowpass > 0 else pass_edge
+        up_rate = float(in_rate * self.up)
+        n_taps = self.taps * self.up
+
+        # Centre the filter on a multiple of down, so that its delay is a whole
+        # number of output samples
+        self.delay = (n_taps - 1) // (2 * self.down)
+        n = np.arange(n_taps) - self.delay * self.down
+
+        def lowpass_kernel(edge):
+            cutoff = edge / up_rate
+            return 2 * cutoff * np.sinc(2 * cutoff * n)
+
+        h = lowpass_kernel(high_edge)
+        if highpass > 0:
+            h -= lowpass_kernel(highpass)
+        h *= np.kaiser(n_taps, beta) * self.up
+
+        # Phase p holds taps p, p + up, p + 2 * up, ... applied to the most
+        # recent input samples first
+        self.phases = h.reshape(self.taps, self.up).T.copy()
+
+        # Stream state: the last taps - 1 input samples, the absolute index of
+        # the next input sample and the index of the next output sample
+        self.history = np.zeros((self.taps - 1, channels))
+        self.in_pos = 0
+        self.out_pos = 0
+
+    def process(self, chunk):
+        """
+        Filter the next chunk of input.
+
+        Args:
+            chunk: A float array of shape (samples, channels)
+        Returns:
+            A float array of the completed output samples.
+        """
+
+        buf = np.concatenate([self.history, chunk])
+        in_end = self.in_pos + len(chunk)
+
+        # Output n is centred on input (n * down) // up, so take all outputs
+        # whose newest input sample is in this chunk
+        last_out = (in_end * self.up - 1) // self.down
+        out_idx = np.arange(self.out_pos, last_out + 1)
+        base = (out_idx * self.down) // self.up
+        phase = (out_idx * self.down) % self.up
+
+        # Gather the input windows for blocks of outputs: (outputs, taps, channels)
+        offsets = base - self.in_pos + self.taps - 1
+        taps = np.arange(self.taps)
+        block = max(self.block_size // (self.taps * self.channels), 1)
+        out = np.empty((len(out_idx), self.channels))
+        for start in range(0, len(out_idx), block):
+            stop = start + block
+            windows = buf[offsets[start:stop, None] - taps[None, :]]
+            out[start:stop] = np.einsum('ntc,nt->nc', windows, self.phases[phase[start:stop]])
+
+        self.history = buf[len(buf) - (self.taps - 1):]
+        self.in_pos = in_end
+        self.out_pos = last_out + 1
+
+        return out
+
+    def flush(self):
+        """
+        Push zeros through the filter to return the output delayed by the filter.
+
+        Returns:
+            A float array of the remaining output samples.
+        """
+
+        n_zeros = int(math.ceil(self.delay * self.down / float(self.up))) + 1
+        return self.process(np.zeros((n_zeros, self.channels)))
+
+
+def _decode(frames, sampwidth, channels):
+    # Convert little endian PCM bytes to floats in [-1, 1)
+    if sampwidth == 1:
+        data = (np.frombuffer(frames, dtype=np.uint8).astype(np.float64) - 128) / 128.0
+    elif sampwidth == 2:
+        data = np.frombuffer(frames, dtype='<i2') / 32768.0
+    elif sampwidth == 3:
+        raw = np.frombuffer(frames, dtype=np.uint8).reshape(-1, 3).astype(np.int32)
+        ints = raw[:, 0] | (raw[:, 1] << 8) | (raw[:, 2] << 16)
+        ints[ints >= 1 << 23] -= 1 << 24
+        data = ints / float(1 << 23)
+    elif sampwidth == 4:
+        data = np.frombuffer(frames, dtype='<i4') / float(1 << 31)
+    else:
+        raise ValueError('Unsupported sample width {}'.format(sampwidth))
+
+    return data.reshape(-1, channels)
+
+
+def _encode(data, sampwidth):
+    # Convert floats to little endian PCM bytes, clipping to the valid range
+    data = np.clip(data.ravel(), -1.0, 1.0)
+    if sampwidth == 1:
+        return np.round(data * 127 + 128).astype(np.uint8).tobytes()
+    elif sampwidth == 2:
+        return np.round(data * 32767).astype('<i2').tobytes()
+    elif sampwidth == 3:
+        ints = np.round(data * ((1 << 23) - 1)).astype('<i4')
+        return ints.view(np.uint8).reshape(-1, 4)[:, :3].tobytes()
+    elif sampwidth == 4:
+        return np.round(data * ((1 << 31) - 1)).astype('<i4').tobytes()
+    else:
+        raise ValueError('Unsupported sample width {}'.format(sampwidth))
+
+
+def resample_wav(infile, outfile, out_rate=0, highpass=0.0, lowpass=0.0, chunk_frames=65536):
+    """
+    Resample and band-pass filter a WAV file in chunks.
+
+    Args:
+        infile: The path of the input WAV file
+        outfile: The path of the output WAV file
+        out_rate: The output sample rate in Hz, or 0 to keep the input rate
+        highpass: The lower edge of the pass band in Hz, or 0 for none
+        lowpass: The upper edge of the pass band in Hz, or 0 for none
+        chunk_frames: The number of input frames processed at a time
+    Returns:
+        The number of output frames written.
+    """
+
+    reader = wave.open(infile, 'rb')
+    writer = wave.open(outfile, 'wb')
+    n_out = 0
+    try:
+        channels = reader.getnchannels()
+        sampwidth = reader.getsampwidth()
+        in_rate = reader.getframerate()
+        out_rate = out_rate or in_rate
+
+        writer.setnchannels(channels)
+        writer.setsampwidth(sampwidth)
+        writer.setframerate(out_rate)
+
+        resampler = PolyphaseResampler(in_rate, out_rate, channels, highpass, lowpass)
+
+        # Trim the filter delay from the start of the output
+        delay = resampler.delay
+        expected = reader.getnframes() * resampler.up // resampler.down
+
+        while True:
+            frames = reader.readframes(chunk_frames)
+            if not frames:
+                out = resampler.flush()
+            else:
+                out = resampler.process(_decode(frames, sampwidth, channels))
+            if delay:
+                trim = min(delay, len(out))
+                out = out[trim:]
+                delay -= trim
+            out = out[:max(expected - n_out, 0)]
+            writer.writeframes(_encode(out, sampwidth))
+            n_out += len(out)
+            if not frames:
+                break
+    finally:
+        reader.close()
+        writer.close()
+
+    logging.info('Resampled {} to {} Hz, band {}-{} Hz'.format(infile, out_rate, highpass,
+                                                               lowpass or out_rate / 2))
+    return n_out
@@ -3,6 +3,7 @@ import json
 import os
 import sys
 import sensors
+import transports
 import inspect
 
 
@@ -135,33 +136,33 @@ offline_config = {}
 for option in offline_options:
     config_parse(option, offline_config)
 
-# Populate the FTP config unless the user has chosen offline mode
+# Populate the upload config unless the user has chosen offline mode. FTP
+# details go in the ftp section, other transports in the transport section.
 
 ftp_config = {}
+transport_config = {}
 
 if not offline_config['offline_mode']:
 
-    ftp_config_options = [
-                  {'name': 'uname',
-                   'type': str,
-                   'prompt': 'Enter FTP server username'},
-                  {'name': 'pword',
-                   'type': str,
-                   'prompt': 'Enter FTP server password'},
-                  {'name': 'host',
-                   'type': str,
-                   'prompt': 'Enter FTP server hostname'},
-                  {'name': 'use_ftps',
-                   'type': int,
-                   'prompt': 'Use FTPS (1) or FTP (0)?',
-                   'default': 1,
-                   'valid': [0, 1]}]
-
-    print("\nNow let's do the FTP server details...")
-
-    # populate the ftp config dictionary
-    for option in ftp_config_options:
-        config_parse(option, ftp_config)
+    config_parse({'name': 'type',
+                  'type': str,
+                  'prompt': 'Upload data by FTP or HTTP?',
+                  'default': 'ftp',
+                  'valid': sorted(transports.TRANSPORT_TYPES.keys())}, transport_config)
+
+    transport_class = transports.TRANSPORT_TYPES[transport_config['type']]
+    if transport_config['type'] == 'ftp':
+        transport_config = {}
+        upload_config = ftp_config
+    else:
+        upload_config = transport_config
+
+    print("\nNow let's do the upload server details...")
+
+    # populate the upload config dictionary, leaving structured options at their defaults
+    for option in transport_class.options():
+        if option['type'] is not dict:
+            config_parse(option, upload_config)
 
 # Popualte the system config options
 sys_config_options = [
@@ -173,6 +174,12 @@ sys_config_options = [
                'type': str,
                'prompt': 'Enter the upload directory path',
                'default': '/home/pi/continuous_monitoring_data'},
+              {'name': 'scheduled_reboot',
+               'type': int,
+               'prompt': 'Should the device also reboot daily as a fallback (1), rely on the recorder '
+                         'supervisor (0) or reboot only when not run as a systemd service (-1)?',
+               'default': -1,
+               'valid': [-1, 0, 1]},
               {'name': 'reboot_time',
                'type': str,
                'prompt': 'Enter the time for the daily reboot',
@@ -187,6 +194,8 @@ for option in sys_config_options:
 
 config = {'ftp': ftp_config, 'offline_mode': offline_config['offline_mode'],
           'sensor': sensor_config, 'sys': sys_config}
+if transport_config:
+    config['transport'] = transport_config
 
 # save the config
 with open(config_file, 'w') as fp:
@@ -0,0 +1,814 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import hashlib
+import tempfile
+import argparse
+import threading
+import logging
+import clock
+import sensors
+from sensors.SensorBase import SensorBase
+from transports.TransportBase import TransportBase
+from supervisor import run_command, set_command_runner
+from integrity import Manifest, record_staged, set_catalog, set_manifest, set_stage_listener
+from catalog import Catalog, parse_time, format_time
+from quality import QualityController, VBR_KBPS, quality_options
+from connectivity import LinkMonitor, link_options
+from realtime import UploadTrigger, realtime_options
+from python_record import clean_dirs, continuous_recording, ftp_server_sync
+
+
+"""
+A simulation mode to replay days of recorder operation in seconds. The
+continuous_recording() and ftp_server_sync() loops from python_record.py run
+unchanged in their threads, but against a virtual clock, with a simulated
+sensor, fake external commands and a simulated uploader. Files are written as
+sparse files in a temporary directory, so they take up little real disk space.
+
+The virtual clock only moves forward once every thread is waiting on it, and
+then wakes the threads one at a time in order of their wake time and name, so a
+run is deterministic for a given seed. The simulation reports the coverage of
+the recorded data, the upload backlog and the disk usage over simulated time:
+
+    python simulation.py --days 7 --availability 0.8 --output report.json
+    python simulation.py config.json --days 14 --bandwidth 20000
+    python simulation.py --days 7 --bandwidth 15000 --adaptive-quality
+    python simulation.py --days 7 --availability 0.7 --outage-length 7200 --link-monitor
+    python simulation.py config.json --days 7 --realtime
+"""
+
+SIMULATED_PI_ID = 'SIMULATED'
+
+
+class VirtualEvent(object):
+
+    def __init__(self, clock):
+        """
+        A replacement for threading.Event whose waits run on a virtual clock,
+        used as the die event of the simulated recorder.
+
+        Args:
+            clock: A VirtualClock instance
+        """
+
+        self.clock = clock
+        self.flag = False
+
+    def is_set(self):
+        return self.flag
+
+    def set(self):
+        with self.clock.cond:
+            self.flag = True
+            self.clock.cond.notify_all()
+
+    def clear(self):
+        self.flag = False
+
+    def wait(self, timeout=None):
+        self.clock.wait_until(self.is_set, timeout)
+        return self.flag
+
+
+class VirtualClock(object):
+
+    def __init__(self, start, poll=0.001):
+        """
+        A clock for set_clock() that advances virtual time instead of sleeping.
+        Waiting threads are recorded with their wake time. Once every running
+        thread is waiting, the first thread whose condition is met, or otherwise
+        the thread with the earliest wake time, is woken and time moves to its
+        wake time. Ties are broken by thread name and then by the order of the
+        waits, so that threads run one at a time in a repeatable order.
+
+        Args:
+            start: The starting virtual time in seconds since the epoch
+            poll: The real time in seconds between checks for exited threads
+        """
+
+        self.now = float(start)
+        self.poll = poll
+        self.cond = threading.Condition()
+        self.waiting = []
+        self.seq = 0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.wait_until(None, secs)
+
+    def event(self):
+        """
+        Returns:
+            A new VirtualEvent on this clock.
+        """
+
+        return VirtualEvent(self)
+
+    def join(self, thread, timeout=None):
+        """
+        Wait for a thread to finish, letting virtual time run meanwhile.
+
+        Args:
+            thread: The thread to wait for
+            timeout: An optional limit in virtual seconds
+        """
+
+        self.wait_until(lambda: not thread.is_alive(), timeout)
+
+    def wait_until(self, condition=None, timeout=None):
+        """
+        Wait until a condition is met or a timeout passes in virtual time.
+
+        Args:
+            condition: An optional function returning True to end the wait
+            timeout: An optional limit in virtual seconds
+        """
+
+        with self.cond:
+            waiter = {'wake': None if timeout is None else self.now + max(timeout, 0),
+                      'name': threading.current_thread().name,
+                      'seq': self.seq,
+                      'condition': condition,
+                      'woken': False}
+            self.seq += 1
+            self.waiting.append(waiter)
+
+            while not waiter['woken']:
+                self._wake_next()
+                if not waiter['woken']:
+                    self.cond.wait(self.poll)
+
+    def _wake_next(self):
+        # Called with the lock held: wake one waiter once all threads are waiting
+        if len(self.waiting) < threading.active_count():
+            return
+
+        def order(waiter):
+            wake = waiter['wake'] if waiter['wake'] is not None else float('inf')
+            return wake, waiter['name'], waiter['seq']
+
+        ready = [w for w in self.waiting if w['condition'] is not None and w['condition']()]
+        if ready:
+            waiter = min(ready, key=order)
+        else:
+            timed = [w for w in self.waiting if w['wake'] is not None]
+            if not timed:
+                raise RuntimeError('Simulation deadlocked, all threads waiting without timeout')
+            waiter = min(timed, key=order)
+            self.now = max(self.now, waiter['wake'])
+
+        waiter['woken'] = True
+        self.waiting.remove(waiter)
+        self.cond.notify_all()
+
+
+class FakeCommandRunner(object):
+
+    def __init__(self, clock, durations=None):
+        """
+        A replacement for external commands for set_command_runner(). Each
+        command takes a set time on the virtual clock and succeeds.
+
+        Args:
+            clock: A VirtualClock instance
+            durations: A list of (regular expression, virtual seconds) pairs.
+                The first pattern found in a command sets its duration, and
+                unmatched commands take no time.
+        """
+
+        self.clock = clock
+        self.durations = [(re.compile(pattern), secs) for pattern, secs in durations or []]
+        self.killed = False
+        self.counts = {}
+
+    def run(self, cmd, timeout, outfile=None, die=None):
+        """
+        Run a fake command, which is stopped by die or kill_all() like a real one.
+
+        Returns:
+            0, or None if the command timed out or was stopped.
+        """
+
+        if not isinstance(cmd, str):
+            cmd = ' '.join(cmd)
+        duration = 0
+        for pattern, secs in self.durations:
+            if pattern.search(cmd):
+                duration = secs
+                self.counts[pattern.pattern] = self.counts.get(pattern.pattern, 0) + 1
+                break
+
+        def stopped():
+            return self.killed or (die is not None and die.is_set())
+
+        start = self.clock.time()
+        self.clock.wait_until(stopped, min(duration, timeout))
+        if stopped() or self.clock.time() - start < duration:
+            return None
+
+        return 0
+
+    def kill_all(self):
+        """
+        Stop all running commands, as when the device reboots
+        """
+
+        with self.clock.cond:
+            self.killed = True
+            self.clock.cond.notify_all()
+
+
+def write_sparse(path, size, mtime):
+    # Create a file of a given size without writing the data
+    with open(path, 'wb') as outfile:
+        outfile.truncate(int(size))
+    os.utime(path, (mtime, mtime))
+
+
+class SimulatedSensor(SensorBase):
+
+    def __init__(self, config=None):
+
+        """
+        A sensor that records audio-like files without any hardware. Recording
+        takes record_length seconds on the clock and encoding runs a fake
+        avconv command, so its time is set by the command runner. With a quality
+        controller, the encoded size scales with the bitrate of the VBR level.
+
+        Args:
+            config: A dictionary used to replace the default settings of the sensor.
+        """
+
+        opts = self.options()
+        opts = {var['name']: var for var in opts}
+
+        self.record_length = sensors.set_option('record_length', config, opts)
+        self.capture_delay = sensors.set_option('capture_delay', config, opts)
+        self.raw_rate = sensors.set_option('raw_rate', config, opts)
+        self.encoded_rate = sensors.set_option('encoded_rate', config, opts)
+        self.failure_rate = sensors.set_option('failure_rate', config, opts)
+        self.seed = sensors.set_option('seed', config, opts)
+
+        self.random = random.Random(self.seed)
+        self.current_file = None
+        self.raw_file = None
+        self.start_time = None
+        self.end_time = None
+        self.working_dir = None
+        self.upload_dir = None
+        self.server_sync_interval = self.record_length + self.capture_delay
+
+    @staticmethod
+    def options():
+        """
+        Static method defining the config options and defaults for the sensor class
+        """
+        return [{'name': 'record_length',
+                 'type': int,
+                 'default': 1200,
+                 'prompt': 'What is the time in seconds of the recordings?'},
+                {'name': 'capture_delay',
+                 'type': int,
+                 'default': 0,
+                 'prompt': 'How long should the system wait between recordings?'},
+                {'name': 'raw_rate',
+                 'type': int,
+                 'default': 88200,
+                 'prompt': 'How many bytes per second are recorded?'},
+                {'name': 'encoded_rate',
+                 'type': int,
+                 'default': 24000,
+                 'prompt': 'How many bytes per second are staged after encoding at the best quality?'},
+                {'name': 'failure_rate',
+                 'type': float,
+                 'default': 0.0,
+                 'prompt': 'What fraction of recordings fail?'},
+                {'name': 'seed',
+                 'type': int,
+                 'default': 0,
+                 'prompt': 'What is the random seed?'}
+                ]
+
+    def capture_data(self, working_dir, upload_dir):
+        """
+        Method to simulate a recording, stopping early on shutdown
+
+        Args:
+            working_dir: A working directory to use for file processing
+            upload_dir: The directory to write the final data file to for upload.
+        """
+
+        self.working_dir = working_dir
+        self.upload_dir = upload_dir
+        self.start_time = clock.time()
+        self.current_file = '{}_dur={}secs'.format(clock.strftime('%H-%M-%S'), self.record_length)
+
+        self.die.wait(self.record_length)
+        self.end_time = clock.time()
+
+        if self.random.random() < self.failure_rate:
+            logging.info('Simulated recording failure')
+            open(os.path.join(working_dir, self.current_file + '_ERROR_audio-record-failed'), 'a').close()
+            self.raw_file = None
+            return
+
+        self.raw_file = os.path.join(working_dir, self.current_file + '.wav')
+        write_sparse(self.raw_file, self.raw_rate * (self.end_time - self.start_time), self.end_time)
+
+    def postprocess(self):
+        """
+        Method to simulate encoding the recording and staging it for upload
+        """
+
+        if self.raw_file is None:
+            return
+
+        ofile = os.path.join(self.upload_dir, self.current_file + '.mp3')
+        if run_command('avconv -i {} {}'.format(self.raw_file, ofile), timeout=600) != 0:
+            logging.info('Simulated encoding of {} stopped'.format(self.raw_file))
+            return
+
+        level = self.quality.level if self.quality is not None else 0
+        rate = self.encoded_rate * VBR_KBPS[level] / float(VBR_KBPS[0])
+        size = int(rate * (self.end_time - self.start_time))
+        write_sparse(ofile, size, clock.time())
+        digest = hashlib.sha256(ofile.encode('utf-8')).hexdigest()
+        record_staged(ofile, size, digest, {'sensor': type(self).__name__, 'start': self.start_time,
+                                            'end': self.end_time, 'codec': 'mp3',
+                                            'quality': level})
+        os.remove(self.raw_file)
+
+
+class SimulatedTransport(TransportBase):
+
+    def __init__(self, bandwidth=50000, connect_time=10, availability=1.0, seed=0,
+                 outage_length=0):
+
+        """
+        An uploader that removes files at a set bandwidth on the clock. Each sync
+        finds the network available with a set probability or, with an outage
+        length, the network is up or down for whole periods of that length.
+
+        Args:
+            bandwidth: The upload rate in bytes per second
+            connect_time: The time in seconds taken to connect, or to fail
+            availability: The probability of the network being available at a
+                sync, or in each period
+            seed: The random seed for network availability
+            outage_length: The length in seconds of the periods the network is
+                up or down for, or 0 to draw availability at each sync
+        """
+
+        self.bandwidth = bandwidth
+        self.connect_time = connect_time
+        self.availability = availability
+        self.seed = seed
+        self.outage_length = outage_length
+        self.random = random.Random(seed)
+        self.uploaded_files = 0
+        self.uploaded_bytes = 0
+        self.failed_syncs = 0
+
+    def link_up(self):
+        """
+        Returns:
+            A boolean showing if the simulated network is up.
+        """
+
+        if not self.outage_length:
+            return self.random.random() < self.availability
+        period = int(clock.time() // self.outage_length)
+        return random.Random(self.seed * 1000003 + period).random() < self.availability
+
+    def probe(self, timeout=5):
+        """
+        Method to simulate a probe, which fails at the timeout when the network is down
+        """
+
+        up = self.link_up()
+        clock.sleep(1 if up else timeout)
+        return up
+
+    def upload(self, upload_dir, manifest=None, die=None):
+        """
+        Method to simulate uploading each pending file, removing files once sent
+
+        Args:
+            upload_dir: The upload directory to synchronise
+            manifest: An optional Manifest holding checksums of staged files
+            die: A VirtualEvent to stop the upload
+        Returns:
+            A list of the paths of the files sent.
+        """
+
+        online = self.link_up()
+        if die.wait(self.connect_time):
+            return []
+        if not online:
+            logging.info('Simulated network unavailable')
+            self.failed_syncs += 1
+            return []
+
+        sent = []
+        files, _ = self.pending_files(upload_dir, manifest)
+        for path in files:
+            if manifest is not None and os.path.dirname(path) == manifest.manifest_dir:
+                # Manifests are only sent once none of their files remain
+                if any(os.path.exists(f) for f in manifest.read(path)):
+                    continue
+            size = os.path.getsize(path)
+            if die.wait(size / float(self.bandwidth)):
+                # interrupted transfers start again at the next sync
+                return sent
+            os.remove(path)
+            sent.append(path)
+            self.uploaded_files += 1
+            self.uploaded_bytes += size
+
+        return sent
+
+
+def dir_usage(path):
+    """
+    Find the number of files and bytes in a directory tree
+
+    Args:
+        path: The directory to search
+    Returns:
+        A tuple of the number of files and bytes.
+    """
+
+    n_files = 0
+    n_bytes = 0
+    for subdir, dirs, files in os.walk(path):
+        for fname in files:
+            n_files += 1
+            n_bytes += os.path.getsize(os.path.join(subdir, fname))
+
+    return n_files, n_bytes
+
+
+def next_time_of_day(after, time_of_day):
+    """
+    Find the next local time at a time of day
+
+    Args:
+        after: A time in seconds since the epoch
+        time_of_day: A time in HH:MM format
+    Returns:
+        The next time after the given time, in seconds since the epoch.
+    """
+
+    hours, minutes = [int(x) for x in time_of_day.split(':')]
+    day = time.localtime(after)
+    candidate = time.mktime(day[:3] + (hours, minutes, 0, 0, 0, -1))
+    while candidate <= after:
+        day = time.localtime(candidate + 86400)
+        candidate = time.mktime(day[:3] + (hours, minutes, 0, 0, 0, -1))
+
+    return candidate
+
+
+class Simulation(object):
+
+    def __init__(self, root, sensor_config=None, start=None, days=7, reboot_time=None,
+                 boot_time=90, shutdown_timeout=60, sync_time=5, encode_time=60,
+                 bandwidth=50000, connect_time=10, availability=1.0, seed=0,
+                 report_interval=3600, min_gap=60, quality=None, outage_length=0, link=None,
+                 realtime=None):
+        """
+        A class to run the recorder against a virtual clock and report on it.
+
+        Args:
+            root: The directory to hold the simulated working and upload directories
+            sensor_config: Settings for the SimulatedSensor
+            start: The virtual start time in seconds since the epoch
+            days: The number of days to simulate
+            reboot_time: An optional daily reboot time in HH:MM format
+            boot_time: The seconds from a reboot to the recorder restarting
+            shutdown_timeout: The seconds allowed for postprocessing on shutdown
+            sync_time: The seconds taken by the time update before each sync
+            encode_time: The seconds taken to encode each recording
+            bandwidth, connect_time, availability: Settings for the SimulatedTransport
+            seed: The random seed for the sensor and network
+            report_interval: The seconds between samples of the recorder state
+            min_gap: The longest uncovered period in seconds not counted as a gap
+            quality: Optional settings for a QualityController, which adapts the
+                encoded size to the simulated link. A new controller is made at
+                each reboot, as in the recorder.
+            outage_length: Setting for the SimulatedTransport
+            link: Optional settings for a LinkMonitor, which probes the link
+                before each sync. A new monitor is made at each reboot.
+            realtime: Optional settings for an UploadTrigger, which starts syncs
+                as files are staged. Latencies are measured across reboots.
+        """
+
+        self.root = root
+        self.sensor_config = dict(sensor_config or {})
+        self.sensor_config.setdefault('seed', seed)
+        self.start = start if start is not None else time.mktime((2020, 1, 1, 0, 0, 0, 0, 0, -1))
+        self.end = self.start + days * 86400
+        self.reboot_time = reboot_time
+        self.boot_time = boot_time
+        self.shutdown_timeout = shutdown_timeout
+        self.durations = [('bash_update_time', sync_time), ('avconv', encode_time)]
+        self.transport = SimulatedTransport(bandwidth, connect_time, availability, seed,
+                                            outage_length)
+        self.report_interval = report_interval
+        self.min_gap = min_gap
+        self.quality_opts = quality
+        self.quality = None
+        self.link_opts = link
+        self.link = None
+        self.realtime_opts = realtime
+        self.trigger = None
+        self.link_totals = {'probes': 0, 'skipped_syncs': 0, 'online_secs': 0.0, 'offline_secs': 0.0}
+
+        self.working_dir = os.path.join(root, 'tmp_dir')
+        self.upload_dir = os.path.join(root, 'continuous_monitoring_data')
+        self.upload_dir_pi = os.path.join(self.upload_dir, 'live_data', SIMULATED_PI_ID)
+        self.samples = []
+        self.reboots = 0
+
+    def run(self):
+        """
+        Run the simulation, replacing the clock, commands, manifest and catalog
+        for the duration.
+
+        Returns:
+            A dictionary holding the report.
+        """
+
+        self.clock = VirtualClock(self.start)
+        self.runner = FakeCommandRunner(self.clock, self.durations)
+        for path in [self.working_dir, self.upload_dir_pi]:
+            if not os.path.exists(path):
+                os.makedirs(path)
+
+        self.catalog = Catalog(os.path.join(self.root, 'catalog.sqlite'), self.upload_dir_pi)
+        clock.set_clock(self.clock)
+        set_command_runner(self.runner)
+        set_catalog(self.catalog)
+        if self.realtime_opts is not None:
+            self.trigger = UploadTrigger(self.clock.event(), **self.realtime_opts)
+            set_stage_listener(self.trigger.staged)
+        try:
+            next_sample = self.start
+            while self.clock.time() < self.end:
+                # Run the recorder until the next reboot or the end of the simulation
+                stop = self.end
+                if self.reboot_time is not None:
+                    stop = min(stop, next_time_of_day(self.clock.time(), self.reboot_time))
+                next_sample = self.run_session(stop, next_sample)
+                if self.clock.time() < self.end:
+                    self.reboots += 1
+                    self.clock.sleep(self.boot_time)
+                    clean_dirs(self.working_dir, self.upload_dir)
+                    os.makedirs(self.working_dir)
+            self.sample()
+        finally:
+            clock.set_clock(None)
+            set_command_runner(None)
+            set_manifest(None)
+            set_catalog(None)
+            set_stage_listener(None)
+
+        report = self.report()
+        self.catalog.close()
+        return report
+
+    def run_session(self, stop, next_sample):
+        """
+        Run the recording and sync threads as record() does until a stop time,
+        then shut them down.
+
+        Args:
+            stop: The virtual time to shut down
+            next_sample: The virtual time of the next report sample
+        Returns:
+            The virtual time of the next report sample.
+        """
+
+        die = self.clock.event()
+        self.runner.killed = False
+        manifest = Manifest(self.upload_dir_pi)
+        set_manifest(manifest)
+        sensor = SimulatedSensor(self.sensor_config)
+        sensor.setup()
+        if self.quality_opts is not None:
+            self.quality = QualityController(**self.quality_opts)
+        if self.link_opts is not None:
+            self.link = LinkMonitor(seed=self.sensor_config['seed'], **self.link_opts)
+
+        record_t = threading.Thread(target=continuous_recording, name='record',
+                                    args=(sensor, self.working_dir, self.upload_dir_pi, die,
+                                          None, None, self.quality))
+        sync_t = threading.Thread(target=ftp_server_sync, name='sync',
+                                  args=(sensor.server_sync_interval, self.transport,
+                                        self.upload_dir, die, None, manifest, None, self.catalog,
+                                        self.quality, self.link, self.trigger))
+        record_t.start()
+        if self.trigger is not None:
+            self.trigger.event.clear()
+            sync_start = self.clock.time()
+        else:
+            sync_start = self.clock.time() + sensor.server_sync_interval / 2
+
+        while self.clock.time() < stop:
+            due = [stop, next_sample] + ([sync_start] if sync_start is not None else [])
+            self.clock.sleep(max(min(due) - self.clock.time(), 0))
+            if sync_start is not None and self.clock.time() >= sync_start:
+                sync_t.start()
+                sync_start = None
+            if self.clock.time() >= next_sample:
+                self.sample()
+                next_sample += self.report_interval
+
+        # Shut down as record() does, killing anything left at the shutdown timeout
+        die.set()
+        if self.trigger is not None:
+            self.trigger.stop()
+        deadline = self.clock.time() + self.shutdown_timeout
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                self.clock.join(thread, max(deadline - self.clock.time(), 0))
+        self.runner.kill_all()
+        for thread in threading.enumerate():
+            if thread is not threading.current_thread():
+                self.clock.join(thread)
+
+        if self.link is not None:
+            metrics = self.link.metrics()
+            for key in self.link_totals:
+                self.link_totals[key] += metrics[key]
+
+        return next_sample
+
+    def sample(self):
+        """
+        Record the coverage, upload backlog and disk usage at the current virtual time
+        """
+
+        now = self.clock.time()
+        _, covered = self.catalog.gaps(self.start, now, SimulatedSensor.__name__, self.min_gap)
+        backlog_files, backlog_bytes = dir_usage(self.upload_dir_pi)
+        working_files, working_bytes = dir_usage(self.working_dir)
+        self.samples.append({'time': format_time(now),
+                             'coverage': round(covered / (now - self.start), 4) if now > self.start else 0,
+                             'backlog_files': backlog_files,
+                             'backlog_bytes': backlog_bytes,
+                             'disk_bytes': backlog_bytes + working_bytes,
+                             'uploaded_bytes': self.transport.uploaded_bytes,
+                             'quality_level': self.quality.level if self.quality is not None else 0})
+
+    def report(self):
+        """
+        Returns:
+            A dictionary of the daily coverage, the samples of the recorder state
+            and a summary.
+        """
+
+        days = []
+        day = self.start
+        while day < self.end:
+            summary = self.catalog.coverage_report(time.strftime('%Y-%m-%d', time.localtime(day)),
+                                                   self.min_gap)
+            sensor = summary['sensors'].get(SimulatedSensor.__name__, {})
+            days.append({'day': summary['day'],
+                         'files': sensor.get('files', 0),
+                         'coverage': sensor.get('coverage', 0),
+                         'gaps': len(sensor.get('gaps', []))})
+            day += 86400
+
+        _, covered = self.catalog.gaps(self.start, self.end, SimulatedSensor.__name__, self.min_gap)
+        levels = {}
+        for s in self.samples:
+            levels[s['quality_level']] = levels.get(s['quality_level'], 0) + 1
+        return {'summary': {'start': format_time(self.start),
+                            'end': format_time(self.end),
+                            'coverage': round(covered / (self.end - self.start), 4),
+                            'reboots': self.reboots,
+                            'uploaded_files': self.transport.uploaded_files,
+                            'uploaded_bytes': self.transport.uploaded_bytes,
+                            'failed_syncs': self.transport.failed_syncs,
+                            'link': self.link_totals if self.link_opts is not None else None,
+                            'upload_latency': self.catalog.upload_latency(self.start, self.end),
+                            'final_backlog_bytes': self.samples[-1]['backlog_bytes'],
+                            'max_backlog_bytes': max(s['backlog_bytes'] for s in self.samples),
+                            'max_disk_bytes': max(s['disk_bytes'] for s in self.samples),
+                            'quality_levels': dict((str(level), round(count / float(len(self.samples)), 4))
+                                                   for level, count in sorted(levels.items())),
+                            'catalog': self.catalog.status()},
+                'days': days,
+                'samples': self.samples}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Simulate days of recorder operation on a virtual clock')
+    parser.add_argument('config', nargs='?',
+                        help='An optional config file, supplying the sensor record_length and '
+                             'capture_delay and the sys scheduled_reboot and reboot_time')
+    parser.add_argument('--days', type=float, default=7, help='The number of days to simulate')
+    parser.add_argument('--start', type=parse_time, help='The virtual start time, YYYY-MM-DD[THH:MM:SS]')
+    parser.add_argument('--seed', type=int, default=0, help='The random seed')
+    parser.add_argument('--encode-time', type=float, default=60, help='Seconds to encode a recording')
+    parser.add_argument('--encoded-rate', type=int, default=24000, help='Bytes per second of staged data')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of failed recordings')
+    parser.add_argument('--bandwidth', type=float, default=50000, help='Upload rate in bytes per second')
+    parser.add_argument('--availability', type=float, default=1.0,
+                        help='Probability of the network being available at each sync')
+    parser.add_argument('--adaptive-quality', action='store_true',
+                        help='Adapt the encoding quality to the upload backlog, using the quality '
+                             'section of the config if given')
+    parser.add_argument('--outage-length', type=int, default=0,
+                        help='Seconds the network stays up or down for, or 0 to draw availability '
+                             'at each sync')
+    parser.add_argument('--link-monitor', action='store_true',
+                        help='Probe the link before syncs, using the link section of the config if given')
+    parser.add_argument('--realtime', action='store_true',
+                        help='Start syncs as files are staged, using the realtime section of the '
+                             'config if given')
+    parser.add_argument('--report-interval', type=int, default=3600,
+                        help='Seconds between samples of the recorder state')
+    parser.add_argument('--output', help='Write the full report as JSON to this file')
+    parser.add_argument('--keep', help='Keep the simulated data files in this directory')
+    parser.add_argument('--verbose', action='store_true', help='Show the recorder log')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING, stream=sys.stdout)
+
+    sensor_config = {'encoded_rate': args.encoded_rate, 'failure_rate': args.failure_rate}
+    reboot_time = None
+    shutdown_timeout = 60
+    config = {}
+    if args.config is not None:
+        config = json.load(open(args.config))
+        for key in ['record_length', 'capture_delay']:
+            if key in config.get('sensor', {}):
+                sensor_config[key] = config['sensor'][key]
+        sys_config = config.get('sys', {})
+        if sys_config.get('scheduled_reboot', 1):
+            reboot_time = sys_config.get('reboot_time', '02:00')
+        shutdown_timeout = sys_config.get('shutdown_timeout', 60)
+
+    quality = None
+    if args.adaptive_quality:
+        quality = dict((k, v) for k, v in quality_options(config).items() if k != 'enabled')
+
+    link = None
+    if args.link_monitor:
+        link = dict((k, v) for k, v in link_options(config).items() if k != 'enabled')
+
+    realtime = None
+    if args.realtime:
+        realtime = dict((k, v) for k, v in realtime_options(config).items() if k != 'enabled')
+
+    root = args.keep or tempfile.mkdtemp(prefix='rpi-eco-simulation-')
+    simulation = Simulation(root, sensor_config, start=args.start, days=args.days,
+                            reboot_time=reboot_time, shutdown_timeout=shutdown_timeout,
+                            encode_time=args.encode_time, bandwidth=args.bandwidth,
+                            availability=args.availability, seed=args.seed,
+                            report_interval=args.report_interval, quality=quality,
+                            outage_length=args.outage_length, link=link, realtime=realtime)
+    started = time.time()
+    try:
+        report = simulation.run()
+    finally:
+        if not args.keep:
+            shutil.rmtree(root, ignore_errors=True)
+    elapsed = time.time() - started
+
+    if args.output:
+        with open(args.output, 'w') as outfile:
+            json.dump(report, outfile, indent=1)
+
+    for day in report['days']:
+        print('{}: {} files, {:.1%} coverage, {} gaps'.format(day['day'], day['files'],
+                                                            day['coverage'], day['gaps']))
+    summary = report['summary']
+    print('Coverage {:.1%}, {} reboots, {} failed syncs, {} files uploaded'.format(
+        summary['coverage'], summary['reboots'], summary['failed_syncs'], summary['uploaded_files']))
+    print('Backlog {:.1f} MB at the end, {:.1f} MB at most, peak disk use {:.1f} MB'.format(
+        summary['final_backlog_bytes'] / 1e6, summary['max_backlog_bytes'] / 1e6,
+        summary['max_disk_bytes'] / 1e6))
+    if link is not None:
+        print('Link uptime {:.1%}, {} probes, {} syncs skipped'.format(
+            summary['link']['online_secs'] / max(summary['link']['online_secs'] +
+                                                 summary['link']['offline_secs'], 1),
+            summary['link']['probes'], summary['link']['skipped_syncs']))
+    if summary['upload_latency']['files']:
+        print('Upload latency p50 {p50:.0f} secs, p90 {p90:.0f} secs, p99 {p99:.0f} secs, '
+              'max {max:.0f} secs over {files} files'.format(**summary['upload_latency']))
+    if quality is not None:
+        print('Time at each VBR level: ' + ', '.join('V{} {:.1%}'.format(level, fraction) for level, fraction
+                                                     in sorted(summary['quality_levels'].items())))
+    print('Simulated {:.1f} days in {:.1f} secs ({:.0f}x real time)'.format(
+        args.days, elapsed, args.days * 86400 / elapsed))
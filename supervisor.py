@@ -0,0 +1,425 @@
+import os
+import time
+import select
+import signal
+import socket
+import subprocess
+import threading
+import logging
+
+
+"""
+In-process supervision of the recorder, replacing the daily forced reboot as the
+defence against hung processes:
+
+* run_command(cmd, timeout) # runs an external command, killing it at a deadline
+* stream_command(cmd, timeout, outfile) # as run_command, writing stdout to a file object
+* Supervisor # restarts dead worker threads with backoff and pings the watchdog
+* heartbeat() # called by workers as they make progress, checked by the Supervisor
+* watchdog_enabled() # whether the recorder is run under a service manager watchdog
+
+Commands can be replaced with set_command_runner(), which is used by the
+simulation mode to run fake commands against a virtual clock.
+"""
+
+# Seconds between SIGTERM and SIGKILL when stopping a hung command
+KILL_GRACE = 5
+
+# An object replacing external commands, set with set_command_runner()
+_runner = None
+
+# The time of the last heartbeat() from each thread, by thread name
+_heartbeats = {}
+
+# Commands started by run_command and stream_command, for diagnostics
+_commands = {}
+_commands_lock = threading.Lock()
+
+
+def set_command_runner(runner):
+    """
+    Replace external commands run by run_command and stream_command.
+
+    Args:
+        runner: An object with a run(cmd, timeout, outfile, die) method returning
+            a return code, or None to run commands normally
+    """
+
+    global _runner
+    _runner = runner
+
+
+def _track_command(proc, cmd):
+    # Record a started command, forgetting any that have since exited
+    with _commands_lock:
+        for pid in [pid for pid, entry in _commands.items() if entry['proc'].returncode is not None]:
+            del _commands[pid]
+        _commands[proc.pid] = {'proc': proc, 'cmd': cmd, 'started': time.time(),
+                               'thread': threading.current_thread().name}
+
+
+def running_commands():
+    """
+    List the external commands that are still running.
+
+    Returns:
+        A list of dictionaries of the command, pid, calling thread and seconds running.
+    """
+
+    now = time.time()
+    with _commands_lock:
+        return [{'cmd': entry['cmd'], 'pid': pid, 'thread': entry['thread'],
+                 'running_secs': round(now - entry['started'], 1)}
+                for pid, entry in sorted(_commands.items())
+                if entry['proc'].returncode is None]
+
+
+def run_command(cmd, timeout, shell=True, die=None):
+    """
+    Run an external command with a deadline. The command is started in its own
+    process group so that a hung child of a shell command (e.g. arecord run via
+    sudo) is killed along with it.
+
+    Args:
+        cmd: The command string (or argument list if shell is False)
+        timeout: The number of seconds to allow the command to run
+        shell: Should the command be run through the shell
+        die: An optional threading event, which also stops the command when set
+    Returns:
+        The command return code, or None if the command was killed.
+    """
+
+    if _runner is not None:
+        return _runner.run(cmd, timeout, None, die)
+
+    try:
+        proc = subprocess.Popen(cmd, shell=shell, preexec_fn=os.setsid)
+    except OSError as e:
+        logging.error('Could not start command {}: {}'.format(cmd, e))
+        return None
+    _track_command(proc, cmd)
+
+    deadline = time.time() + timeout
+    poll = 0.05
+    while proc.poll() is None:
+        if time.time() > deadline:
+            logging.error('Command timed out after {} secs, killing: {}'.format(timeout, cmd))
+            break
+        if die is not None and die.is_set():
+            logging.info('Stopping command on shutdown: {}'.format(cmd))
+            break
+        time.sleep(poll)
+        poll = min(poll * 2, 0.5)
+    else:
+        return proc.returncode
+
+    kill_process_group(proc)
+    return None
+
+
+def stream_command(cmd, timeout, outfile, shell=True, die=None, chunk_size=65536):
+    """
+    Run an external command with a deadline, as run_command, copying its
+    standard output to a file object as it is produced. This allows callers
+    to process the output (e.g. hashing) while it is written.
+
+    Args:
+        cmd: The command string (or argument list if shell is False)
+        timeout: The number of seconds to allow the command to run
+        outfile: A file-like object with a write method
+        shell: Should the command be run through the shell
+        die: An optional threading event, which also stops the command when set
+        chunk_size: The maximum number of bytes to read at a time
+    Returns:
+        The command return code, or None if the command was killed.
+    """
+
+    if _runner is not None:
+        return _runner.run(cmd, timeout, outfile, die)
+
+    try:
+        proc = subprocess.Popen(cmd, shell=shell, stdout=subprocess.PIPE, preexec_fn=os.setsid)
+    except OSError as e:
+        logging.error('Could not start command {}: {}'.format(cmd, e))
+        return None
+    _track_command(proc, cmd)
+
+    deadline = time.time() + timeout
+    fd = proc.stdout.fileno()
+    while True:
+        if time.time() > deadline:
+            logging.error('Command timed out after {} secs, killing: {}'.format(timeout, cmd))
+            break
+        if die is not None and die.is_set():
+            logging.info('Stopping command on shutdown: {}'.format(cmd))
+            break
+        ready, _, _ = select.select([fd], [], [], 0.5)
+        if ready:
+            data = os.read(fd, chunk_size)
+            if not data:
+                # end of output, so wait for the command to exit
+                proc.stdout.close()
+                remaining = max(deadline - time.time(), 0)
+                while proc.poll() is None and remaining > 0:
+                    time.sleep(0.1)
+                    remaining -= 0.1
+                if proc.poll() is not None:
+                    return proc.returncode
+                logging.error('Command timed out after {} secs, killing: {}'.format(timeout, cmd))
+                break
+            outfile.write(data)
+
+    kill_process_group(proc)
+    proc.stdout.close()
+    return None
+
+
+def kill_process_group(proc):
+    """
+    Terminate the process group of a running command, escalating to SIGKILL
+    if it does not exit within KILL_GRACE seconds.
+
+    Args:
+        proc: A subprocess.Popen instance started with its own process group
+    """
+
+    for sig, wait in [(signal.SIGTERM, KILL_GRACE), (signal.SIGKILL, KILL_GRACE)]:
+        try:
+            os.killpg(proc.pid, sig)
+        except OSError:
+            # process group already gone
+            break
+        deadline = time.time() + wait
+        while proc.poll() is None and time.time() < deadline:
+            time.sleep(0.1)
+        if proc.poll() is not None:
+            break
+
+    # reap the child if it has exited
+    proc.poll()
+
+
+def watchdog_notify(state='WATCHDOG=1'):
+    """
+    Send a systemd style notification to the socket in NOTIFY_SOCKET. This is
+    a no-op when the recorder is not run under a service manager watchdog.
+
+    Args:
+        state: The notification string to send
+    Returns:
+        A boolean showing if the notification was sent.
+    """
+
+    addr = os.environ.get('NOTIFY_SOCKET')
+    if not addr:
+        return False
+
+    # abstract namespace sockets are given with a leading @
+    if addr[0] == '@':
+        addr = '\0' + addr[1:]
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(state.encode('ascii'), addr)
+    except socket.error as e:
+        logging.error('Watchdog notification failed: {}'.format(e))
+        return False
+    finally:
+        sock.close()
+
+    return True
+
+
+def watchdog_enabled():
+    """
+    Returns:
+        A boolean showing if the recorder is run under a service manager with a
+        watchdog, such as the systemd unit rpi-eco-monitoring.service.
+    """
+
+    return bool(os.environ.get('NOTIFY_SOCKET') and os.environ.get('WATCHDOG_USEC'))
+
+
+def heartbeat():
+    """
+    Record that the calling worker thread is making progress. Workers call this
+    once per loop, and the supervisor stops pinging the watchdog if a worker
+    stops calling it, even if its thread is still alive.
+    """
+
+    _heartbeats[threading.current_thread().name] = time.time()
+
+
+class Supervisor(object):
+
+    def __init__(self, die, backoff_base=5, backoff_max=600, stable_time=3600):
+        """
+        A class to run the recorder worker threads, restarting any that die
+        unexpectedly with exponential backoff, and to ping the watchdog while
+        all workers are alive and sending heartbeats.
+
+        Args:
+            die: The threading event used to shut the workers down
+            backoff_base: The delay in seconds before the first restart
+            backoff_max: The maximum delay in seconds between restarts
+            stable_time: Seconds a worker must run for the backoff to reset
+        """
+
+        self.die = die
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.stable_time = stable_time
+        self.workers = {}
+
+    def add(self, name, target, args=(), stall_time=None):
+        """
+        Register a worker thread function. Workers are not started until
+        start() is called.
+
+        Args:
+            name: A name for the worker, used in logging
+            target: The function to run in the thread
+            args: The arguments to the function
+            stall_time: An optional time in seconds. A worker that has not called
+                heartbeat() for this long is treated as hung.
+        """
+
+        self.workers[name] = {'target': target, 'args': args, 'thread': None,
+                              'started': None, 'restarts': 0, 'next_start': None,
+                              'stall_time': stall_time, 'stalled': False}
+
+    def set_stall_time(self, name, stall_time):
+        """
+        Change the stall time of a registered worker, for example when a new
+        config changes its loop interval.
+
+        Args:
+            name: The name of the worker
+            stall_time: The new time in seconds, or None to never treat the
+                worker as hung
+        """
+
+        self.workers[name]['stall_time'] = stall_time
+
+    def last_heartbeat(self, name):
+        """
+        Returns:
+            The seconds since the worker last called heartbeat() or was started,
+            or None if it has not been started.
+        """
+
+        worker = self.workers[name]
+        if worker['started'] is None:
+            return None
+        return time.time() - max(_heartbeats.get(name, 0), worker['started'])
+
+    def status(self):
+        """
+        Returns:
+            A dictionary of the state of each worker: alive, seconds since the
+            last start and the last heartbeat, whether it has stalled and the
+            number of restarts.
+        """
+
+        now = time.time()
+        status = {}
+        for name, worker in self.workers.items():
+            last = self.last_heartbeat(name)
+            status[name] = {'alive': worker['thread'] is not None and worker['thread'].is_alive(),
+                            'running_secs': None if worker['started'] is None
+                            else round(now - worker['started']),
+                            'heartbeat_secs': None if last is None else round(last),
+                            'stalled': worker['stalled'],
+                            'restarts': worker['restarts']}
+        return status
+
+    def start(self, name):
+        """
+        Start a registered worker thread.
+
+        Args:
+            name: The name of the worker to start
+        """
+
+        worker = self.workers[name]
+        thread = threading.Thread(target=self._run, args=(name,), name=name)
+        thread.daemon = True
+        thread.start()
+        worker['thread'] = thread
+        worker['started'] = time.time()
+        worker['next_start'] = None
+
+    def _run(self, name):
+        # Run a worker function, logging rather than printing any exception
+        worker = self.workers[name]
+        try:
+            worker['target'](*worker['args'])
+        except Exception:
+            logging.exception('Worker {} raised an exception'.format(name))
+
+    def check(self):
+        """
+        Restart any started worker threads that have died, using exponential
+        backoff between restarts, and ping the watchdog if all are alive and
+        none has gone longer than its stall time without a heartbeat. A stalled
+        thread can not be restarted, so the watchdog is left to restart the
+        recorder. This is intended to be called regularly from the main loop.
+        """
+
+        if self.die.is_set():
+            return
+
+        now = time.time()
+        healthy = True
+
+        for name, worker in self.workers.items():
+            if worker['thread'] is None:
+                continue
+
+            if worker['thread'].is_alive():
+                last = self.last_heartbeat(name)
+                stalled = worker['stall_time'] is not None and last > worker['stall_time']
+                if stalled and not worker['stalled']:
+                    logging.error('Worker {} has made no progress for {:.0f} secs, '
+                                  'stopping watchdog pings'.format(name, last))
+                elif worker['stalled'] and not stalled:
+                    logging.info('Worker {} is making progress again'.format(name))
+                worker['stalled'] = stalled
+                healthy = healthy and not stalled
+                continue
+
+            healthy = False
+
+            # schedule a restart with backoff, resetting after a stable run
+            if worker['next_start'] is None:
+                if now - worker['started'] > self.stable_time:
+                    worker['restarts'] = 0
+                delay = min(self.backoff_base * 2 ** worker['restarts'], self.backoff_max)
+                worker['restarts'] += 1
+                worker['next_start'] = now + delay
+                logging.error('Worker {} died, restarting in {} secs'.format(name, delay))
+            elif now >= worker['next_start']:
+                logging.info('Restarting worker {} (restart {})'.format(name, worker['restarts']))
+                self.start(name)
+
+        if healthy:
+            watchdog_notify()
+
+    def join(self, timeout=None):
+        """
+        Wait for all started worker threads to finish
+
+        Args:
+            timeout: An optional overall time limit in seconds
+        Returns:
+            A list of the names of any workers still running.
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+        for worker in self.workers.values():
+            if worker['thread'] is not None:
+                remaining = None if deadline is None else max(deadline - time.time(), 0)
+                worker['thread'].join(remaining)
+
+        return [name for name, worker in self.workers.items()
+                if worker['thread'] is not None and worker['thread'].is_alive()]
@@ -0,0 +1,128 @@
+import os
+import time
+import shutil
+import pytest
+
+import integrity
+from bundler import Bundler, bundle_staged_files
+from catalog import Catalog
+from integrity import Manifest, UPLOAD_LOCK_NAME, UploadLock, hash_file, record_staged
+from unbundle import unbundle
+
+
+NAMES = [os.path.join('2020-05-01', '2020-05-01T12:00:{:02d}.jpg'.format(n)) for n in range(3)]
+
+
+@pytest.fixture
+def staging(tmp_path):
+    # A device upload directory recording staged files in a manifest and catalog
+    upload_dir = str(tmp_path / 'live_data' / 'device')
+    manifest = Manifest(upload_dir)
+    catalog = Catalog(str(tmp_path / 'catalog.sqlite'), upload_dir)
+    integrity.set_manifest(manifest)
+    integrity.set_catalog(catalog)
+    yield upload_dir, manifest, catalog
+    integrity.set_manifest(None)
+    integrity.set_catalog(None)
+    catalog.close()
+
+
+def stage_images(upload_dir):
+    contents = {}
+    os.makedirs(os.path.join(upload_dir, '2020-05-01'))
+    for index, relpath in enumerate(NAMES):
+        path = os.path.join(upload_dir, relpath)
+        data = os.urandom(100 + index)
+        with open(path, 'wb') as outfile:
+            outfile.write(data)
+        old = time.time() - 3600
+        os.utime(path, (old, old))
+        record_staged(path, len(data), hash_file(path))
+        contents[relpath] = data
+    return contents
+
+
+class StopAfterWait(object):
+    # A die event that is set by the first wait, so the loop runs once
+
+    def __init__(self):
+        self.set = False
+
+    def is_set(self):
+        return self.set
+
+    def wait(self, timeout=None):
+        self.set = True
+        return True
+
+
+def test_round_trip(staging, tmp_path):
+    upload_dir, manifest, catalog = staging
+    contents = stage_images(upload_dir)
+    bundler = Bundler(upload_dir, small_file_size=1000, settle_time=60)
+
+    assert bundler.bundle() == 3
+    bundler.seal()
+
+    bundles = os.listdir(bundler.bundle_dir)
+    assert len(bundles) == 1
+    bundle = os.path.join(bundler.bundle_dir, bundles[0])
+    for relpath in NAMES:
+        assert not os.path.exists(os.path.join(upload_dir, relpath))
+
+    # The manifest holds the original files and the sealed bundle
+    entries = manifest.entries()
+    assert entries[bundle][integrity.HASH_ALGORITHM] == hash_file(bundle)
+    for relpath, data in contents.items():
+        assert entries[os.path.join(upload_dir, relpath)]['size'] == len(data)
+
+    # The catalog knows which bundle each file went into
+    rows = dict((row['path'], row) for row in catalog.files(0, time.time()))
+    for relpath in NAMES:
+        assert rows[relpath]['state'] == 'bundled'
+        assert rows[relpath]['bundle'] == os.path.join('bundles', bundles[0])
+    assert catalog.backlog() == (1, os.path.getsize(bundle))
+
+    # Restoring the upload on the server gives back the original files
+    server_dir = str(tmp_path / 'server' / 'device')
+    os.makedirs(os.path.join(server_dir, 'bundles'))
+    shutil.copy(bundle, os.path.join(server_dir, 'bundles'))
+    assert unbundle(os.path.join(server_dir, 'bundles', bundles[0])) == 3
+    for relpath, data in contents.items():
+        path = os.path.join(server_dir, relpath)
+        with open(path, 'rb') as infile:
+            assert infile.read() == data
+        entry = entries[os.path.join(upload_dir, relpath)]
+        assert hash_file(path) == entry[integrity.HASH_ALGORITHM]
+
+
+def test_recent_files_are_not_bundled(staging):
+    upload_dir = staging[0]
+    stage_images(upload_dir)
+    now = time.time()
+    os.utime(os.path.join(upload_dir, NAMES[0]), (now, now))
+    bundler = Bundler(upload_dir, small_file_size=1000, settle_time=60)
+
+    assert bundler.bundle() == 2
+    assert os.path.exists(os.path.join(upload_dir, NAMES[0]))
+
+
+def test_skip_while_upload_lock_held(staging):
+    upload_dir = staging[0]
+    stage_images(upload_dir)
+    bundler = Bundler(upload_dir, small_file_size=1000, settle_time=60)
+    upload_lock = UploadLock(os.path.join(upload_dir, UPLOAD_LOCK_NAME))
+
+    with upload_lock:
+        bundle_staged_files(bundler, 60, StopAfterWait(), upload_lock)
+    for relpath in NAMES:
+        assert os.path.exists(os.path.join(upload_dir, relpath))
+    assert os.listdir(bundler.bundle_dir) == []
+
+    # Once the sync has finished the files are bundled, and sealed on shutdown
+    bundle_staged_files(bundler, 60, StopAfterWait(), upload_lock)
+    for relpath in NAMES:
+        assert not os.path.exists(os.path.join(upload_dir, relpath))
+    assert len(os.listdir(bundler.bundle_dir)) == 1
+    assert upload_lock.acquire(False)
+    upload_lock.release()
@@ -0,0 +1,124 @@
+import pytest
+
+import clock
+from connectivity import LinkMonitor, OFFLINE, ONLINE
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, secs):
+        self.now += secs
+
+
+class ClockEvent(object):
+    # A die event that is never set, whose waits advance the fake clock
+
+    def __init__(self, fake_clock):
+        self.clock = fake_clock
+        self.waits = []
+
+    def is_set(self):
+        return False
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        self.clock.sleep(timeout)
+        return False
+
+
+class ScriptedTransport(object):
+    # A transport whose probes succeed or fail by a function of the time
+
+    def __init__(self, up):
+        self.up = up
+        self.probes = []
+
+    def probe(self, timeout=5):
+        self.probes.append(clock.time())
+        return self.up(clock.time())
+
+
+@pytest.fixture
+def fake_clock():
+    fake_clock = FakeClock()
+    clock.set_clock(fake_clock)
+    yield fake_clock
+    clock.set_clock(None)
+
+
+def test_outage_needs_failure_threshold(fake_clock):
+    link = LinkMonitor(failure_threshold=2, jitter=0)
+    transport = ScriptedTransport(lambda now: False)
+
+    assert not link.probe(transport)
+    assert link.state == ONLINE
+    assert not link.probe(transport)
+    assert link.state == OFFLINE
+    assert link.history[-1] == (fake_clock.now, OFFLINE)
+
+
+def test_backoff_doubles_to_max(fake_clock):
+    link = LinkMonitor(failure_threshold=1, backoff_base=15, backoff_max=100, jitter=0)
+    transport = ScriptedTransport(lambda now: False)
+
+    delays = []
+    for _ in range(5):
+        link.probe(transport)
+        delays.append(link.next_probe - fake_clock.now)
+    assert delays == [15, 30, 60, 100, 100]
+
+    # A successful probe resets the backoff
+    transport.up = lambda now: True
+    assert link.probe(transport)
+    assert link.state == ONLINE
+    assert link.failures == 0
+    assert link.next_probe == 0
+
+
+def test_jitter_shortens_delays(fake_clock):
+    link = LinkMonitor(backoff_base=100, jitter=0.5, seed=1)
+    link.failures = 1
+    delays = [link.backoff() for _ in range(100)]
+
+    assert all(50 <= delay <= 100 for delay in delays)
+    assert len(set(delays)) > 1
+
+
+def test_available_waits_through_outage(fake_clock):
+    link = LinkMonitor(failure_threshold=2, backoff_base=15, backoff_max=600, jitter=0)
+    back_at = fake_clock.now + 100
+    transport = ScriptedTransport(lambda now: now >= back_at)
+    die = ClockEvent(fake_clock)
+
+    # Probes at 0, 15, 45 and 105 secs, the last after the link returns
+    assert link.available(transport, die, 1200)
+    assert [t - transport.probes[0] for t in transport.probes] == [0, 15, 45, 105]
+    assert [state for _, state in link.history] == [OFFLINE, ONLINE]
+    assert link.skipped_syncs == 0
+
+    metrics = link.metrics()
+    assert metrics['offline_secs'] == 90
+    assert metrics['probes'] == 4
+
+
+def test_available_skips_sync_while_down(fake_clock):
+    link = LinkMonitor(failure_threshold=1, backoff_base=15, backoff_max=600, jitter=0)
+    transport = ScriptedTransport(lambda now: False)
+    die = ClockEvent(fake_clock)
+    start = fake_clock.now
+
+    assert not link.available(transport, die, 100)
+    assert fake_clock.now - start == 100
+    assert link.skipped_syncs == 1
+    assert link.state == OFFLINE
+
+    # The next sync carries on probing with the backoff reached
+    assert not link.available(transport, die, 100)
+    assert link.skipped_syncs == 2
+    assert link.metrics()['uptime'] == 0
@@ -0,0 +1,183 @@
+import os
+import multiprocessing
+
+import supervisor
+from governor import Governor, SysfsReader
+from python_record import ftp_server_sync
+
+
+def write_readings(root, temp=50.0, load=0.1, free_mb=512, volts=None):
+    """
+    Write fake proc and sys files below a root directory.
+
+    Args:
+        root: The fake root directory
+        temp: The CPU temperature in degrees C
+        load: The one minute load average per CPU
+        free_mb: The available memory in MB
+        volts: An optional battery voltage
+    """
+
+    files = {'sys/class/thermal/thermal_zone0/temp': '{}\n'.format(int(temp * 1000)),
+             'proc/loadavg': '{:.2f} 0.50 0.50 1/100 1000\n'.format(
+                 load * multiprocessing.cpu_count()),
+             'proc/meminfo': 'MemTotal: 1000000 kB\nMemAvailable: {} kB\n'.format(
+                 int(free_mb * 1024))}
+    if volts is not None:
+        files['sys/class/power_supply/BAT0/voltage_now'] = '{}\n'.format(int(volts * 1e6))
+
+    for path, value in files.items():
+        path = os.path.join(str(root), path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as outfile:
+            outfile.write(value)
+
+
+def make_governor(root, **kwargs):
+    reader = SysfsReader(str(root), 'sys/class/power_supply/BAT0/voltage_now')
+    return Governor(reader, max_encoders=4, **kwargs)
+
+
+def test_readings(tmp_path):
+    write_readings(tmp_path, temp=61.5, load=0.5, free_mb=100, volts=3.7)
+    readings = SysfsReader(str(tmp_path), 'sys/class/power_supply/BAT0/voltage_now').readings()
+
+    assert readings['temperature'] == 61.5
+    assert abs(readings['load'] - 0.5) < 0.01
+    assert readings['free_memory'] == 100
+    assert readings['battery_voltage'] == 3.7
+
+
+def test_missing_readings(tmp_path):
+    # A root without the files, as on a device without a thermal zone
+    governor = make_governor(tmp_path)
+
+    assert governor.update() == 0
+    assert governor.readings['temperature'] is None
+
+
+def test_normal_running(tmp_path):
+    write_readings(tmp_path)
+    governor = make_governor(tmp_path)
+
+    assert governor.update() == 0
+    assert not governor.fast_compression()
+    assert not governor.defer_uploads()
+    assert governor.encoder_limit() == 4
+    assert governor.stretch_delay(10) == 10
+
+
+def test_loaded_uses_fast_compression(tmp_path):
+    write_readings(tmp_path, load=2.0)
+    governor = make_governor(tmp_path)
+
+    assert governor.update() == 1
+    assert governor.fast_compression()
+    assert governor.encoder_limit() == 1
+    assert not governor.defer_uploads()
+
+    write_readings(tmp_path, free_mb=10)
+    assert governor.update() == 1
+
+
+def test_hot_defers_uploads(tmp_path):
+    write_readings(tmp_path, temp=76.0)
+    governor = make_governor(tmp_path)
+
+    assert governor.update() == 2
+    assert governor.fast_compression()
+    assert governor.defer_uploads()
+    assert governor.stretch_delay(10) == 10
+
+
+def test_critical_stretches_delay(tmp_path):
+    write_readings(tmp_path, temp=85.0)
+    governor = make_governor(tmp_path, critical_pause=300)
+
+    assert governor.update() == 3
+    assert governor.defer_uploads()
+    assert governor.stretch_delay(10) == 310
+
+
+def test_battery_levels(tmp_path):
+    governor = make_governor(tmp_path, low_voltage=3.5, critical_voltage=3.3)
+
+    write_readings(tmp_path, volts=3.4)
+    assert governor.update() == 2
+    write_readings(tmp_path, volts=3.2)
+    assert governor.update() == 3
+    write_readings(tmp_path, volts=3.8)
+    assert governor.update() == 0
+
+
+def test_hysteresis(tmp_path):
+    write_readings(tmp_path, temp=76.0)
+    governor = make_governor(tmp_path, hysteresis=3.0)
+    assert governor.update() == 2
+
+    # The level is held until the temperature drops by the hysteresis
+    write_readings(tmp_path, temp=73.0)
+    assert governor.update() == 2
+    write_readings(tmp_path, temp=71.5)
+    assert governor.update() == 1
+    write_readings(tmp_path, temp=60.0)
+    assert governor.update() == 0
+
+
+class StopAfterWait(object):
+    # A die event that is set by the first wait, so the sync loop runs once
+
+    def __init__(self):
+        self.waits = []
+
+    def is_set(self):
+        return bool(self.waits)
+
+    def wait(self, timeout=None):
+        self.waits.append(timeout)
+        return True
+
+
+class RecordingTransport(object):
+
+    def __init__(self):
+        self.uploads = 0
+
+    def upload(self, upload_dir, manifest=None, die=None):
+        self.uploads += 1
+        return []
+
+
+class NoCommands(object):
+
+    def run(self, cmd, timeout, outfile, die):
+        return 0
+
+
+def test_sync_deferred_when_hot(tmp_path):
+    write_readings(tmp_path, temp=76.0)
+    governor = make_governor(tmp_path)
+    governor.update()
+    transport = RecordingTransport()
+    die = StopAfterWait()
+
+    ftp_server_sync(600, transport, str(tmp_path), die, governor=governor)
+
+    assert transport.uploads == 0
+    assert die.waits == [600]
+
+
+def test_sync_runs_when_loaded(tmp_path):
+    write_readings(tmp_path, load=2.0)
+    governor = make_governor(tmp_path)
+    governor.update()
+    transport = RecordingTransport()
+
+    supervisor.set_command_runner(NoCommands())
+    try:
+        ftp_server_sync(600, transport, str(tmp_path), StopAfterWait(), governor=governor)
+    finally:
+        supervisor.set_command_runner(None)
+
+    assert transport.uploads == 1
@@ -0,0 +1,150 @@
+import io
+import os
+import json
+import wave
+
+import pytest
+
+from health import AudioCheck, HealthChecker, HEALTH_DIR
+
+
+RATE = 8000
+
+
+def make_wav(samples, channels=1, rate=RATE):
+    """
+    Make the bytes of a 16 bit WAV file.
+
+    Args:
+        samples: A list of integer samples, interleaved by channel
+    """
+
+    buf = io.BytesIO()
+    writer = wave.open(buf, 'wb')
+    writer.setnchannels(channels)
+    writer.setsampwidth(2)
+    writer.setframerate(rate)
+    writer.writeframes(b''.join(int(s).to_bytes(2, 'little', signed=True) for s in samples))
+    writer.close()
+    return buf.getvalue()
+
+
+def check_wav(data, chunk_size=1001):
+    # Pass a WAV stream through an AudioCheck in uneven chunks, as from arecord
+    check = AudioCheck()
+    for start in range(0, len(data), chunk_size):
+        check.write(data[start:start + chunk_size])
+    return check.metrics()
+
+
+def noise(n, level=8000, seed=1):
+    # Deterministic pseudo-random samples, to avoid needing NumPy here
+    value = seed
+    samples = []
+    for _ in range(n):
+        value = (value * 1103515245 + 12345) % (1 << 31)
+        samples.append(value % (2 * level) - level)
+    return samples
+
+
+def test_good_recording(tmp_path):
+    pytest.importorskip('numpy')
+    metrics = check_wav(make_wav(noise(RATE)))
+
+    assert metrics['duration'] == 1.0
+    assert metrics['sample_rate'] == RATE
+    assert HealthChecker(str(tmp_path)).audio_flags(metrics, expected=1) == []
+
+
+def test_silence_and_flatline(tmp_path):
+    pytest.importorskip('numpy')
+    checker = HealthChecker(str(tmp_path))
+
+    metrics = check_wav(make_wav([0] * RATE))
+    assert metrics['zero_ratio'] == 1.0
+    assert sorted(checker.audio_flags(metrics)) == ['flatline', 'silence']
+
+    # A stuck channel beside a working one is a flatline without silence
+    stereo = []
+    for sample in noise(RATE):
+        stereo.extend([sample, 100])
+    metrics = check_wav(make_wav(stereo, channels=2))
+    assert metrics['channels'] == 2
+    assert checker.audio_flags(metrics) == ['flatline']
+
+
+def test_clipping_and_dc_offset(tmp_path):
+    pytest.importorskip('numpy')
+    checker = HealthChecker(str(tmp_path))
+
+    metrics = check_wav(make_wav([32767, -32768] * (RATE // 2)))
+    assert 'clipping' in checker.audio_flags(metrics)
+
+    metrics = check_wav(make_wav([s + 10000 for s in noise(RATE, level=1000)]))
+    assert checker.audio_flags(metrics) == ['dc_offset']
+
+
+def test_truncation(tmp_path):
+    checker = HealthChecker(str(tmp_path))
+    metrics = check_wav(make_wav(noise(RATE // 2)))
+
+    assert metrics['duration'] == 0.5
+    assert 'truncated' in checker.audio_flags(metrics, expected=1)
+    assert 'truncated' not in checker.audio_flags(metrics, expected=0.5)
+    assert 'truncated' not in checker.audio_flags(metrics)
+
+
+def test_unreadable_stream(tmp_path):
+    metrics = check_wav(b'not a wav file at all')
+    assert HealthChecker(str(tmp_path)).audio_flags(metrics) == ['unreadable']
+
+
+def save_jpeg(path, pixels):
+    Image = pytest.importorskip('PIL.Image')
+    image = Image.new('L', (64, 48))
+    image.putdata(pixels)
+    image.save(str(path), 'JPEG', quality=95)
+    return str(path)
+
+
+def test_good_image(tmp_path):
+    pytest.importorskip('numpy')
+    path = save_jpeg(tmp_path / 'good.jpg', [128 + s // 80 for s in noise(64 * 48)])
+    flags, metrics = HealthChecker(str(tmp_path)).check_image(path)
+
+    assert flags == []
+    assert 0.3 < metrics['brightness'] < 0.7
+
+
+def test_black_and_overexposed_images(tmp_path):
+    pytest.importorskip('numpy')
+    checker = HealthChecker(str(tmp_path))
+
+    flags, _ = checker.check_image(save_jpeg(tmp_path / 'black.jpg', [0] * (64 * 48)))
+    assert sorted(flags) == ['black', 'blurred']
+    flags, _ = checker.check_image(save_jpeg(tmp_path / 'white.jpg', [255] * (64 * 48)))
+    assert sorted(flags) == ['blurred', 'overexposed']
+
+
+def test_missing_and_corrupt_images(tmp_path):
+    checker = HealthChecker(str(tmp_path))
+    path = str(tmp_path / 'capture.jpg')
+
+    assert checker.check_image(path)[0] == ['missing']
+    with open(path, 'wb') as outfile:
+        outfile.write(b'\xff\xd8' + b'\x00' * 100)
+    assert checker.check_image(path)[0] == ['corrupt']
+    assert checker.check_image(path, returncode=1)[0] == ['missing']
+
+
+def test_report(tmp_path):
+    checker = HealthChecker(str(tmp_path))
+    path = checker.report('USBSoundcardMic', '12-00-00_dur=1200secs', 1588334400,
+                          ['silence'], {'zero_ratio': 1.0})
+
+    assert os.path.dirname(path) == str(tmp_path / HEALTH_DIR)
+    with open(path) as infile:
+        record = json.load(infile)
+    assert not record['ok']
+    assert record['flags'] == ['silence']
+    assert checker.status()['alerts'] == 1
@@ -0,0 +1,106 @@
+import os
+import json
+import hashlib
+import pytest
+from http_benchmark import RangePutServer, start_server
+from integrity import HASH_ALGORITHM
+from transports.HTTPTransport import HTTPTransport, STATE_SUFFIX
+
+
+PART_SIZE = 1000
+
+
+@pytest.fixture
+def server():
+    server = start_server(RangePutServer())
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_file(upload_dir, size):
+    # A file dated in the past, so that it is ready for upload without a manifest
+    day_dir = upload_dir / '2020-05-01'
+    os.makedirs(str(day_dir))
+    path = str(day_dir / '2020-05-01T000000.wav')
+    data = os.urandom(size)
+    with open(path, 'wb') as outfile:
+        outfile.write(data)
+    os.utime(path, (0, 0))
+    return path, data
+
+
+def transport(server, parallel=2):
+    return HTTPTransport({'url': server.url, 'part_size': PART_SIZE, 'parallel': parallel})
+
+
+def test_upload_in_parts(server, tmp_path):
+    upload_dir = tmp_path / 'live_data'
+    path, data = make_file(upload_dir, 3500)
+
+    assert transport(server).upload(str(upload_dir)) == [path]
+    assert server.puts == 4
+    assert server.files['/upload/live_data/2020-05-01/2020-05-01T000000.wav'] == data
+    assert not os.path.exists(path)
+    assert not os.path.exists(path + STATE_SUFFIX)
+
+
+def test_hash_mismatch_is_uploaded_again(server, tmp_path):
+    upload_dir = tmp_path / 'live_data'
+    path, data = make_file(upload_dir, 1500)
+    entry = {'size': 1500, HASH_ALGORITHM: hashlib.sha256(b'other').hexdigest()}
+    http = transport(server)
+
+    assert not http.upload_file([http.connect()], path, str(upload_dir), entry)
+    assert os.path.exists(path)
+    assert not os.path.exists(path + STATE_SUFFIX)
+
+
+def test_resume_from_sidecar(server, tmp_path):
+    upload_dir = tmp_path / 'live_data'
+    path, data = make_file(upload_dir, 3500)
+    remote = '/upload/live_data/2020-05-01/2020-05-01T000000.wav'
+
+    # An earlier sync sent the first two parts
+    server.files[remote] = bytearray(data[:2 * PART_SIZE])
+    with open(path + STATE_SUFFIX, 'w') as sf:
+        json.dump({'size': 3500, 'part_size': PART_SIZE, 'done': [0, 1]}, sf)
+
+    assert transport(server).upload(str(upload_dir)) == [path]
+    assert server.puts == 2
+    assert server.received == 1500
+    assert server.files[remote] == data
+
+
+def test_server_error_mid_upload(server, tmp_path):
+    upload_dir = tmp_path / 'live_data'
+    path, data = make_file(upload_dir, 3500)
+    server.fail_puts = set([2])
+
+    assert transport(server, parallel=1).upload(str(upload_dir)) == []
+    assert os.path.exists(path)
+    with open(path + STATE_SUFFIX) as sf:
+        assert json.load(sf)['done'] == [0]
+
+    # The next sync sends only the parts that did not succeed
+    assert transport(server, parallel=1).upload(str(upload_dir)) == [path]
+    assert server.puts == 5
+    assert server.files['/upload/live_data/2020-05-01/2020-05-01T000000.wav'] == data
+
+
+def test_server_without_ranges(tmp_path):
+    server = start_server(RangePutServer(ranges=False))
+    try:
+        upload_dir = tmp_path / 'live_data'
+        path, data = make_file(upload_dir, 3500)
+        http = transport(server)
+
+        # Each part replaces the last, so the file is kept and sent whole next time
+        assert http.upload(str(upload_dir)) == []
+        assert os.path.exists(path)
+        assert not http.ranges
+        assert http.upload(str(upload_dir)) == [path]
+        assert server.files['/upload/live_data/2020-05-01/2020-05-01T000000.wav'] == data
+    finally:
+        server.shutdown()
+        server.server_close()
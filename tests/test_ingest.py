@@ -0,0 +1,203 @@
+import os
+import json
+import time
+import hashlib
+
+from bundler import Bundler
+from ingest import Ingest, QUARANTINE_DIR, STATUS_NAME
+
+
+DEVICE = '00000000abcdef01'
+AUDIO = os.path.join('2020-05-01', '12-00-00_dur=1200secs.mp3')
+AUDIO_ARCHIVE = os.path.join(DEVICE, 'USBSoundcardMic', '2020', '2020-05-01',
+                             '12-00-00_dur=1200secs.mp3')
+
+
+def upload(landing, relpath, data, age=7200, device=DEVICE):
+    """
+    Write a file into the landing area as if uploaded age seconds ago.
+
+    Returns:
+        The path of the file.
+    """
+
+    path = os.path.join(str(landing), device, relpath)
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as outfile:
+        outfile.write(data)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return path
+
+
+def write_manifest(landing, entries, name='20200501_120000.jsonl', device=DEVICE):
+    """
+    Upload a batch manifest of (relpath, data) entries.
+    """
+
+    lines = [json.dumps({'name': relpath, 'size': len(data),
+                         'sha256': hashlib.sha256(data).hexdigest()}) + '\n'
+             for relpath, data in entries]
+    return upload(landing, os.path.join('manifests', name), ''.join(lines).encode('utf-8'),
+                  device=device)
+
+
+def make_ingest(tmp_path, **kwargs):
+    os.makedirs(str(tmp_path / 'landing'))
+    return Ingest(str(tmp_path / 'landing'), str(tmp_path / 'archive'), workers=2,
+                  settle_time=60, orphan_time=3600, **kwargs)
+
+
+def test_verified_move(tmp_path):
+    ingest = make_ingest(tmp_path)
+    landing, archive = tmp_path / 'landing', tmp_path / 'archive'
+    data = b'audio' * 100
+    path = upload(landing, AUDIO, data)
+    write_manifest(landing, [(AUDIO, data)])
+
+    totals = ingest.run_once()
+
+    assert totals['files'] == 1
+    assert totals['bytes'] == len(data)
+    assert not os.path.exists(path)
+    with open(str(archive / AUDIO_ARCHIVE), 'rb') as infile:
+        assert infile.read() == data
+    assert os.path.exists(str(archive / DEVICE / 'manifests' / '20200501_120000.jsonl'))
+    files = ingest.files(DEVICE, 0, time.time())
+    assert [f['path'] for f in files] == [AUDIO_ARCHIVE]
+    assert files[0]['verified'] == 1
+    assert files[0]['sensor'] == 'USBSoundcardMic'
+    ingest.close()
+
+
+def test_quarantine_on_mismatch(tmp_path):
+    ingest = make_ingest(tmp_path)
+    landing, archive = tmp_path / 'landing', tmp_path / 'archive'
+    short = os.path.join('2020-05-01', '12-20-00_dur=1200secs.mp3')
+    corrupt = os.path.join('2020-05-01', '12-40-00_dur=1200secs.mp3')
+    upload(landing, short, b'x' * 50)
+    upload(landing, corrupt, b'y' * 100)
+    write_manifest(landing, [(short, b'x' * 100), (corrupt, b'z' * 100)])
+
+    totals = ingest.run_once()
+
+    assert totals['files'] == 0
+    assert totals['quarantined'] == 2
+    for relpath in [short, corrupt]:
+        assert os.path.exists(str(archive / QUARANTINE_DIR / DEVICE / relpath))
+    assert ingest.status()[0]['quarantined'] == 2
+    ingest.close()
+
+
+def test_recent_size_mismatch_waits(tmp_path):
+    # A file still arriving is not quarantined until orphan_time has passed
+    ingest = make_ingest(tmp_path)
+    path = upload(tmp_path / 'landing', AUDIO, b'x' * 50, age=600)
+    write_manifest(tmp_path / 'landing', [(AUDIO, b'x' * 100)])
+
+    totals = ingest.run_once()
+
+    assert totals['waiting'] == 1
+    assert totals['quarantined'] == 0
+    assert os.path.exists(path)
+    ingest.close()
+
+
+def test_orphan_waits_for_manifest(tmp_path):
+    ingest = make_ingest(tmp_path)
+    archive = tmp_path / 'archive'
+    path = upload(tmp_path / 'landing', AUDIO, b'audio', age=600)
+
+    totals = ingest.run_once()
+    assert totals['waiting'] == 1
+    assert os.path.exists(path)
+
+    # After orphan_time without a manifest entry, it is taken unverified
+    old = time.time() - 7200
+    os.utime(path, (old, old))
+    totals = ingest.run_once()
+    assert totals['files'] == 1
+    assert os.path.exists(str(archive / AUDIO_ARCHIVE))
+    assert ingest.files(DEVICE, 0, time.time())[0]['verified'] == 0
+    ingest.close()
+
+
+def test_duplicate_upload(tmp_path):
+    ingest = make_ingest(tmp_path)
+    landing, archive = tmp_path / 'landing', tmp_path / 'archive'
+    upload(landing, AUDIO, b'audio')
+    ingest.run_once()
+
+    # The same file uploaded again is dropped
+    path = upload(landing, AUDIO, b'audio')
+    totals = ingest.run_once()
+    assert totals['files'] == 0
+    assert totals['quarantined'] == 0
+    assert not os.path.exists(path)
+
+    # A different file under the same name is quarantined
+    upload(landing, AUDIO, b'other')
+    totals = ingest.run_once()
+    assert totals['quarantined'] == 1
+    with open(str(archive / AUDIO_ARCHIVE), 'rb') as infile:
+        assert infile.read() == b'audio'
+    assert os.path.exists(str(archive / QUARANTINE_DIR / DEVICE / AUDIO))
+    ingest.close()
+
+
+def test_bundle_restore(tmp_path):
+    # Bundle small files on a device, then upload the sealed archive
+    device_dir = tmp_path / 'device'
+    names = [os.path.join('2020-05-01', '2020-05-01T12:00:{:02d}.jpg'.format(n)) for n in range(3)]
+    for relpath in names:
+        upload(device_dir, relpath, b'image', device='')
+    bundler = Bundler(str(device_dir), small_file_size=1000, settle_time=0)
+    bundler.bundle()
+    bundler.seal()
+    bundle_dir = device_dir / 'bundles'
+    bundle = os.listdir(str(bundle_dir))[0]
+
+    ingest = make_ingest(tmp_path)
+    landing, archive = tmp_path / 'landing', tmp_path / 'archive'
+    with open(str(bundle_dir / bundle), 'rb') as infile:
+        path = upload(landing, os.path.join('bundles', bundle), infile.read())
+
+    totals = ingest.run_once()
+
+    assert totals['files'] == 3
+    assert not os.path.exists(path)
+    for relpath in names:
+        fname = os.path.basename(relpath)
+        assert os.path.exists(str(archive / DEVICE / 'TimelapseCamera' / '2020' / '2020-05-01' /
+                                  fname))
+    ingest.close()
+
+
+def test_device_states(tmp_path):
+    ingest = make_ingest(tmp_path)
+    landing, archive = tmp_path / 'landing', tmp_path / 'archive'
+
+    # Recent data from one device, only a log from another, nothing new from a third
+    recent = time.localtime(time.time() - 3600)
+    audio = os.path.join(time.strftime('%Y-%m-%d', recent),
+                         time.strftime('%H-%M-%S', recent) + '_dur=1200secs.mp3')
+    upload(landing, audio, b'audio', age=600, device='live')
+    write_manifest(landing, [(audio, b'audio')], device='live')
+    upload(landing, os.path.join('logs', 'rpi_eco.log'), b'log', age=600, device='no_data')
+    write_manifest(landing, [(os.path.join('logs', 'rpi_eco.log'), b'log')], device='no_data')
+    upload(landing, AUDIO, b'audio', age=86400, device='stale')
+
+    ingest.run_once()
+
+    states = dict((d['device'], d['state']) for d in ingest.status())
+    assert states == {'live': 'live', 'no_data': 'no_data', 'stale': 'stale'}
+    with open(str(archive / STATUS_NAME)) as infile:
+        status = json.load(infile)
+    assert sorted(d['device'] for d in status['devices']) == ['live', 'no_data', 'stale']
+
+    # Devices go stale once nothing has been uploaded for stale_time
+    ingest.stale_time = 60
+    ingest.run_once()
+    assert all(d['state'] == 'stale' for d in ingest.status())
+    ingest.close()
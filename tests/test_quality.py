@@ -0,0 +1,125 @@
+import os
+
+from catalog import Catalog
+from quality import QualityController, VBR_KBPS
+
+
+SYNC_INTERVAL = 1200
+
+
+def run_link(controller, capacity, syncs, backlog=0):
+    """
+    Simulate a recorder staging audio at the controller's level and a link
+    sending up to capacity bytes per second between syncs.
+
+    Args:
+        controller: A QualityController
+        capacity: A function of the sync number giving the link rate in bytes per second
+        syncs: The number of syncs to simulate
+        backlog: The bytes waiting at the start
+    Returns:
+        A list of (level, backlog bytes) after each sync.
+    """
+
+    history = []
+    for sync in range(syncs):
+        backlog += VBR_KBPS[controller.level] * 1000 / 8 * SYNC_INTERVAL
+        rate = capacity(sync)
+        sent = min(backlog, rate * SYNC_INTERVAL)
+        backlog -= sent
+        controller.update(backlog, sent, sent / rate if rate else SYNC_INTERVAL)
+        history.append((controller.level, backlog))
+    return history
+
+
+def test_fast_link_keeps_best_quality():
+    controller = QualityController(best_level=0, worst_level=6)
+    history = run_link(controller, lambda sync: 1e6, 50)
+    assert all(level == 0 for level, backlog in history)
+    assert history[-1][1] == 0
+
+
+def test_slow_link_lowers_quality_until_backlog_drains():
+    # The link carries 150 kbps, below V0 (245 kbps) but above V6 (115 kbps)
+    controller = QualityController(best_level=0, worst_level=6, target_drain=3600)
+    history = run_link(controller, lambda sync: 150000 / 8.0, 200)
+
+    # The level settles between the best and worst, near the link rate, and
+    # the backlog stops growing
+    levels = [level for level, backlog in history[100:]]
+    assert 0 < min(levels) and max(levels) < 6
+    backlogs = [backlog for level, backlog in history[100:]]
+    assert max(backlogs) < 2 * 3600 * 150000 / 8.0
+    assert controller.drain_time < 2 * 3600
+
+
+def test_link_outage_and_recovery():
+    # No data is sent for a day, then the link returns at full speed
+    controller = QualityController(best_level=0, worst_level=6, target_drain=3600)
+    outage = 72
+    history = run_link(controller, lambda sync: 0 if sync < outage else 1e6, 150)
+
+    assert history[outage - 1][0] == 6
+    assert history[-1] == (0, 0)
+
+
+def test_catalog_counts_bundled_files_once(tmp_path):
+    # Files removed into a bundle are not counted as sent until the bundle is
+    upload_dir = tmp_path / 'upload'
+    os.makedirs(str(upload_dir / 'bundles'))
+    catalog = Catalog(str(tmp_path / 'catalog.sqlite'), str(upload_dir))
+
+    paths = []
+    for index in range(3):
+        path = str(upload_dir / 'log{}.log'.format(index))
+        with open(path, 'wb') as outfile:
+            outfile.write(b'x' * 100)
+        catalog.add(path, 100, 'digest')
+        paths.append(path)
+    assert catalog.backlog() == (3, 300)
+
+    bundle = str(upload_dir / 'bundles' / 'bundle_20200501_000000.tar')
+    catalog.mark_bundled(paths, bundle)
+    for path in paths:
+        os.remove(path)
+    assert catalog.reconcile() == 0
+    assert catalog.backlog() == (0, 0)
+
+    with open(bundle, 'wb') as outfile:
+        outfile.write(b'x' * 250)
+    catalog.add(bundle, 250, 'digest')
+    assert catalog.backlog() == (1, 250)
+
+    os.remove(bundle)
+    assert catalog.mark_uploaded([bundle]) == (1, 250)
+    assert catalog.reconcile() == 0
+    assert catalog.backlog() == (0, 0)
+    assert catalog.status()['uploaded']['files'] == 4
+    catalog.close()
+
+
+def test_catalog_does_not_count_local_removals_as_sent(tmp_path):
+    # Only files reported as sent by a transport count towards the throughput
+    upload_dir = tmp_path / 'upload'
+    os.makedirs(str(upload_dir))
+    catalog = Catalog(str(tmp_path / 'catalog.sqlite'), str(upload_dir))
+
+    paths = []
+    for name in ('sent.mp3', 'replaced.wav', 'deleted.log'):
+        path = str(upload_dir / name)
+        with open(path, 'wb') as outfile:
+            outfile.write(b'x' * 100)
+        catalog.add(path, 100, 'digest')
+        paths.append(path)
+    for path in paths:
+        os.remove(path)
+
+    catalog.mark_replaced([paths[1]])
+    assert catalog.mark_uploaded([paths[0]]) == (1, 100)
+    assert catalog.reconcile() == 1
+    assert catalog.backlog() == (0, 0)
+    status = catalog.status()
+    assert status['uploaded']['files'] == 1
+    assert status['replaced']['files'] == 1
+    assert status['missing']['files'] == 1
+    catalog.close()
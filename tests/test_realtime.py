@@ -0,0 +1,30 @@
+from realtime import UploadTrigger
+
+
+def test_latency_of_sent_files(monkeypatch):
+    monkeypatch.setattr('clock.time', lambda: 1000.0)
+    trigger = UploadTrigger()
+    trigger.staged('a.mp3', {'end': 900.0})
+    trigger.staged('b.mp3', {'end': 950.0})
+
+    # Only the files the transport reports as sent are measured
+    trigger.synced(['a.mp3', 'other.mp3'])
+
+    metrics = trigger.metrics()
+    assert metrics['measured'] == 1
+    assert metrics['max'] == 100.0
+    assert metrics['waiting'] == 1
+
+
+def test_pending_is_bounded():
+    trigger = UploadTrigger(max_pending=100)
+    for index in range(250):
+        trigger.staged('{}.jpg'.format(index), {'end': float(index)})
+
+    metrics = trigger.metrics()
+    assert metrics['waiting'] == 100
+    assert metrics['dropped'] == 150
+
+    # The newest files are kept
+    trigger.synced(['0.jpg', '249.jpg'])
+    assert trigger.metrics()['measured'] == 1
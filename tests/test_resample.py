@@ -0,0 +1,119 @@
+import wave
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from sensors import resample
+
+
+IN_RATE = 44100
+DURATION = 2.0
+
+
+def write_tones(path, tones, rate=IN_RATE, duration=DURATION):
+    """
+    Write a 16 bit mono WAV file holding a sum of sine tones.
+
+    Args:
+        path: The path of the WAV file
+        tones: A list of (frequency in Hz, amplitude as a fraction of full scale)
+    """
+
+    t = np.arange(int(rate * duration)) / float(rate)
+    signal = sum(amp * np.sin(2 * np.pi * freq * t) for freq, amp in tones)
+    writer = wave.open(str(path), 'wb')
+    writer.setnchannels(1)
+    writer.setsampwidth(2)
+    writer.setframerate(rate)
+    writer.writeframes(np.round(signal * 32767).astype('<i2').tobytes())
+    writer.close()
+
+
+def read_wav(path):
+    reader = wave.open(str(path), 'rb')
+    rate = reader.getframerate()
+    data = np.frombuffer(reader.readframes(reader.getnframes()), '<i2') / 32768.0
+    reader.close()
+    return data, rate
+
+
+def tone_snr(data, rate, freq, edge=0.05):
+    """
+    Fit a sine of the given frequency to the output, away from the edges, and
+    find the ratio of its power to the power of the residual.
+
+    Returns:
+        A tuple of the fitted amplitude and the SNR in dB.
+    """
+
+    trim = int(edge * rate)
+    data = data[trim:-trim]
+    t = (np.arange(len(data)) + trim) / float(rate)
+    basis = np.column_stack([np.sin(2 * np.pi * freq * t), np.cos(2 * np.pi * freq * t)])
+    coef = np.linalg.lstsq(basis, data, rcond=None)[0]
+    fitted = basis.dot(coef)
+    residual = data - fitted
+    snr = 10 * np.log10(np.mean(fitted ** 2) / np.mean(residual ** 2))
+    return np.hypot(*coef), snr
+
+
+@pytest.mark.parametrize('out_rate', [16000, 22050, 48000])
+def test_resample_length_and_snr(tmp_path, out_rate):
+    infile = tmp_path / 'in.wav'
+    outfile = tmp_path / 'out.wav'
+    write_tones(infile, [(1000, 0.5)])
+
+    n_out = resample.resample_wav(str(infile), str(outfile), out_rate)
+    data, rate = read_wav(outfile)
+
+    assert rate == out_rate
+    assert n_out == len(data) == int(IN_RATE * DURATION) * out_rate // IN_RATE
+
+    amplitude, snr = tone_snr(data, rate, 1000)
+    assert amplitude == pytest.approx(0.5, rel=0.01)
+    assert snr > 80
+
+
+def test_resample_removes_aliases(tmp_path):
+    # A tone above the output Nyquist frequency must not fold into the band
+    infile = tmp_path / 'in.wav'
+    outfile = tmp_path / 'out.wav'
+    write_tones(infile, [(1000, 0.5), (12000, 0.3)])
+
+    resample.resample_wav(str(infile), str(outfile), 16000)
+    data, rate = read_wav(outfile)
+
+    amplitude, snr = tone_snr(data, rate, 1000)
+    assert amplitude == pytest.approx(0.5, rel=0.01)
+    assert snr > 80
+
+
+def test_band_pass(tmp_path):
+    # Tones below and above the pass band are removed, the tone inside is kept
+    infile = tmp_path / 'in.wav'
+    outfile = tmp_path / 'out.wav'
+    write_tones(infile, [(100, 0.3), (1000, 0.3), (6000, 0.3)])
+
+    n_out = resample.resample_wav(str(infile), str(outfile), 16000, highpass=300, lowpass=3000)
+    data, rate = read_wav(outfile)
+
+    assert n_out == len(data) == int(IN_RATE * DURATION) * 16000 // IN_RATE
+    amplitude, snr = tone_snr(data, rate, 1000)
+    assert amplitude == pytest.approx(0.3, rel=0.01)
+    assert snr > 70
+
+
+def test_chunked_matches_single_pass():
+    # Streaming in chunks gives the same output as one call
+    rng = np.random.RandomState(0)
+    signal = rng.uniform(-0.5, 0.5, (10000, 2))
+
+    whole = resample.PolyphaseResampler(IN_RATE, 16000, channels=2)
+    expected = np.concatenate([whole.process(signal), whole.flush()])
+
+    chunked = resample.PolyphaseResampler(IN_RATE, 16000, channels=2)
+    parts = [chunked.process(signal[start:start + 777]) for start in range(0, len(signal), 777)]
+    actual = np.concatenate(parts + [chunked.flush()])
+
+    assert np.allclose(actual, expected)
@@ -0,0 +1,193 @@
+import sys
+import time
+import argparse
+from integrity import HashingWriter
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+"""
+Reduced resolution copies of captured images, used by TimelapseCamera to send
+small previews ahead of full resolution frames. Each tier is set by a name, a
+width in pixels, a JPEG quality and an upload priority. The full frame is
+decoded once, at the smallest size the JPEG decoder can scale to while still
+covering the largest tier, and each tier is then resized from the next larger
+one. Requires PIL.
+
+Run as a script, it benchmarks the decode, resize and encode time of a sample
+image, to check the tiers keep up with the capture rate on a device:
+
+    python tiers.py sample.jpg --tiers thumb:320:60:0,medium:1024:75:1
+"""
+
+
+def parse_tiers(spec):
+    """
+    Parse a tier specification.
+
+    Args:
+        spec: A comma separated list of tiers, each given as
+            name:width:quality:priority, for example 'thumb:320:60:0'. An
+            empty string gives no tiers.
+    Returns:
+        A list of tier dictionaries with name, width, quality and priority
+        keys, largest first.
+    Raises:
+        ValueError if the specification is not valid.
+    """
+
+    tiers = []
+    for item in spec.split(','):
+        if not item.strip():
+            continue
+        fields = item.strip().split(':')
+        if len(fields) != 4:
+            raise ValueError('Tier {} is not name:width:quality:priority'.format(item))
+        name = fields[0]
+        width, quality, priority = [int(field) for field in fields[1:]]
+        if not name.isalnum():
+            raise ValueError('Tier name {} must be letters and digits'.format(name))
+        if width <= 0 or not 1 <= quality <= 95 or priority < 0:
+            raise ValueError('Tier {} needs a positive width, a quality from 1 to 95 '
+                             'and a priority of at least 0'.format(name))
+        tiers.append({'name': name, 'width': width, 'quality': quality, 'priority': priority})
+
+    if len(set(tier['name'] for tier in tiers)) != len(tiers):
+        raise ValueError('Tier names must be unique')
+
+    return sorted(tiers, key=lambda tier: tier['width'], reverse=True)
+
+
+def decode_image(infile, width):
+    """
+    Decode a JPEG at the smallest scale covering a width, letting the decoder
+    scale down by up to 1/8 while decoding.
+
+    Args:
+        infile: The path of the JPEG
+        width: The largest width needed from the image
+    Returns:
+        An RGB PIL image at least width pixels wide, or at full size if smaller.
+    """
+
+    if Image is None:
+        raise ImportError('PIL is required to make image tiers')
+
+    image = Image.open(infile)
+    image.draft('RGB', (width, 1))
+    return image.convert('RGB')
+
+
+def resize_image(image, width):
+    """
+    Resize an image to a width, keeping the aspect ratio. Images are never
+    enlarged.
+
+    Args:
+        image: A PIL image
+        width: The width in pixels
+    Returns:
+        The resized image, or the same image if it is no wider than width.
+    """
+
+    if image.size[0] <= width:
+        return image
+    height = max(int(round(image.size[1] * width / float(image.size[0]))), 1)
+    return image.resize((width, height), Image.BILINEAR)
+
+
+def make_tiers(infile, tiers, outfiles):
+    """
+    Write the tiers of an image from a single decode.
+
+    Args:
+        infile: The path of the full resolution JPEG
+        tiers: A list of tier dictionaries from parse_tiers(), largest first
+        outfiles: A list of the paths to write each tier to
+    Returns:
+        A list of (width, height, size, digest) tuples, one for each tier.
+    """
+
+    image = decode_image(infile, tiers[0]['width'])
+    results = []
+    for tier, outfile in zip(tiers, outfiles):
+        image = resize_image(image, tier['width'])
+        writer = HashingWriter(outfile)
+        try:
+            image.save(writer, 'JPEG', quality=tier['quality'], optimize=True)
+        finally:
+            digest = writer.close()
+        results.append((image.size[0], image.size[1], writer.size, digest))
+
+    return results
+
+
+class _CountingWriter(object):
+    # Counts the bytes written by the benchmark, which discards them
+
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+def benchmark(infile, tiers, repeats=10):
+    """
+    Time the decode, resize and encode of the tiers of an image.
+
+    Args:
+        infile: The path of a full resolution JPEG
+        tiers: A list of tier dictionaries from parse_tiers(), largest first
+        repeats: The number of times to make the tiers
+    Returns:
+        A dictionary of the mean time in seconds to decode the image, the mean
+        time to resize and encode each tier and its file size, and the number of
+        frames per second the tiers can be made at.
+    """
+
+    decode = 0.0
+    encode = [0.0] * len(tiers)
+    sizes = [0] * len(tiers)
+    for _ in range(repeats):
+        started = time.time()
+        image = decode_image(infile, tiers[0]['width'])
+        decode += time.time() - started
+
+        for index, tier in enumerate(tiers):
+            started = time.time()
+            image = resize_image(image, tier['width'])
+            writer = _CountingWriter()
+            image.save(writer, 'JPEG', quality=tier['quality'], optimize=True)
+            encode[index] += time.time() - started
+            sizes[index] = writer.size
+
+    total = (decode + sum(encode)) / repeats
+    return {'decode': decode / repeats,
+            'tiers': dict((tier['name'], {'secs': secs / repeats, 'size': size})
+                          for tier, secs, size in zip(tiers, encode, sizes)),
+            'frames_per_sec': 1 / total if total else None}
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark making image tiers')
+    parser.add_argument('image', help='A full resolution JPEG')
+    parser.add_argument('--tiers', default='thumb:320:60:0,medium:1024:75:1',
+                        help='The tiers, as name:width:quality:priority separated by commas')
+    parser.add_argument('--repeats', type=int, default=10, help='The number of runs to average')
+    args = parser.parse_args()
+
+    try:
+        result = benchmark(args.image, parse_tiers(args.tiers), args.repeats)
+    except (ImportError, ValueError) as e:
+        sys.exit(str(e))
+
+    print('Decode: {:.3f} secs'.format(result['decode']))
+    for name, tier in sorted(result['tiers'].items()):
+        print('{}: resize and encode {:.3f} secs, {:.1f} kB'.format(name, tier['secs'],
+                                                                  tier['size'] / 1000.0))
+    print('{:.1f} frames per second'.format(result['frames_per_sec']))
@@ -0,0 +1,365 @@
+import os
+import sys
+import json
+import time
+import struct
+import signal
+import argparse
+import threading
+import multiprocessing
+import logging
+try:
+    from shutil import which as find_executable
+except ImportError:
+    # Python 2
+    from distutils.spawn import find_executable
+from sensors.USBSoundcardMic import USBSoundcardMic
+from supervisor import run_command
+from integrity import (Manifest, PART_SUFFIX, UPLOAD_LOCK_NAME, UploadLock, hash_file,
+                       record_replaced, record_staged, set_catalog, set_manifest)
+from catalog import Catalog, parse_name
+
+
+"""
+A batch tool to compress a backlog of WAV recordings to mp3, for example after
+an encoder failure or a change of the compress_data setting. The recorder
+stages raw audio that failed to compress in the upload directory, so it is
+found there. Files are found by scanning directories or read from a list, and
+are encoded oldest first by a pool of worker processes, one per core by default
+less one left for live capture. The workers run at low CPU and IO priority, so
+that a running recorder is not held up.
+
+Each mp3 is written with a .part suffix and renamed once complete, and the WAV
+is only removed after that, so an interrupted run can simply be started again.
+WAV files in a live upload directory are claimed before they are encoded, by
+renaming them under the recorder's upload lock, so that the sync does not send
+or remove them part way through. Given the recorder config, mp3 files in the
+upload directory are added to the manifest and catalog like files staged by
+the recorder.
+
+    python transcode.py /home/pi/continuous_monitoring_data/live_data/<PI_ID>
+    python transcode.py --list wavs.txt --jobs 2 --config config.json
+"""
+
+# WAV files being encoded from an upload directory are renamed with this
+# suffix, which hides them from the sync
+CLAIM_SUFFIX = '.transcoding' + PART_SUFFIX
+
+# Set in each worker process, stopping the running encode on SIGTERM
+_worker_die = None
+_encoding = False
+_claimed = None
+_upload_locks = {}
+
+
+def wav_duration(path):
+    """
+    Find the duration of a WAV file from its header and size. The size is used
+    rather than the data chunk length, as arecord writing to a pipe can not
+    fill in the length.
+
+    Args:
+        path: The path of the WAV file
+    Returns:
+        A tuple of the duration in seconds and the number of channels, or (None, 1)
+        if the file can not be read.
+    """
+
+    try:
+        with open(path, 'rb') as infile:
+            if infile.read(12)[:4] != b'RIFF':
+                return None, 1
+            fmt = None
+            while True:
+                chunk_id, size = struct.unpack('<4sI', infile.read(8))
+                if chunk_id == b'fmt ':
+                    fmt = struct.unpack('<HHIIHH', infile.read(16))
+                    infile.seek(size - 16 + size % 2, 1)
+                elif chunk_id == b'data':
+                    break
+                else:
+                    infile.seek(size + size % 2, 1)
+            header = infile.tell()
+    except (IOError, struct.error):
+        return None, 1
+
+    if fmt is None:
+        return None, 1
+    _, channels, rate, _, block_align, _ = fmt
+
+    return (os.path.getsize(path) - header) / float(block_align * rate), channels
+
+
+def find_wavs(paths, settle_time=60):
+    """
+    Find WAV files to compress, skipping any still being written.
+
+    Args:
+        paths: A list of WAV files and directories to search
+        settle_time: Files modified in the last settle_time seconds are skipped
+    Returns:
+        A list of WAV file paths, oldest recording first.
+    """
+
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for subdir, dirs, files in os.walk(path):
+                found.extend(os.path.join(subdir, fname) for fname in files)
+        else:
+            found.append(path)
+
+    now = time.time()
+    # Files claimed by an interrupted run are taken up again
+    for path in found:
+        if path.endswith(CLAIM_SUFFIX) and os.path.exists(path):
+            os.rename(path, path[:-len(CLAIM_SUFFIX)])
+    found = [path[:-len(CLAIM_SUFFIX)] if path.endswith(CLAIM_SUFFIX) else path for path in found]
+
+    wavs = [path for path in found
+            if path.lower().endswith('.wav') and os.path.exists(path) and
+            now - os.path.getmtime(path) > settle_time]
+
+    def recorded(path):
+        # Order by the recording time in the file name, falling back to the file time
+        parts = os.path.normpath(path).split(os.sep)
+        start = parse_name(os.path.join(*parts[-2:]))['start']
+        return start if start is not None else os.path.getmtime(path)
+
+    return sorted(set(wavs), key=recorded)
+
+
+def _init_worker(nice):
+    # Lower the priority of the worker and the encoders it starts, and stop the
+    # running encode when the pool is terminated
+    global _worker_die
+    _worker_die = threading.Event()
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, _stop_worker)
+    if nice:
+        os.nice(nice)
+
+
+def _stop_worker(signum, frame):
+    # Exit at once if idle, otherwise once run_command has killed the encoder
+    _worker_die.set()
+    if not _encoding:
+        _unclaim()
+        os._exit(1)
+
+
+def _claim(wfile, lock_path):
+    # Rename a WAV in an upload directory out of sight of the sync, waiting for
+    # any running upload to finish. Returns the path to encode, or None if the
+    # sync has already sent the file.
+    global _claimed
+    if lock_path is None:
+        return wfile
+    if lock_path not in _upload_locks:
+        _upload_locks[lock_path] = UploadLock(lock_path)
+    with _upload_locks[lock_path]:
+        if not os.path.exists(wfile):
+            return None
+        os.rename(wfile, wfile + CLAIM_SUFFIX)
+    _claimed = wfile
+    return wfile + CLAIM_SUFFIX
+
+
+def _unclaim():
+    # Return a claimed WAV to the upload directory
+    global _claimed
+    if _claimed is not None and os.path.exists(_claimed + CLAIM_SUFFIX):
+        os.rename(_claimed + CLAIM_SUFFIX, _claimed)
+    _claimed = None
+
+
+def compress_file(task):
+    """
+    Compress a single WAV file to mp3 in a worker process.
+
+    Args:
+        task: A tuple of the WAV path, the mp3 path, a command prefix, the fast
+            flag, the timeout in seconds and the path of the upload lock if the
+            WAV is in an upload directory
+    Returns:
+        A dictionary of the result. The source is the path of the WAV to remove,
+        which is None if the sync sent the WAV before it could be claimed.
+    """
+
+    global _encoding, _claimed
+    wfile, ofile, prefix, fast, timeout, lock_path = task
+    result = {'wfile': wfile, 'ofile': ofile, 'source': None, 'returncode': None,
+              'duration': None, 'encode_secs': 0}
+
+    source = _claim(wfile, lock_path)
+    if source is None:
+        return result
+
+    duration, channels = wav_duration(source)
+    started = time.time()
+    cmd = prefix + USBSoundcardMic.compress_command(source, ofile + PART_SUFFIX, channels, fast)
+    _encoding = True
+    returncode = run_command(cmd, timeout, die=_worker_die)
+    _encoding = False
+    if _worker_die.is_set():
+        if os.path.exists(ofile + PART_SUFFIX):
+            os.remove(ofile + PART_SUFFIX)
+        _unclaim()
+        os._exit(1)
+
+    result.update({'source': source, 'returncode': returncode, 'duration': duration,
+                   'encode_secs': time.time() - started})
+
+    if returncode == 0:
+        os.rename(ofile + PART_SUFFIX, ofile)
+        result['size'] = os.path.getsize(ofile)
+        result['digest'] = hash_file(ofile)
+        _claimed = None
+    else:
+        if os.path.exists(ofile + PART_SUFFIX):
+            os.remove(ofile + PART_SUFFIX)
+        _unclaim()
+
+    return result
+
+
+def transcode(wavs, output_dir=None, jobs=None, nice=10, fast=False, timeout=3600,
+              upload_dir=None, keep=False):
+    """
+    Compress WAV files to mp3 with a pool of worker processes, oldest first.
+
+    Args:
+        wavs: A list of WAV paths in the order to compress them
+        output_dir: A directory for the mp3 files, by default beside each WAV
+        jobs: The number of worker processes, by default one less than the
+            number of cores
+        nice: The niceness added to the workers, and the encoders they start
+        fast: Should the fastest encoder algorithm be used
+        timeout: The longest time in seconds allowed to encode a file
+        upload_dir: The device upload directory. mp3 files written below it are
+            recorded in the active manifest and catalog.
+        keep: Keep the WAV files after compression
+    Returns:
+        A dictionary of the number of files compressed and failed, the hours of
+        recording compressed and the wall clock time taken.
+    """
+
+    if jobs is None:
+        jobs = max(multiprocessing.cpu_count() - 1, 1)
+
+    # Run the encoders in the idle IO class where ionice is available
+    prefix = 'ionice -c 3 ' if find_executable('ionice') else ''
+
+    # WAV files in the upload directory are claimed under the recorder's upload lock
+    lock_path = None
+    if upload_dir is not None:
+        lock_path = os.path.join(upload_dir, UPLOAD_LOCK_NAME)
+
+    tasks = []
+    for wfile in wavs:
+        odir = output_dir if output_dir is not None else os.path.dirname(wfile)
+        ofile = os.path.join(odir, os.path.splitext(os.path.basename(wfile))[0] + '.mp3')
+        live = (upload_dir is not None and
+                not os.path.relpath(wfile, upload_dir).startswith(os.pardir))
+        tasks.append((wfile, ofile, prefix, fast, timeout, lock_path if live else None))
+
+    logging.info('Compressing {} files with {} workers'.format(len(tasks), jobs))
+    stats = {'files': 0, 'failed': 0, 'recorded_hours': 0.0, 'wall_hours': 0.0}
+    started = time.time()
+    pool = multiprocessing.Pool(jobs, _init_worker, (nice,))
+    completed = False
+
+    try:
+        results = pool.imap(compress_file, tasks)
+        for _ in tasks:
+            # A timeout keeps the wait interruptible under Python 2
+            result = results.next(timeout + 60)
+            if result['source'] is None:
+                logging.info('{} was uploaded by the recorder, skipping'.format(result['wfile']))
+                continue
+            if result['returncode'] != 0:
+                logging.error('Compression of {} failed, keeping raw audio'.format(result['wfile']))
+                stats['failed'] += 1
+                continue
+
+            ofile = result['ofile']
+            if upload_dir is not None and not os.path.relpath(ofile, upload_dir).startswith(os.pardir):
+                info = parse_name(os.path.relpath(result['wfile'], upload_dir))
+                info['codec'] = 'mp3'
+                if info['start'] is not None and result['duration'] is not None:
+                    info['end'] = info['start'] + result['duration']
+                record_staged(ofile, result['size'], result['digest'], info)
+                record_replaced([result['wfile']])
+            if keep:
+                os.rename(result['source'], result['wfile'])
+            else:
+                try:
+                    os.remove(result['source'])
+                except OSError as e:
+                    logging.error('Could not remove {}: {}'.format(result['source'], e))
+
+            stats['files'] += 1
+            stats['recorded_hours'] += (result['duration'] or 0) / 3600.0
+            stats['wall_hours'] = (time.time() - started) / 3600.0
+            logging.info('Compressed {} ({}/{}), {:.1f} recorded hours per hour'.format(
+                result['wfile'], stats['files'] + stats['failed'], len(tasks),
+                stats['recorded_hours'] / stats['wall_hours']))
+        completed = True
+    except (KeyboardInterrupt, multiprocessing.TimeoutError):
+        logging.warning('Stopping, run again to compress the remaining files')
+        raise
+    finally:
+        # Stop the workers on any error, so that the join can not wait forever
+        if completed:
+            pool.close()
+        else:
+            pool.terminate()
+        pool.join()
+
+    stats['wall_hours'] = (time.time() - started) / 3600.0
+    return stats
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Compress a backlog of WAV recordings to mp3')
+    parser.add_argument('paths', nargs='*', help='WAV files or directories to search')
+    parser.add_argument('--list', help='A file listing WAV files, one per line')
+    parser.add_argument('--output-dir', help='A directory for the mp3 files, by default beside each WAV')
+    parser.add_argument('--jobs', type=int, help='The number of encoders, by default one less than the cores')
+    parser.add_argument('--nice', type=int, default=10, help='The niceness added to the encoders')
+    parser.add_argument('--fast', action='store_true', help='Use the fastest encoder algorithm')
+    parser.add_argument('--settle-time', type=int, default=60,
+                        help='Skip files modified in the last settle-time seconds')
+    parser.add_argument('--keep', action='store_true', help='Keep the WAV files after compression')
+    parser.add_argument('--config', help='The recorder config, to record mp3 files staged in '
+                                         'the upload directory in the manifest and catalog')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+
+    paths = list(args.paths)
+    if args.list:
+        with open(args.list) as listfile:
+            paths.extend(line.strip() for line in listfile if line.strip())
+    if not paths:
+        parser.error('No WAV files or directories given')
+
+    upload_dir = None
+    if args.config:
+        config = json.load(open(args.config))
+        upload_dir = os.path.join(config['sys']['upload_dir'], 'live_data',
+                                  os.environ.get('PI_ID', 'CPU_SERIAL_ERROR'))
+        if not config['offline_mode']:
+            set_manifest(Manifest(upload_dir))
+        set_catalog(Catalog(config['sys'].get('catalog_file', 'catalog.sqlite'), upload_dir))
+
+    wavs = find_wavs(paths, args.settle_time)
+    stats = transcode(wavs, args.output_dir, args.jobs, args.nice, args.fast,
+                      upload_dir=upload_dir, keep=args.keep)
+
+    rate = stats['recorded_hours'] / stats['wall_hours'] if stats['wall_hours'] else 0
+    logging.info('Compressed {} files ({} failed): {:.2f} recorded hours in {:.2f} hours, '
+                 '{:.1f} recorded hours per hour'.format(stats['files'], stats['failed'],
+                                                         stats['recorded_hours'],
+                                                         stats['wall_hours'], rate))
@@ -0,0 +1,306 @@
+import os
+import sys
+import socket
+import ftplib
+import logging
+import sensors
+from transports.TransportBase import TransportBase
+from integrity import HASH_ALGORITHM
+from supervisor import run_command
+
+
+# lftp uses implicit TLS for ftps:// URLs, on this port unless one is given
+FTPS_PORT = 990
+
+
+class ImplicitFTP_TLS(ftplib.FTP_TLS):
+    """
+    An FTP_TLS client using implicit TLS, where the connection is encrypted from
+    the start rather than upgraded with AUTH TLS. This is what lftp does for
+    ftps:// URLs, on port 990 by default.
+    """
+
+    def connect(self, host='', port=0, timeout=-999):
+        """
+        Connect to the server and wrap the socket before reading the welcome.
+        Login then skips AUTH TLS, as the control connection is already secure.
+        """
+
+        if host:
+            self.host = host
+        if port:
+            self.port = port
+        if timeout != -999:
+            self.timeout = timeout
+        sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.af = sock.family
+        self.sock = self.context.wrap_socket(sock, server_hostname=self.host)
+        if sys.version_info[0] < 3:
+            self.file = self.sock.makefile('rb')
+        else:
+            self.file = self.sock.makefile('r', encoding=self.encoding)
+        self.welcome = self.getresp()
+        return self.welcome
+
+
+class FTPTransport(TransportBase):
+
+    def __init__(self, config=None):
+
+        """
+        A class to upload data to an FTP or FTPS server by mirroring the upload
+        directory with lftp.
+
+        Args:
+            config: The ftp section of the config, used to replace the
+            default settings of the transport.
+        """
+
+        opts = self.options()
+        opts = {var['name']: var for var in opts}
+
+        self.uname = sensors.set_option('uname', config, opts)
+        self.pword = sensors.set_option('pword', config, opts)
+        self.host = sensors.set_option('host', config, opts)
+        self.use_ftps = sensors.set_option('use_ftps', config, opts)
+        self.verify_uploads = sensors.set_option('verify_uploads', config, opts)
+        self.sync_timeout = sensors.set_option('sync_timeout', config, opts)
+        self.port = sensors.set_option('port', config, opts)
+
+        # Set when uploads could not be verified, so that the next sync removes
+        # local files as lftp transfers them rather than filling the disk
+        self.remove_next_sync = False
+
+    @staticmethod
+    def options():
+        """
+        Static method defining the config options and defaults for the transport class
+        """
+        return [{'name': 'uname',
+                 'type': str,
+                 'prompt': 'Enter FTP server username'},
+                {'name': 'pword',
+                 'type': str,
+                 'prompt': 'Enter FTP server password'},
+                {'name': 'host',
+                 'type': str,
+                 'prompt': 'Enter FTP server hostname'},
+                {'name': 'use_ftps',
+                 'type': int,
+                 'default': 1,
+                 'valid': [0, 1],
+                 'prompt': 'Use FTPS (1) or FTP (0)?'},
+                {'name': 'verify_uploads',
+                 'type': int,
+                 'default': 1,
+                 'valid': [0, 1],
+                 'prompt': 'Verify uploads before removing local files (1) or not (0)?'},
+                {'name': 'sync_timeout',
+                 'type': int,
+                 'default': 3600,
+                 'prompt': 'What is the maximum time in seconds for a single sync?'},
+                {'name': 'port',
+                 'type': int,
+                 'default': 0,
+                 'prompt': 'What is the server port (0 for 990 with FTPS or 21 with FTP)?'}
+                ]
+
+    def ftp_string(self):
+        """
+        Method to build the lftp connection string
+        """
+
+        protocol = 'ftps' if self.use_ftps else 'ftp'
+        address = self.host
+        if self.port:
+            address = '{}:{}'.format(self.host, self.port)
+        return '{}://{}:{}@{}'.format(protocol, self.uname, self.pword, address)
+
+    def server_port(self):
+        """
+        Method giving the port lftp connects to, which is the configured port or
+        the default for the protocol: 990 for implicit FTPS and 21 for FTP.
+        """
+
+        if self.port:
+            return self.port
+        return FTPS_PORT if self.use_ftps else ftplib.FTP_PORT
+
+    def probe_address(self):
+        return self.host, self.server_port()
+
+    def upload(self, upload_dir, manifest=None, die=None):
+        """
+        Method to mirror the upload directory to the server. Without upload
+        verification, lftp removes local files as soon as they are transferred.
+
+        Args:
+            upload_dir: The upload directory to synchronise
+            manifest: An optional Manifest holding checksums of staged files
+            die: An optional threading event to stop the upload
+        Returns:
+            A list of the paths of the files verified and removed, or without
+            verification, the files lftp removed.
+        """
+
+        verify = manifest is not None and self.verify_uploads and not self.remove_next_sync
+        remove_flag = '' if verify else '--Remove-source-files'
+        if self.remove_next_sync:
+            logging.warning('Removing local files as they are uploaded, without verification')
+            self.remove_next_sync = False
+
+        # lftp removes the files it has sent when not verifying
+        before = self.local_files(upload_dir) if not verify else None
+
+        run_command('bash ./ftp_upload.sh {} {} {}'.format(self.ftp_string(), upload_dir, remove_flag),
+                    timeout=self.sync_timeout, die=die)
+
+        if not verify:
+            return sorted(before - self.local_files(upload_dir))
+        if die is not None and die.is_set():
+            return []
+        return self.verify(upload_dir, manifest)[0]
+
+    def connect(self):
+        """
+        Method to open an ftplib connection to the server in binary mode, in the
+        same mode and on the same port as lftp
+
+        Returns:
+            A logged in ftplib.FTP instance.
+        """
+
+        if self.use_ftps:
+            ftp = ImplicitFTP_TLS(timeout=60)
+        else:
+            ftp = ftplib.FTP(timeout=60)
+
+        ftp.connect(self.host, self.server_port())
+        ftp.login(self.uname, self.pword)
+        if self.use_ftps:
+            ftp.prot_p()
+        ftp.voidcmd('TYPE I')
+        try:
+            ftp.sendcmd('OPTS HASH SHA-256')
+        except ftplib.error_perm:
+            pass
+
+        return ftp
+
+    def verify(self, upload_dir, manifest, settle_time=60):
+        """
+        Remove local files that have been uploaded intact. Every file in the upload
+        directory is checked against the remote size and, where the server supports
+        it and a hash was recorded at staging, the remote hash. A remote file that
+        fails the check is deleted so that it is uploaded again at the next sync.
+
+        Args:
+            upload_dir: The upload directory synchronised by ftp_upload.sh
+            manifest: The Manifest instance for the device
+            settle_time: Files without a manifest entry that were modified in the
+                last settle_time seconds may still be being written and are kept
+        Returns:
+            A tuple of the list of files verified and removed and the number that
+            failed.
+        """
+
+        try:
+            ftp = self.connect()
+        except ftplib.all_errors as e:
+            logging.error('Could not connect to verify uploads, local files will be removed '
+                          'as they are uploaded at the next sync: {}'.format(e))
+            self.remove_next_sync = True
+            return [], 0
+
+        files, entries = self.pending_files(upload_dir, manifest, settle_time)
+        verified = []
+        n_failed = 0
+
+        try:
+            for path in files:
+                if os.path.dirname(path) == manifest.manifest_dir:
+                    # Manifests can go once none of their files remain
+                    if any(os.path.exists(f) for f in manifest.read(path)):
+                        continue
+
+                if self.verify_file(ftp, path, upload_dir, entries.get(path)):
+                    os.remove(path)
+                    verified.append(path)
+                else:
+                    n_failed += 1
+        except ftplib.all_errors as e:
+            logging.error('Upload verification interrupted: {}'.format(e))
+        finally:
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+
+        logging.info('Verified {} uploaded files, {} not yet uploaded or failed'.format(
+            len(verified), n_failed))
+
+        return verified, n_failed
+
+    def verify_file(self, ftp, path, upload_dir, entry):
+        """
+        Check a single local file against its remote copy, deleting a remote
+        copy that does not match.
+
+        Args:
+            ftp: A connected ftplib.FTP instance
+            path: The local file path
+            upload_dir: The top level upload directory
+            entry: The manifest entry for the file or None
+        Returns:
+            A boolean showing if the remote copy is intact.
+        """
+
+        remote_path = self.remote_path(path, upload_dir)
+
+        try:
+            remote_size = ftp.size(remote_path)
+        except ftplib.error_perm:
+            # not uploaded yet
+            return False
+
+        local_size = os.path.getsize(path)
+        if remote_size != local_size:
+            logging.error('Remote size of {} is {}, expected {}. Removing remote copy'.format(
+                remote_path, remote_size, local_size))
+            ftp.delete(remote_path)
+            return False
+
+        if entry is not None and entry['size'] == local_size:
+            remote_hash = self.remote_hash(ftp, remote_path)
+            if remote_hash is not None and remote_hash != entry[HASH_ALGORITHM]:
+                logging.error('Remote hash of {} does not match. Removing remote copy'.format(remote_path))
+                ftp.delete(remote_path)
+                return False
+
+        return True
+
+    @staticmethod
+    def remote_hash(ftp, remote_path):
+        """
+        Ask the server for the SHA-256 of a remote file, trying the HASH command
+        and then the XSHA256 extension.
+
+        Args:
+            ftp: A connected ftplib.FTP instance
+            remote_path: The path of the remote file
+        Returns:
+            The lower case hex digest or None if the server does not support hashes.
+        """
+
+        try:
+            resp = ftp.sendcmd('HASH {}'.format(remote_path))
+            # 213 SHA-256 0-1234 <hex> <path>
+            return resp.split()[3].lower()
+        except (ftplib.error_perm, IndexError):
+            pass
+
+        try:
+            resp = ftp.sendcmd('XSHA256 {}'.format(remote_path))
+            return resp.split()[1].lower()
+        except (ftplib.error_perm, IndexError):
+            return None
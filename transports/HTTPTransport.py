@@ -0,0 +1,289 @@
+import os
+import ssl
+import json
+import socket
+import logging
+import threading
+import sensors
+from transports.TransportBase import TransportBase
+from integrity import HASH_ALGORITHM, PART_SUFFIX
+
+try:
+    import httplib
+    from urlparse import urlparse
+    from urllib import quote
+    from Queue import Queue, Empty
+except ImportError:
+    import http.client as httplib
+    from urllib.parse import urlparse, quote
+    from queue import Queue, Empty
+
+# Suffix of the sidecar file recording the uploaded parts of a file, for resuming
+STATE_SUFFIX = '.upload' + PART_SUFFIX
+
+
+class HTTPTransport(TransportBase):
+
+    def __init__(self, config=None):
+
+        """
+        A class to upload data with HTTP(S) PUT requests, for networks that block
+        FTP. Files are sent in parts using Content-Range headers, with several
+        parts in flight at once over persistent keep-alive connections. The
+        parts already sent are recorded beside each file, so an interrupted
+        upload resumes with the remaining parts. The endpoint should write each
+        part at its offset and report the stored size in response to HEAD. This
+        is not S3 multipart upload: an endpoint that ignores Content-Range
+        stores only the last part it receives, and once one is detected files
+        are sent whole in a single request.
+
+        Args:
+            config: The transport section of the config, used to replace the
+            default settings of the transport.
+        """
+
+        opts = self.options()
+        opts = {var['name']: var for var in opts}
+
+        self.url = sensors.set_option('url', config, opts)
+        self.part_size = sensors.set_option('part_size', config, opts)
+        self.parallel = sensors.set_option('parallel', config, opts)
+        self.timeout = sensors.set_option('timeout', config, opts)
+        self.headers = sensors.set_option('headers', config, opts)
+        self.verify_certificate = sensors.set_option('verify_certificate', config, opts)
+
+        url = urlparse(self.url)
+        if url.scheme not in ['http', 'https']:
+            raise ValueError('Transport url must be http or https: {}'.format(self.url))
+        self.scheme = url.scheme
+        self.netloc = url.netloc
+        self.host = url.hostname
+        self.port = url.port or (443 if url.scheme == 'https' else 80)
+        self.base_path = url.path.rstrip('/')
+        # Cleared if the server is found to ignore Content-Range
+        self.ranges = True
+
+    @staticmethod
+    def options():
+        """
+        Static method defining the config options and defaults for the transport class
+        """
+        return [{'name': 'url',
+                 'type': str,
+                 'prompt': 'Enter the base URL of the upload endpoint'},
+                {'name': 'part_size',
+                 'type': int,
+                 'default': 4 * 1024 * 1024,
+                 'prompt': 'What is the size in bytes of each upload part?'},
+                {'name': 'parallel',
+                 'type': int,
+                 'default': 4,
+                 'prompt': 'How many parts should be uploaded at once?'},
+                {'name': 'timeout',
+                 'type': int,
+                 'default': 60,
+                 'prompt': 'What is the network timeout in seconds?'},
+                {'name': 'headers',
+                 'type': dict,
+                 'default': {},
+                 'prompt': 'Extra request headers, e.g. for authentication'},
+                {'name': 'verify_certificate',
+                 'type': int,
+                 'default': 1,
+                 'valid': [0, 1],
+                 'prompt': 'Verify the server certificate for HTTPS (1) or not (0)?'}
+                ]
+
+    def probe_address(self):
+        return self.host, self.port
+
+    def connect(self):
+        """
+        Method to open a connection to the upload endpoint
+
+        Returns:
+            An httplib connection instance.
+        """
+
+        if self.scheme == 'https':
+            if self.verify_certificate:
+                context = ssl.create_default_context()
+            else:
+                context = ssl._create_unverified_context()
+            return httplib.HTTPSConnection(self.netloc, timeout=self.timeout, context=context)
+        else:
+            return httplib.HTTPConnection(self.netloc, timeout=self.timeout)
+
+    def request(self, conn, method, remote_path, body=None, headers=None):
+        """
+        Method to make a request on a persistent connection, reading the whole
+        response so that the connection can be reused.
+
+        Returns:
+            A tuple of the response status, headers and body.
+        """
+
+        all_headers = dict(self.headers)
+        all_headers.update(headers or {})
+        conn.request(method, quote(self.base_path + '/' + remote_path), body, all_headers)
+        resp = conn.getresponse()
+        data = resp.read()
+        return resp.status, dict((k.lower(), v) for k, v in resp.getheaders()), data
+
+    def upload(self, upload_dir, manifest=None, die=None):
+        """
+        Method to upload each pending file in parts, removing local files once
+        the server reports the full size and, if it returns an X-Checksum-Sha256
+        header, the hash matches the manifest.
+
+        Args:
+            upload_dir: The upload directory to synchronise
+            manifest: An optional Manifest holding checksums of staged files
+            die: An optional threading event to stop the upload
+        Returns:
+            A list of the paths of the files uploaded and removed.
+        """
+
+        files, entries = self.pending_files(upload_dir, manifest)
+        conns = [self.connect() for _ in range(self.parallel)]
+        uploaded = []
+
+        try:
+            for path in files:
+                if die is not None and die.is_set():
+                    break
+                if manifest is not None and os.path.dirname(path) == manifest.manifest_dir:
+                    # Manifests are only sent once none of their files remain
+                    if any(os.path.exists(f) for f in manifest.read(path)):
+                        continue
+                if not self.upload_file(conns, path, upload_dir, entries.get(path), die):
+                    # Stop this sync on a failure, the remaining parts will resume next time
+                    break
+                uploaded.append(path)
+        finally:
+            for conn in conns:
+                conn.close()
+
+        logging.info('Uploaded {} of {} files over HTTP'.format(len(uploaded), len(files)))
+        return uploaded
+
+    def upload_file(self, conns, path, upload_dir, entry, die=None):
+        """
+        Method to upload the remaining parts of a single file in parallel and
+        check the result.
+
+        Args:
+            conns: A list of connections, one for each upload thread
+            path: The local file path
+            upload_dir: The top level upload directory
+            entry: The manifest entry for the file or None
+            die: An optional threading event to stop the upload
+        Returns:
+            A boolean showing if the file was uploaded and removed.
+        """
+
+        remote_path = self.remote_path(path, upload_dir)
+        size = os.path.getsize(path)
+        state_file = path + STATE_SUFFIX
+        part_size = self.part_size if self.ranges else max(size, 1)
+
+        # Load the parts sent by an interrupted upload of the same file
+        state = {'size': size, 'part_size': part_size, 'done': []}
+        if os.path.exists(state_file):
+            try:
+                with open(state_file) as sf:
+                    saved = json.load(sf)
+                if saved['size'] == size and saved['part_size'] == part_size:
+                    state = saved
+                    logging.info('Resuming upload of {} with {} parts sent'.format(
+                        path, len(state['done'])))
+            except (IOError, ValueError, KeyError):
+                pass
+
+        n_parts = max((size + part_size - 1) // part_size, 1)
+        parts = Queue()
+        for part in range(n_parts):
+            if part not in state['done']:
+                parts.put(part)
+
+        lock = threading.Lock()
+        failed = []
+
+        def send_parts(conn_idx):
+            # Upload parts from the queue on one of the persistent connections
+            with open(path, 'rb') as infile:
+                while not failed and not (die is not None and die.is_set()):
+                    try:
+                        part = parts.get_nowait()
+                    except Empty:
+                        return
+                    start = part * part_size
+                    infile.seek(start)
+                    if self.ranges:
+                        data = infile.read(part_size)
+                        headers = {'Content-Length': str(len(data))}
+                        if size > 0:
+                            headers['Content-Range'] = 'bytes {}-{}/{}'.format(
+                                start, start + len(data) - 1, size)
+                    else:
+                        # Stream the whole file rather than reading it into memory
+                        data = infile
+                        headers = {'Content-Length': str(size)}
+                    try:
+                        status, _, _ = self.request(conns[conn_idx], 'PUT', remote_path,
+                                                    data, headers)
+                    except (socket.error, httplib.HTTPException) as e:
+                        conns[conn_idx].close()
+                        conns[conn_idx] = self.connect()
+                        status = str(e)
+                    if status not in [200, 201, 204]:
+                        logging.error('Upload of part {} of {} failed: {}'.format(
+                            part, remote_path, status))
+                        failed.append(part)
+                        return
+                    with lock:
+                        state['done'].append(part)
+                        with open(state_file, 'w') as sf:
+                            json.dump(state, sf)
+
+        threads = [threading.Thread(target=send_parts, args=(i,)) for i in range(len(conns))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if len(state['done']) < n_parts:
+            return False
+
+        # Check the stored size, and the hash if the server reports one
+        try:
+            status, headers, _ = self.request(conns[0], 'HEAD', remote_path)
+        except (socket.error, httplib.HTTPException) as e:
+            conns[0].close()
+            conns[0] = self.connect()
+            logging.error('Could not check upload of {}: {}'.format(remote_path, e))
+            return False
+
+        remote_hash = headers.get('x-checksum-sha256')
+        remote_size = int(headers.get('content-length', -1))
+        intact = True
+        if status != 200 or remote_size != size:
+            logging.error('Remote size of {} does not match, uploading again'.format(remote_path))
+            intact = False
+            if status == 200 and self.ranges and n_parts > 1 and 0 <= remote_size <= part_size:
+                # Each part replaced the last, so the server ignores Content-Range
+                logging.error('Server does not support Content-Range PUT, sending whole files')
+                self.ranges = False
+        elif (entry is not None and remote_hash is not None and
+                remote_hash.lower() != entry[HASH_ALGORITHM]):
+            logging.error('Remote hash of {} does not match, uploading again'.format(remote_path))
+            intact = False
+
+        if os.path.exists(state_file):
+            os.remove(state_file)
+        if not intact:
+            return False
+
+        os.remove(path)
+
+        return True
@@ -0,0 +1,165 @@
+import os
+import socket
+import clock
+from integrity import PART_SUFFIX, PRIORITY_DIR
+from health import HEALTH_DIR
+
+
+class TransportBase(object):
+
+    def __init__(self, config=None):
+
+        """
+        A base class definition to set the methods for upload transport classes.
+
+        Args:
+            config: A dictionary loaded from a config JSON file used to update
+            the default settings of the transport.
+        """
+
+        self.config = config
+
+    @staticmethod
+    def options():
+        """
+        Static method defining the config options and defaults for the transport class
+        """
+        return []
+
+    def upload(self, upload_dir, manifest=None, die=None):
+        """
+        Method to upload the contents of the upload directory, removing local
+        files once they are safely on the server.
+
+        Args:
+            upload_dir: The upload directory to synchronise (top level, not the
+                device specific subdirectory)
+            manifest: An optional Manifest holding checksums of staged files
+            die: An optional threading event to stop the upload
+        Returns:
+            A list of the paths of the files sent and removed, which the catalog
+            marks as uploaded.
+        """
+        raise NotImplementedError
+
+    def probe_address(self):
+        """
+        Method giving the server address used to probe the link
+
+        Returns:
+            A tuple of the host and port, or None if not known.
+        """
+        return None
+
+    def probe(self, timeout=5):
+        """
+        Method to check cheaply that the server can be reached, by opening and
+        closing a TCP connection.
+
+        Args:
+            timeout: The time in seconds allowed to connect
+        Returns:
+            A boolean showing if the server could be reached. This is True if
+            the transport has no address to probe.
+        """
+
+        address = self.probe_address()
+        if address is None:
+            return True
+
+        try:
+            conn = socket.create_connection(address, timeout)
+            conn.close()
+            return True
+        except (socket.error, socket.timeout):
+            return False
+
+    @staticmethod
+    def pending_files(upload_dir, manifest=None, settle_time=60):
+        """
+        Find the files in the upload directory that are ready for upload. Files
+        still being staged have a .part suffix, and files without a manifest
+        entry must not have been modified in the last settle_time seconds.
+        Files are listed in upload_rank() order, and manifests last, after the
+        files they describe.
+
+        Args:
+            upload_dir: The upload directory to search
+            manifest: An optional Manifest holding checksums of staged files
+            settle_time: The time in seconds for unrecorded files to settle
+        Returns:
+            A tuple of a list of file paths and a dictionary of manifest entries.
+        """
+
+        entries = manifest.entries() if manifest is not None else {}
+        files = []
+        manifests = []
+        now = clock.time()
+        for subdir, dirs, fnames in os.walk(upload_dir):
+            for fname in sorted(fnames):
+                path = os.path.join(subdir, fname)
+                if fname.endswith(PART_SUFFIX):
+                    continue
+                if manifest is not None and subdir == manifest.manifest_dir:
+                    manifests.append(path)
+                elif path in entries or now - os.path.getmtime(path) > settle_time:
+                    files.append(path)
+
+        files.sort(key=lambda path: TransportBase.upload_rank(path, upload_dir))
+        return files + manifests, entries
+
+    @staticmethod
+    def local_files(upload_dir):
+        """
+        List every file in the upload directory that a mirror would send.
+
+        Args:
+            upload_dir: The upload directory to search
+        Returns:
+            A set of file paths, skipping files still being staged.
+        """
+
+        found = set()
+        for subdir, dirs, fnames in os.walk(upload_dir):
+            found.update(os.path.join(subdir, fname) for fname in fnames
+                         if not fname.endswith(PART_SUFFIX))
+        return found
+
+    @staticmethod
+    def upload_rank(path, upload_dir):
+        """
+        Get the upload order of a staged file. Health records go first, so that
+        sensor faults are reported early, then the files in each priority queue
+        (integrity.PRIORITY_DIR) from priority 0 up, then all other files.
+
+        Args:
+            path: The local file path
+            upload_dir: The top level upload directory
+        Returns:
+            A tuple sorting in upload order.
+        """
+
+        parts = os.path.relpath(os.path.dirname(path), upload_dir).split(os.sep)
+        if parts[-1] == HEALTH_DIR:
+            return 0, 0
+        if PRIORITY_DIR in parts[:-1]:
+            queue = parts[parts.index(PRIORITY_DIR) + 1]
+            if queue.isdigit():
+                return 1, int(queue)
+        return 2, 0
+
+    @staticmethod
+    def remote_path(path, upload_dir):
+        """
+        Get the remote path for a local file, matching the layout created by
+        mirroring the upload directory.
+
+        Args:
+            path: The local file path
+            upload_dir: The top level upload directory
+        Returns:
+            The remote path, using forward slashes.
+        """
+
+        remote_root = os.path.basename(os.path.normpath(upload_dir))
+        return '/'.join([remote_root] + os.path.relpath(path, upload_dir).split(os.sep))
@@ -0,0 +1,36 @@
+# Import individual transport class files into the transports module namespace
+# This does need to be edited as classes are added
+from transports.TransportBase import TransportBase
+from transports.FTPTransport import FTPTransport
+from transports.HTTPTransport import HTTPTransport
+
+# Transport types that can be selected in the transport section of the config
+TRANSPORT_TYPES = {'ftp': FTPTransport,
+                   'http': HTTPTransport}
+
+
+def configure_transport(config):
+    """
+    Get an upload transport from the config settings. The transport type is set
+    by the optional transport section of the config, defaulting to FTP using the
+    ftp section.
+
+    Args:
+        config: The full config dictionary
+
+    Returns:
+        An instance of a transport class.
+    """
+
+    transport_config = config.get('transport', {})
+    transport_type = transport_config.get('type', 'ftp')
+
+    try:
+        transport_class = TRANSPORT_TYPES[transport_type]
+    except KeyError:
+        raise ValueError('Transport type {} not found.'.format(transport_type))
+
+    if transport_type == 'ftp':
+        return transport_class(config.get('ftp'))
+    else:
+        return transport_class(transport_config)
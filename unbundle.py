@@ -0,0 +1,105 @@
+import os
+import sys
+import json
+import tarfile
+import argparse
+import logging
+
+
+"""
+Server side tool to restore the original layout of files bundled on a device
+by bundler.py. Run against the FTP landing area, each sealed archive found in
+a bundles directory is extracted into the device directory above it, checked
+against its embedded index and then removed.
+
+    python unbundle.py /srv/ftp/live_data
+"""
+
+BUNDLE_DIR = 'bundles'
+INDEX_NAME = 'bundle_index.json'
+
+
+def unbundle(archive_path, keep=False):
+    """
+    Extract a sealed bundle into the device directory above its bundles directory.
+
+    Args:
+        archive_path: The path to the sealed archive
+        keep: Should the archive be kept after extraction
+    Returns:
+        The number of files restored.
+    Raises:
+        ValueError if the archive is missing its index, contains unsafe paths
+        or the extracted files do not match the index.
+    """
+
+    device_dir = os.path.dirname(os.path.dirname(os.path.abspath(archive_path)))
+
+    with tarfile.open(archive_path, 'r') as archive:
+        try:
+            index = json.loads(archive.extractfile(INDEX_NAME).read().decode('utf-8'))
+        except KeyError:
+            raise ValueError('No index in {}'.format(archive_path))
+
+        members = []
+        for member in archive.getmembers():
+            if member.name == INDEX_NAME:
+                continue
+            target = os.path.abspath(os.path.join(device_dir, member.name))
+            if not member.isfile() or not target.startswith(device_dir + os.sep):
+                raise ValueError('Unsafe member {} in {}'.format(member.name, archive_path))
+            members.append(member)
+
+        archive.extractall(device_dir, members=members)
+
+    for entry in index['files']:
+        path = os.path.join(device_dir, entry['name'])
+        if not os.path.exists(path) or os.path.getsize(path) != entry['size']:
+            raise ValueError('{} does not match index of {}'.format(path, archive_path))
+
+    if not keep:
+        os.remove(archive_path)
+
+    return len(index['files'])
+
+
+def unbundle_tree(root, keep=False):
+    """
+    Find and extract all sealed bundles below a directory.
+
+    Args:
+        root: The directory to search, typically the live_data landing area
+        keep: Should archives be kept after extraction
+    Returns:
+        A tuple of the number of archives and files restored.
+    """
+
+    n_archives = 0
+    n_files = 0
+    for subdir, dirs, files in os.walk(root):
+        if os.path.basename(subdir) != BUNDLE_DIR:
+            continue
+        for fname in sorted(files):
+            if not fname.endswith('.tar'):
+                continue
+            path = os.path.join(subdir, fname)
+            try:
+                n_files += unbundle(path, keep=keep)
+                n_archives += 1
+                logging.info('Restored {}'.format(path))
+            except (ValueError, IOError, OSError, tarfile.TarError) as e:
+                logging.error('Could not restore {}: {}'.format(path, e))
+
+    return n_archives, n_files
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Restore files bundled by rpi-eco-monitoring devices')
+    parser.add_argument('root', help='The directory to search for bundles')
+    parser.add_argument('--keep', action='store_true', help='Keep archives after extraction')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout)
+    n_archives, n_files = unbundle_tree(args.root, keep=args.keep)
+    logging.info('Restored {} files from {} bundles'.format(n_files, n_archives))